@@ -0,0 +1,114 @@
+"""
+Write throughput of a single client pushing data to --replicas chunk servers (each in
+its own process), one after another (the client sends every replica a copy) and
+pipelined along a chain (the client sends one copy, the chunk servers forward it while
+receiving). The client's uplink is the bottleneck of a write, its sends are throttled
+to --link MB/s (0 for no limit, then loopback and the CPUs are the bottleneck).
+The best of --repeat pushes of each of --sizes megabytes is reported.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+import xmlrpc.client
+
+from common import load_script, temp_dir, Timer
+
+from commons import data_channel
+from commons.data_channel import DataChannel, start_data_server
+from commons.loggers import request_logger
+from commons.rpc_server import ThreadPoolXMLRPCServer
+
+
+def serve(path, ready):
+    request_logger.setLevel(logging.WARNING)
+    chunk_server_cls = load_script('chunkserver.py', {'log': request_logger})['ChunkServer']
+    cs = chunk_server_cls('http://bench', 'http://unused', path, os.path.join(path, 'meta.bin'))
+    rpc_server = ThreadPoolXMLRPCServer(('127.0.0.1', 0), 4, 16, logRequests=False, allow_none=True)
+    rpc_server.register_instance(cs)
+
+    def pushed():
+        """Number of payloads held, dropping them."""
+        count = len(cs.data)
+        cs.data.clear()
+        return count
+
+    rpc_server.register_function(pushed)
+    start_data_server('127.0.0.1', rpc_server.server_address[1], cs)
+    ready.put(f'http://127.0.0.1:{rpc_server.server_address[1]}')
+    rpc_server.serve_forever()
+
+
+def throttle(link):
+    """Limits the pieces sent by the data channels of this process to link bytes per second."""
+    def throttled_send_pieces(sock, data):
+        start = time.perf_counter()
+        view = memoryview(data)
+        for sent in range(0, len(view), 64 << 10):
+            time.sleep(max(0.0, start + sent / link - time.perf_counter()))
+            sock.sendall(view[sent:sent + (64 << 10)])
+        time.sleep(max(0.0, start + len(view) / link - time.perf_counter()))
+
+    data_channel.send_pieces = throttled_send_pieces
+
+
+def best_rate(size, repeat, push, addresses):
+    best = 0
+    for _ in range(repeat):
+        with Timer() as timer:
+            push()
+        for address in addresses:
+            assert xmlrpc.client.ServerProxy(address).pushed() == 1
+        best = max(best, size / timer.elapsed)
+    return best / (1 << 20)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 16, 64], help="push sizes in MB")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--link', type=float, default=100, help="client uplink in MB/s")
+    args = parser.parse_args()
+
+    path = temp_dir('chain_push_bench')
+    ready = multiprocessing.Queue()
+    processes = []
+    for i in range(args.replicas):
+        os.mkdir(os.path.join(path, str(i)))
+        process = multiprocessing.Process(target=serve, args=(os.path.join(path, str(i)), ready), daemon=True)
+        process.start()
+        processes.append(process)
+    addresses = [ready.get() for _ in processes]
+    channel = DataChannel()
+    if args.link:
+        # after the chunk servers have been forked, so that they are not limited
+        throttle(args.link * (1 << 20))
+
+    print(f"{'MB':>4} {'one by one MB/s':>16} {'chained MB/s':>13} {'speedup':>8}")
+    for mb in args.sizes:
+        size = mb << 20
+        payload = os.urandom(size)
+
+        def one_by_one():
+            for address in addresses:
+                assert not channel.push_data(address, 1, 0.0, payload)
+
+        def chained():
+            assert not channel.push_data(addresses[0], 1, 0.0, payload, addresses[1:])
+
+        sequential_rate = best_rate(size, args.repeat, one_by_one, addresses)
+        chained_rate = best_rate(size, args.repeat, chained, addresses)
+        print(f"{mb:>4} {sequential_rate:>16.1f} {chained_rate:>13.1f} {chained_rate / sequential_rate:>7.1f}x")
+
+    channel.close()
+    for process in processes:
+        process.terminate()
+        process.join()
+    shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Cost of verifying block checksums on the chunk server's read path. Random reads of
+--sizes bytes from --chunks chunk files are done through the open file cache only
+(pread, no verification) and through ChunkChecksums, with the files in the page cache.
+The first time, the blocks touched by a read are read whole and verified. Reads of
+blocks verified already (again) only read the bytes asked for.
+"""
+import argparse
+import os
+import random
+import shutil
+
+from common import temp_dir, Timer
+
+from commons.checksums import ChunkChecksums
+from commons.file_cache import FileCache
+from commons.settings import CHECKSUM_BLOCK_SIZE
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=16, help="number of chunk files")
+    parser.add_argument('--chunk-size', type=int, default=16 << 20, help="bytes per chunk file")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 4096, 65536, 1 << 20], help="bytes per read")
+    parser.add_argument('--reads', type=int, default=20000)
+    parser.add_argument('--block-size', type=int, default=CHECKSUM_BLOCK_SIZE)
+    args = parser.parse_args()
+
+    path = temp_dir('checksum_read_bench')
+    files = FileCache(path, args.chunks)
+    checksums = ChunkChecksums(files, args.block_size)
+    for chunk_handle in range(args.chunks):
+        checksums.write(chunk_handle, os.urandom(args.chunk_size), 0)
+
+    print(f"{'bytes':>8} {'plain us':>9} {'first us':>9} {'overhead':>9} {'again us':>9} {'overhead':>9}")
+    for size in args.sizes:
+        rng = random.Random(size)
+        reads = [(rng.randrange(args.chunks), rng.randrange(args.chunk_size - size))
+                 for _ in range(max(1, args.reads * 4096 // max(size, 4096)))]
+
+        with Timer() as plain:
+            for chunk_handle, offset in reads:
+                files.read(chunk_handle, offset, size)
+        verified_us = []
+        for _ in range(2):
+            with Timer() as verified:
+                for chunk_handle, offset in reads:
+                    data, err = checksums.read(chunk_handle, offset, size)
+                    assert not err and len(data) == size, err
+            verified_us.append(verified.elapsed / len(reads) * 1e6)
+        for flags in checksums.verified.values():
+            flags[:] = bytes(len(flags))  # as written, for the next size
+
+        plain_us = plain.elapsed / len(reads) * 1e6
+        first_us, again_us = verified_us
+        print(f"{size:>8} {plain_us:>9.1f} {first_us:>9.1f} {first_us / plain_us - 1:>9.0%} "
+              f"{again_us:>9.1f} {again_us / plain_us - 1:>9.0%}")
+
+    files.close()
+    shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Aggregate write throughput of one chunk server (the primary, without secondaries) for
+--clients concurrent clients spread over 1 to --clients distinct chunks. Every write
+grows its chunk, so it is logged to the chunk server's oplog, whose fsyncs take
+--fsync-latency ms more, as on a disk without a write cache. The reports to the master
+are queued and never sent.
+Mutations of a chunk are applied one at a time, those of different chunks in parallel
+(see commons/chunk_locks.py), the oplog commits the records of concurrent mutations
+with a single fsync. For comparison, all chunks are also put behind a single lock.
+"""
+import argparse
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import load_script, temp_dir, Timer
+
+from commons import oplog
+from commons.chunk_locks import ChunkLocks
+from commons.loggers import request_logger
+from commons.oplog import OplogWriter
+
+
+class ServerLock:
+    """The lock of every chunk is the same lock."""
+    __slots__ = 'locks'
+
+    def __init__(self):
+        self.locks = ChunkLocks()
+
+    def lock(self, chunk_handle):
+        return self.locks.lock(0)
+
+
+def slow_fsync(latency):
+    real_fsync = os.fsync
+
+    def fsync(fd):
+        time.sleep(latency)
+        real_fsync(fd)
+
+    oplog.os.fsync = fsync
+
+
+def run(cs, first_handle, chunks, clients, writes, size):
+    """Writes per second of clients writing chunks first_handle.. first_handle + chunks - 1."""
+    def client(client_id):
+        chunk_handle = first_handle + client_id % chunks
+        for timestamp in range(writes // clients):
+            assert not cs.put_data(client_id, timestamp, os.urandom(size))
+            offset = (timestamp * clients + client_id) * size
+            err = cs.write(client_id, timestamp, '/bench', 0, chunk_handle, offset, [cs.my_addr])
+            assert not err, err
+
+    with Timer() as timer, ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(client, range(clients)))
+    return writes // clients * clients / timer.elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--chunks', type=int, nargs='+', default=[1, 2, 4, 8, 16], help="distinct chunks written")
+    parser.add_argument('--writes', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=4096, help="bytes per write")
+    parser.add_argument('--fsync-latency', type=float, default=5, help="ms added to every fsync of the oplog")
+    args = parser.parse_args()
+
+    request_logger.setLevel(logging.WARNING)
+    chunk_server_cls = load_script('chunkserver.py', {'log': request_logger})['ChunkServer']
+    path = temp_dir('chunk_lock_bench')
+
+    cs = chunk_server_cls('http://bench', 'http://unused', path, os.path.join(path, 'meta.bin'))
+    cs.oplog = OplogWriter(cs.metadata_file)
+    if args.fsync_latency:
+        slow_fsync(args.fsync_latency / 1000)
+    chunk_locks = cs.chunk_locks
+
+    print(f"{'chunks':>6} {'server lock writes/s':>21} {'chunk locks writes/s':>21} {'speedup':>8}")
+    first_handle = 0
+    for chunks in args.chunks:
+        rates = []
+        for cs.chunk_locks in ServerLock(), chunk_locks:
+            rates.append(run(cs, first_handle, chunks, args.clients, args.writes, args.size))
+            first_handle += chunks  # fresh chunks, so that every write grows its chunk
+        print(f"{chunks:>6} {rates[0]:>21.0f} {rates[1]:>21.0f} {rates[1] / rates[0]:>7.1f}x")
+
+    shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Small random reads of chunk files by ChunkServer.read, called in process so that the
+RPC layer does not hide the cost of the file accesses. The reads are done once by
+opening, seeking, reading and closing the chunk file per read (the former read path),
+and once through the chunk server's cache of open files, with --cache entries.
+A cache smaller than --chunks shows the cost of the misses.
+"""
+import argparse
+import logging
+import os
+import random
+import shutil
+
+from common import load_script, temp_dir, Timer
+
+from commons.loggers import request_logger
+
+
+def open_per_read(path, chunk_handle, offset, length):
+    with open(f'{path}/{chunk_handle}', 'rb') as file:
+        file.seek(offset)
+        return file.read(length)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=200, help="number of chunk files")
+    parser.add_argument('--chunk-size', type=int, default=1 << 20, help="bytes per chunk file")
+    parser.add_argument('--size', type=int, default=512, help="bytes per read")
+    parser.add_argument('--reads', type=int, default=100000)
+    parser.add_argument('--cache', type=int, nargs='+', default=[256, 100], help="cache sizes to measure")
+    args = parser.parse_args()
+
+    request_logger.setLevel(logging.WARNING)
+    chunk_server_cls = load_script('chunkserver.py', {'log': request_logger})['ChunkServer']
+
+    path = temp_dir('chunk_read_bench')
+    for chunk_handle in range(args.chunks):
+        with open(os.path.join(path, str(chunk_handle)), 'wb') as fp:
+            fp.write(os.urandom(args.chunk_size))
+
+    rng = random.Random(42)
+    reads = [(rng.randrange(args.chunks), rng.randrange(args.chunk_size - args.size)) for _ in range(args.reads)]
+
+    print(f"{'path':>16} {'reads/s':>10} {'us/read':>8} {'hit rate':>9}")
+    with Timer() as timer:
+        for chunk_handle, offset in reads:
+            open_per_read(path, chunk_handle, offset, args.size)
+    print(f"{'open per read':>16} {args.reads / timer.elapsed:>10.0f} {timer.elapsed / args.reads * 1e6:>8.1f}")
+
+    for capacity in args.cache:
+        cs = chunk_server_cls('http://bench', 'http://unused', path, os.path.join(path, 'meta.bin'))
+        cs.files.capacity = capacity
+        with Timer() as timer:
+            for chunk_handle, offset in reads:
+                data, err = cs.read(chunk_handle, offset, args.size)
+                assert not err and len(data) == args.size, err
+        stats = cs.files.stats()
+        cs.files.close()
+        hit_rate = stats['hits'] / (stats['hits'] + stats['misses'])
+        print(f"{f'cache of {capacity}':>16} {args.reads / timer.elapsed:>10.0f} "
+              f"{timer.elapsed / args.reads * 1e6:>8.1f} {hit_rate:>9.1%}")
+
+    shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Chunk reports sent to the master by one chunk server while --clients concurrent clients
+append small records (--size bytes writes at the end) to --chunks chunks. Every write
+grows its chunk. Reports are sent one RPC per write, as a chunk server used to, or
+queued, coalesced per chunk and sent in batches (see commons/chunk_reporter.py). The
+master takes --master-latency ms to take a call.
+"""
+import argparse
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import load_script, temp_dir, Timer
+
+from commons.loggers import request_logger
+from commons.oplog import OplogWriter
+from commons.rpc_server import ThreadPoolXMLRPCServer
+from commons.settings import CHUNK_REPORT_INTERVAL, CHUNK_REPORT_BATCH
+
+
+class Master:
+    """Counts the reports it gets."""
+    __slots__ = 'latency', 'lock', 'calls', 'reports'
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.reports = 0
+
+    def report_chunks(self, server, reports):
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+            self.reports += len(reports)
+        return []
+
+    def counts(self):
+        with self.lock:
+            counts = self.calls, self.reports
+            self.calls = self.reports = 0
+            return counts
+
+
+class PerWriteReporter:
+    """Sends every report right away, from the writing thread."""
+    __slots__ = 'send'
+
+    def __init__(self, send):
+        self.send = send
+
+    def report(self, chunk_handle, chunk_index, length, new=False):
+        self.send([[chunk_handle, chunk_index, length]])
+
+    def flush(self):
+        return True
+
+
+def run(cs, first_handle, chunks, clients, writes, size):
+    """Writes per second of clients appending to chunks first_handle.. first_handle + chunks - 1."""
+    def client(client_id):
+        chunk_handle = first_handle + client_id % chunks
+        for timestamp in range(writes // clients):
+            assert not cs.put_data(client_id, timestamp, os.urandom(size))
+            offset = (timestamp * clients + client_id) * size
+            err = cs.write(client_id, timestamp, '/bench', 0, chunk_handle, offset, [cs.my_addr])
+            assert not err, err
+
+    with Timer() as timer, ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(client, range(clients)))
+    cs.reporter.flush()
+    return writes // clients * clients / timer.elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--chunks', type=int, default=4)
+    parser.add_argument('--writes', type=int, default=4000)
+    parser.add_argument('--size', type=int, default=100, help="bytes per record")
+    parser.add_argument('--master-latency', type=float, default=1, help="ms the master takes to take a call")
+    args = parser.parse_args()
+
+    request_logger.setLevel(logging.WARNING)
+    chunk_server = load_script('chunkserver.py', {'log': request_logger})
+    chunk_server_cls, report_chunks = chunk_server['ChunkServer'], chunk_server['report_chunks']
+    path = temp_dir('chunk_report_bench')
+
+    master = Master(args.master_latency / 1000)
+    rpc_server = ThreadPoolXMLRPCServer(('127.0.0.1', 0), 16, 64, logRequests=False, allow_none=True)
+    rpc_server.register_instance(master)
+    threading.Thread(target=rpc_server.serve_forever, daemon=True).start()
+
+    cs = chunk_server_cls('http://bench', f'http://127.0.0.1:{rpc_server.server_address[1]}', path,
+                          os.path.join(path, 'meta.bin'))
+    cs.oplog = OplogWriter(cs.metadata_file)
+    batched = cs.reporter
+    batched.start()
+    per_write = PerWriteReporter(lambda reports: report_chunks(cs, reports))
+
+    print(f"interval {CHUNK_REPORT_INTERVAL}s, batches of up to {CHUNK_REPORT_BATCH} chunks")
+    print(f"{'reports':>10} {'writes/s':>9} {'master calls':>13} {'calls/write':>12} {'chunks/call':>12}")
+    first_handle = 0
+    for name, reporter in ('per write', per_write), ('batched', batched):
+        cs.reporter = reporter
+        rate = run(cs, first_handle, args.chunks, args.clients, args.writes, args.size)
+        first_handle += args.chunks
+        calls, reports = master.counts()
+        writes = args.writes // args.clients * args.clients
+        print(f"{name:>10} {rate:>9.0f} {calls:>13} {calls / writes:>12.3f} {reports / max(calls, 1):>12.1f}")
+
+    rpc_server.shutdown()
+    shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Memory used by the master's chunk metadata, in bytes per chunk.
+"dict" rebuilds the previous layout of ChunkManager: four dicts of small objects
+keyed by path (chunks, handles, locations with a list per chunk, and
+chunks_of_chunk_server lists), "table" is the array backed ChunkTable keyed by file id. Both hold the same chunks,
+REPLICATION_FACTOR replicas each, spread over --servers chunk servers.
+"""
+import argparse
+import gc
+import random
+import tracemalloc
+from collections import defaultdict
+
+import common  # noqa: F401 (sets up sys.path)
+
+from commons.settings import REPLICATION_FACTOR
+from master.chunk_manager import ChunkInfo
+from master.chunk_table import ChunkTable
+
+
+class Chunk:
+    # the removed ChunkManager chunks value
+    __slots__ = 'chunk_handle'
+
+    def __init__(self, chunk_handle=0):
+        self.chunk_handle = chunk_handle
+
+
+class PathIndex:
+    # the removed ChunkManager handles value
+    __slots__ = 'path', 'index'
+
+    def __init__(self, path="", index=0):
+        self.path = path
+        self.index = index
+
+
+def chunk_layout(chunks, chunks_per_file, servers, seed):
+    """Yields (handle, file id, path, chunk index, locations), the same for every layout."""
+    rng = random.Random(seed)
+    addresses = [f'http://10.0.{i // 256}.{i % 256}:9010' for i in range(servers)]
+    for handle in range(chunks):
+        file_id, chunk_index = divmod(handle, chunks_per_file)
+        yield handle, file_id, f'/data/dir{file_id % 1000}/file{file_id}', chunk_index, \
+            rng.sample(addresses, REPLICATION_FACTOR)
+
+
+def build_dicts(layout):
+    chunks, handles, locations = {}, {}, {}
+    chunks_of_chunk_server = defaultdict(list)
+    for handle, _, path, chunk_index, chunk_locations in layout:
+        chunks.setdefault(path, {})[chunk_index] = Chunk(handle)
+        handles[handle] = PathIndex(path, chunk_index)
+        locations[handle] = ChunkInfo(handle, chunk_locations)
+        for address in chunk_locations:
+            chunks_of_chunk_server[address].append(handle)
+    return chunks, handles, locations, chunks_of_chunk_server
+
+
+def build_table(layout):
+    table = ChunkTable(REPLICATION_FACTOR)
+    for handle, file_id, _, chunk_index, chunk_locations in layout:
+        table.add(handle, file_id, chunk_index, chunk_locations)
+    return table
+
+
+def measure(build, args):
+    gc.collect()
+    tracemalloc.start()
+    tables = build(chunk_layout(args.chunks, args.chunks_per_file, args.servers, args.seed))
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tables
+    return size / args.chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=200000)
+    parser.add_argument('--chunks-per-file', type=int, default=16)
+    parser.add_argument('--servers', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'layout':>8} {'bytes/chunk':>12}")
+    for name, build in (('dict', build_dicts), ('table', build_table)):
+        print(f"{name:>8} {measure(build, args):>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
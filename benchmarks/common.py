@@ -0,0 +1,32 @@
+# Helpers shared by the benchmarks
+import os
+import runpy
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+
+def load_script(name, init_globals=None):
+    """Returns the globals of a top level script (eg. master.py) without running its __main__ block.
+    The scripts can't simply be imported because master.py is shadowed by the master package.
+    init_globals provides names the script only defines in its __main__ block (eg. log of chunkserver.py)."""
+    return runpy.run_path(os.path.join(ROOT_DIR, name), init_globals)
+
+
+def temp_dir(prefix):
+    return tempfile.mkdtemp(prefix=f'gfs_{prefix}_')
+
+
+class Timer:
+    """Context manager measuring wall clock time in seconds."""
+    __slots__ = 'start', 'elapsed'
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
@@ -0,0 +1,88 @@
+"""
+Throughput of chunk data transfers over XML-RPC (base64 in XML) and over the binary
+data channel, for push_data and read of --sizes megabytes. An in-process ChunkServer
+serves both, the best of --repeat transfers of each size is reported.
+"""
+import argparse
+import logging
+import os
+import shutil
+import threading
+import xmlrpc.client
+
+from common import load_script, temp_dir, Timer
+
+from commons.data_channel import DataChannel, start_data_server
+from commons.loggers import request_logger
+from commons.rpc_server import ThreadPoolXMLRPCServer
+
+
+def best_rate(size, repeat, transfer):
+    best = 0
+    for _ in range(repeat):
+        with Timer() as timer:
+            transfer()
+        best = max(best, size / timer.elapsed)
+    return best / (1 << 20)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 4, 16, 64], help="transfer sizes in MB")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    request_logger.setLevel(logging.WARNING)
+    chunk_server_cls = load_script('chunkserver.py', {'log': request_logger})['ChunkServer']
+
+    path = temp_dir('data_channel_bench')
+    cs = chunk_server_cls('http://bench', 'http://unused', path, os.path.join(path, 'meta.bin'))
+    rpc_server = ThreadPoolXMLRPCServer(('127.0.0.1', 0), 4, 16, logRequests=False, allow_none=True)
+    rpc_server.register_instance(cs)
+    port = rpc_server.server_address[1]
+    threading.Thread(target=rpc_server.serve_forever, daemon=True).start()
+    data_server = start_data_server('127.0.0.1', port, cs)
+
+    address = f'http://127.0.0.1:{port}'
+    proxy = xmlrpc.client.ServerProxy(address, allow_none=True)
+    channel = DataChannel()
+
+    print(f"{'MB':>4} {'op':>10} {'xmlrpc MB/s':>12} {'channel MB/s':>13} {'speedup':>8}")
+    for mb in args.sizes:
+        size = mb << 20
+        payload = os.urandom(size)
+        with open(os.path.join(path, str(mb)), 'wb') as fp:
+            fp.write(payload)
+
+        def push_rpc():
+            proxy.push_data(1, 0.0, payload)
+            cs.data.clear()
+
+        def push_channel():
+            channel.push_data(address, 1, 0.0, payload)
+            cs.data.clear()
+
+        def read_rpc():
+            data, err = proxy.read(mb, 0, size)
+            assert not err and len(data.data) == size, err
+
+        def read_channel():
+            data, err = channel.read(address, mb, 0, size)
+            assert not err and len(data) == size, err
+
+        for op, rpc, data_channel in (('push_data', push_rpc, push_channel), ('read', read_rpc, read_channel)):
+            rpc_rate = best_rate(size, args.repeat, rpc)
+            channel_rate = best_rate(size, args.repeat, data_channel)
+            print(f"{mb:>4} {op:>10} {rpc_rate:>12.1f} {channel_rate:>13.1f} {channel_rate / rpc_rate:>7.1f}x")
+
+    channel.close()
+    data_server.shutdown()
+    data_server.server_close()
+    rpc_server.shutdown()
+    rpc_server.server_close()
+    cs.files.close()
+    shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Multithreaded create stress benchmark against an in-process Master.
+Every thread creates files in its own directory (disjoint subtrees), so with
+hierarchical path locking and the group-commit oplog, create ops/sec should
+grow with the number of client threads instead of staying flat.
+"""
+import argparse
+import logging
+import os
+import shutil
+import threading
+
+from common import load_script, temp_dir, Timer
+
+from commons.loggers import default_logger, request_logger
+from commons.oplog import OplogWriter
+
+
+def run(master_cls, threads, files_per_thread):
+    work_dir = temp_dir('ns_bench')
+    m = master_cls('http://bench', os.path.join(work_dir, 'oplog.bin'), os.path.join(work_dir, 'checkpoint.bin'))
+    m.oplog = OplogWriter(m.metadata_file)
+
+    for t in range(threads):
+        m.create_dir(f'/dir{t}')
+
+    def worker(t):
+        for i in range(files_per_thread):
+            m.create(f'/dir{t}/file{i}')
+
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    with Timer() as timer:
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+    m.oplog.close()
+    shutil.rmtree(work_dir)
+    return threads * files_per_thread / timer.elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--files', type=int, default=500, help="files created by each thread")
+    args = parser.parse_args()
+
+    default_logger.setLevel(logging.WARNING)
+    request_logger.setLevel(logging.WARNING)
+    master_cls = load_script('master.py')['Master']
+
+    print(f"{'threads':>8} {'creates/sec':>12}")
+    for threads in args.threads:
+        print(f"{threads:>8} {run(master_cls, threads, args.files):>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
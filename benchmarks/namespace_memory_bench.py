@@ -0,0 +1,149 @@
+"""
+Memory and lookup latency of the master's namespace for a synthetic tree of --files files.
+"dict" rebuilds the previous layout of NamespaceManager: a dict of full paths -> Path
+objects and a sorted list of full child paths per directory, "inode" is the InodeTable
+used now, where every path component is stored once. Each layout is built in its own
+process, memory is the growth of the resident set size while loading the tree.
+Lookups resolve random existing paths, the way every RPC resolves its path.
+"""
+import argparse
+import bisect
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import common  # noqa: F401 (sets up sys.path)
+
+from master.namespace_manager import NamespaceManager, get_parent
+
+
+class Path:
+    # the removed NamespaceManager paths value
+    __slots__ = 'is_dir', 'length'
+
+    def __init__(self, is_dir=False, length=0):
+        self.is_dir = is_dir
+        self.length = length
+
+
+class DictNamespace:
+    __slots__ = 'paths', 'children'
+
+    def __init__(self):
+        self.paths = {'/': Path(True, 0)}
+        self.children = {'/': []}
+
+    def insert_path(self, path, is_dir):
+        self.paths[path] = Path(is_dir, 0)
+        if is_dir:
+            self.children[path] = []
+        bisect.insort(self.children[get_parent(path)], path)
+
+    def lookup(self, path):
+        return self.paths.get(path, None)
+
+
+class InodeNamespace:
+    __slots__ = 'ns',
+
+    def __init__(self):
+        self.ns = NamespaceManager()
+
+    def insert_path(self, path, is_dir):
+        self.ns.insert_path(path, is_dir)
+
+    def lookup(self, path):
+        return self.ns.inodes.lookup(path)
+
+
+LAYOUTS = {'dict': DictNamespace, 'inode': InodeNamespace}
+
+
+def file_path(i, files_per_dir):
+    """/bench/u<user>/p<project>/part-<n>: 100 projects per user, file names repeat in every directory."""
+    directory = i // files_per_dir
+    return f'/bench/u{directory // 100}/p{directory % 100}/part-{i % files_per_dir:05d}'
+
+
+def tree(files, files_per_dir):
+    """Yields (path, is_dir) in creation order, every directory before its children."""
+    dirs = set()
+    for i in range(files):
+        path = file_path(i, files_per_dir)
+        parent = get_parent(path)
+        if parent not in dirs:
+            missing = []
+            while parent != '/' and parent not in dirs:
+                missing.append(parent)
+                parent = get_parent(parent)
+            for directory in reversed(missing):
+                dirs.add(directory)
+                yield directory, True
+        yield path, False
+
+
+def rss():
+    """Current resident set size in bytes."""
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:  # not linux, peak instead of current
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(layout, args):
+    """Runs in a child process, returns bytes per file and lookup latency in microseconds."""
+    before = rss()
+    namespace = LAYOUTS[layout]()
+    start = time.perf_counter()
+    for path, is_dir in tree(args.files, args.files_per_dir):
+        namespace.insert_path(path, is_dir)
+    load_time = time.perf_counter() - start
+    used = rss() - before
+
+    rng = random.Random(args.seed)
+    sample = [file_path(rng.randrange(args.files), args.files_per_dir) for _ in range(args.lookups)]
+    start = time.perf_counter()
+    for path in sample:
+        namespace.lookup(path)
+    lookup_time = time.perf_counter() - start
+
+    return {
+        'bytes_per_file': used / args.files,
+        'rss_mb': used / 2 ** 20,
+        'load_s': load_time,
+        'lookup_us': lookup_time / args.lookups * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=10_000_000)
+    parser.add_argument('--files-per-dir', type=int, default=1000)
+    parser.add_argument('--lookups', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--layout', choices=sorted(LAYOUTS), nargs='+', default=['dict', 'inode'])
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.layout[0], args)))
+        return
+
+    print(f"{'layout':>8} {'RSS MB':>10} {'bytes/file':>11} {'load s':>8} {'lookup us':>10}")
+    for layout in args.layout:
+        # a fresh process per layout, memory freed by the previous one is not returned to the OS
+        out = subprocess.run([sys.executable, __file__, '--child', '--layout', layout, '--files', str(args.files),
+                              '--files-per-dir', str(args.files_per_dir), '--lookups', str(args.lookups),
+                              '--seed', str(args.seed)], check=True, capture_output=True, text=True).stdout
+        result = json.loads(out)
+        print(f"{layout:>8} {result['rss_mb']:>10.1f} {result['bytes_per_file']:>11.1f} {result['load_s']:>8.1f} "
+              f"{result['lookup_us']:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Simulation comparing chunk placement skew of the load aware policy against random placement.
+
+A cluster of chunk servers with heterogeneous disks receives a stream of new
+chunks; half way through, fresh empty servers join. Chunk servers report their
+stats every --report-every allocations, writes go to recently created chunks.
+Reported: chunk count and disk utilization spread, and the write load of the
+hottest server relative to the average, at the end of the run.
+"""
+import argparse
+import random
+import statistics
+from collections import deque
+
+import common  # noqa: F401 (sets up sys.path)
+
+from commons.settings import REPLICATION_FACTOR
+from master.placement import PLACEMENT_POLICIES, ServerStats
+
+CHUNK_MB = 64
+
+
+class SimClock:
+    __slots__ = 'now',
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class SimServer:
+    __slots__ = 'addr', 'capacity_mb', 'chunks', 'written_mb'
+
+    def __init__(self, addr, capacity_mb):
+        self.addr = addr
+        self.capacity_mb = capacity_mb
+        self.chunks = 0
+        self.written_mb = 0.0  # since the last report
+
+    def report(self, interval):
+        report = {
+            'disk_total': float(self.capacity_mb),
+            'disk_used': float(self.chunks * CHUNK_MB),
+            'chunk_count': self.chunks,
+            'write_load': self.written_mb / interval,
+        }
+        self.written_mb = 0.0
+        return report
+
+
+def simulate(policy_name, args, seed):
+    rng = random.Random(seed)
+    random.seed(seed)  # the policies use the global generator
+    clock = SimClock()
+    policy = PLACEMENT_POLICIES[policy_name](clock=clock)
+
+    servers = {}
+    stats = {}
+
+    def add_server(joined):
+        addr = f'cs{len(servers)}'
+        servers[addr] = SimServer(addr, rng.choice(args.disks_gb) * 1024)
+        stats[addr] = ServerStats(joined=joined)
+
+    for _ in range(args.servers):
+        add_server(joined=-10 ** 6)  # long time members
+
+    hot_chunks = deque(maxlen=args.hot_chunks)  # recently created chunks receive the writes
+    for i in range(args.chunks):
+        if i == args.chunks // 2:
+            for _ in range(args.new_servers):
+                add_server(joined=clock.now)
+
+        clock.now += args.seconds_per_chunk
+        placed = policy.place(list(servers), REPLICATION_FACTOR, stats)
+        policy.record(placed, stats)
+        for addr in placed:
+            servers[addr].chunks += 1
+        hot_chunks.append(placed)
+
+        # every hot chunk gets a small write on all of its replicas
+        for replicas in hot_chunks:
+            for addr in replicas:
+                servers[addr].written_mb += args.write_mb
+
+        if i % args.report_every == 0:
+            interval = args.report_every * args.seconds_per_chunk
+            for addr, server in servers.items():
+                stats[addr].update(server.report(interval))
+
+    counts = [s.chunks for s in servers.values()]
+    utilization = [s.chunks * CHUNK_MB / s.capacity_mb for s in servers.values()]
+    loads = [st.write_load for st in stats.values()]
+    new_counts = counts[args.servers:] or [0]
+    return {
+        'chunks max/mean': max(counts) / statistics.mean(counts),
+        'util max': max(utilization),
+        'util stdev': statistics.pstdev(utilization),
+        'load max/mean': max(loads) / (statistics.mean(loads) or 1),
+        'new server chunks': statistics.mean(new_counts),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', type=int, default=20)
+    parser.add_argument('--new-servers', type=int, default=4, help="empty servers joining half way through")
+    parser.add_argument('--disks-gb', type=int, nargs='+', default=[500, 1000, 2000, 4000])
+    parser.add_argument('--chunks', type=int, default=20000)
+    parser.add_argument('--seconds-per-chunk', type=float, default=0.05)
+    parser.add_argument('--hot-chunks', type=int, default=50, help="number of recent chunks receiving writes")
+    parser.add_argument('--write-mb', type=float, default=0.5)
+    parser.add_argument('--report-every', type=int, default=200, help="allocations between two stats reports")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    results = {name: simulate(name, args, args.seed) for name in ('random', 'load_aware')}
+    metrics = list(results['random'])
+    print(f"{'metric':>18} " + ' '.join(f'{name:>12}' for name in results))
+    for metric in metrics:
+        print(f"{metric:>18} " + ' '.join(f'{results[name][metric]:>12.3f}' for name in results))
+
+
+if __name__ == '__main__':
+    main()
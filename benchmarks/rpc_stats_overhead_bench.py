@@ -0,0 +1,109 @@
+"""
+Overhead of the RPC instrumentation on the hot chunk server paths, push_data and read.
+An in-process ChunkServer is served once by an uninstrumented server with plain locks
+and once by the instrumented server, --threads clients call each RPC --calls times.
+The runs alternate --repeat times, the best rate of each is reported.
+"""
+import argparse
+import logging
+import os
+import shutil
+import threading
+import xmlrpc.client
+from xmlrpc.server import SimpleXMLRPCServer
+
+from common import load_script, temp_dir, Timer
+
+from commons.loggers import request_logger
+from commons.rpc_server import ThreadPoolXMLRPCServer
+from commons.stats import format_stats
+
+
+class PlainXMLRPCServer(ThreadPoolXMLRPCServer):
+    """The thread pool server without per RPC measurements."""
+    _marshaled_dispatch = SimpleXMLRPCServer._marshaled_dispatch
+    _dispatch = SimpleXMLRPCServer._dispatch
+
+
+def serve(chunk_server_cls, path, instrumented):
+    cs = chunk_server_cls('http://bench', 'http://unused', path, os.path.join(path, 'meta.bin'))
+    if instrumented:
+        server = ThreadPoolXMLRPCServer(('127.0.0.1', 0), 16, 64, {'ChunkServer.mutex': cs.mutex,
+                                                                  'ChunkServer.data_mutex': cs.data.mutex},
+                                        logRequests=False, allow_none=True)
+    else:
+        cs.mutex = threading.Lock()
+        cs.data.mutex = threading.Lock()
+        server = PlainXMLRPCServer(('127.0.0.1', 0), 16, 64, logRequests=False, allow_none=True)
+    server.register_instance(cs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return cs, server
+
+
+def rate(address, threads, calls, call):
+    def worker(t):
+        proxy = xmlrpc.client.ServerProxy(address, allow_none=True)
+        for i in range(calls):
+            call(proxy, t, i)
+
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    with Timer() as timer:
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+    return threads * calls / timer.elapsed
+
+
+def run(chunk_server_cls, instrumented, args):
+    path = temp_dir('rpc_stats_bench')
+    payload = os.urandom(args.size)
+    with open(os.path.join(path, '0'), 'wb') as fp:
+        fp.write(payload)
+
+    cs, server = serve(chunk_server_cls, path, instrumented)
+    address = f'http://127.0.0.1:{server.server_address[1]}'
+    data = xmlrpc.client.Binary(payload)
+    push = rate(address, args.threads, args.calls, lambda proxy, t, i: proxy.push_data(t, i, data))
+    cs.data.clear()
+    read = rate(address, args.threads, args.calls, lambda proxy, t, i: proxy.read(0, 0, args.size))
+    stats = server.get_stats() if instrumented else None
+
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(path)
+    return push, read, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--calls', type=int, default=2000, help="calls of each RPC by each thread")
+    parser.add_argument('--size', type=int, default=4096, help="bytes pushed and read by each call")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dump', action='store_true', help="print the stats of the last instrumented run")
+    args = parser.parse_args()
+
+    request_logger.setLevel(logging.WARNING)
+    chunk_server_cls = load_script('chunkserver.py', {'log': request_logger})['ChunkServer']
+
+    best = {False: [0, 0], True: [0, 0]}
+    stats = None
+    for _ in range(args.repeat):
+        for instrumented in (False, True):
+            push, read, run_stats = run(chunk_server_cls, instrumented, args)
+            best[instrumented] = [max(best[instrumented][0], push), max(best[instrumented][1], read)]
+            stats = run_stats or stats
+
+    print(f"{'rpc':>10} {'plain/s':>10} {'stats/s':>10} {'overhead':>9}")
+    for column, rpc in enumerate(('push_data', 'read')):
+        plain, instrumented = best[False][column], best[True][column]
+        print(f"{rpc:>10} {plain:>10.0f} {instrumented:>10.0f} {(plain - instrumented) / plain:>9.1%}")
+
+    if args.dump:
+        print()
+        print(format_stats(stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Latency of writes through a primary chunk server with --replicas - 1 secondaries, each
+taking a random time (exponential, mean --delay ms) to apply a mutation. The primary
+sends a mutation to its secondaries one by one (a single fan-out thread, a write takes
+the sum of their delays, and waits for the writes before it) or to all of them at once
+(a write takes the slowest of them). --clients write the same chunk concurrently, their
+writes are pipelined, the secondaries apply them in the order of the primary (see
+commons/mutation_order.py).
+"""
+import argparse
+import logging
+import os
+import random
+import shutil
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import load_script, temp_dir, Timer
+
+from commons.loggers import request_logger
+from commons.oplog import OplogWriter
+from commons.rpc_server import ThreadPoolXMLRPCServer
+from commons.settings import FANOUT_WORKERS
+
+
+def serve(instance, functions=()):
+    rpc_server = ThreadPoolXMLRPCServer(('127.0.0.1', 0), 16, 64, logRequests=False, allow_none=True)
+    rpc_server.register_instance(instance)
+    for function in functions:
+        rpc_server.register_function(function)
+    threading.Thread(target=rpc_server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{rpc_server.server_address[1]}'
+
+
+def start_chunk_server(chunk_server_cls, path, delay=None):
+    os.mkdir(path)
+    # the chunk reports to the master are queued, and never sent
+    cs = chunk_server_cls('http://bench', 'http://unused', path, os.path.join(path, 'meta.bin'))
+    cs.oplog = OplogWriter(cs.metadata_file)
+    if delay is None:
+        cs.my_addr = serve(cs)
+        return cs
+
+    def serialized_write(*args):
+        time.sleep(random.expovariate(1000 / delay))
+        return cs.serialized_write(*args)
+
+    # functions are dispatched before the instance
+    cs.my_addr = serve(cs, [serialized_write])
+    return cs
+
+
+def percentile(latencies, p):
+    return sorted(latencies)[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+
+def run(primary, secondaries, writes, clients, size):
+    """Latencies of writes of size bytes to chunk 1 by concurrent clients, and the writes per second."""
+    chunk_locations = [primary.my_addr] + [cs.my_addr for cs in secondaries]
+    latencies = []
+
+    def client(client_id):
+        for timestamp in range(writes // clients):
+            data = os.urandom(size)
+            for cs in [primary] + secondaries:
+                assert not cs.put_data(client_id, timestamp, data)
+            with Timer() as timer:
+                err = primary.write(client_id, timestamp, '/bench', 0, 1, 0, chunk_locations)
+            assert not err, err
+            latencies.append(timer.elapsed)
+
+    with Timer() as total, ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(client, range(clients)))
+    return latencies, len(latencies) / total.elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--delay', type=float, default=20, help="mean ms a secondary takes to apply a mutation")
+    parser.add_argument('--writes', type=int, default=1000)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--size', type=int, default=4096, help="bytes per write")
+    args = parser.parse_args()
+
+    request_logger.setLevel(logging.WARNING)
+    chunk_server_cls = load_script('chunkserver.py', {'log': request_logger})['ChunkServer']
+    path = temp_dir('secondary_fanout_bench')
+    primary = start_chunk_server(chunk_server_cls, os.path.join(path, 'primary'))
+    secondaries = [start_chunk_server(chunk_server_cls, os.path.join(path, str(i)), args.delay)
+                   for i in range(args.replicas - 1)]
+
+    print(f"{'clients':>7} {'fan-out':>10} {'p50 ms':>7} {'p99 ms':>7} {'writes/s':>9}")
+    for clients in args.clients:
+        for name, workers in ('one by one', 1), ('concurrent', FANOUT_WORKERS):
+            primary.fanout = ThreadPoolExecutor(max_workers=workers)
+            latencies, rate = run(primary, secondaries, args.writes, clients, args.size)
+            primary.fanout.shutdown()
+            print(f"{clients:>7} {name:>10} {statistics.median(latencies) * 1000:>7.1f} "
+                  f"{percentile(latencies, 0.99):>7.1f} {rate:>9.0f}")
+
+    shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
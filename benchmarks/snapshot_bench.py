@@ -0,0 +1,67 @@
+"""
+Master time of a copy on write snapshot of a directory tree, against an in-process Master.
+The tree holds --dirs directories of --files files of --chunks chunks each, its chunk
+metadata is filled in directly. The snapshot only copies the inodes and references
+the chunks of the source, so it takes time in the number of files and chunks, not
+in the number of bytes. Bytes are reported assuming full 64 MB chunks.
+"""
+import argparse
+import logging
+import os
+import shutil
+
+from common import load_script, temp_dir, Timer
+
+from commons.loggers import default_logger, request_logger
+from commons.oplog import OplogWriter
+
+GFS_CHUNK_SIZE = 64 * 2 ** 20
+
+
+def build(m, dirs, files, chunks):
+    ns, cm = m.namespace_manager, m.chunk_manager
+    locations = ['http://cs1', 'http://cs2', 'http://cs3']
+    ns.insert_path('/data', True)
+    for d in range(dirs):
+        ns.insert_path(f'/data/d{d}', True)
+        for f in range(files):
+            file_id = ns.insert_path(f'/data/d{d}/f{f}', False)
+            for chunk_index in range(chunks):
+                cm.table.add(cm.chunk_handle, file_id, chunk_index, locations)
+                cm.chunk_handle += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dirs', type=int, default=100)
+    parser.add_argument('--files', type=int, default=100, help="files per directory")
+    parser.add_argument('--chunks', type=int, default=16, help="chunks per file")
+    parser.add_argument('--snapshots', type=int, default=3, help="successive snapshots of the same tree")
+    args = parser.parse_args()
+
+    default_logger.setLevel(logging.WARNING)
+    request_logger.setLevel(logging.WARNING)
+    master_cls = load_script('master.py')['Master']
+
+    work_dir = temp_dir('snapshot_bench')
+    m = master_cls('http://bench', os.path.join(work_dir, 'oplog.bin'), os.path.join(work_dir, 'checkpoint.bin'))
+    m.oplog = OplogWriter(m.metadata_file)
+    build(m, args.dirs, args.files, args.chunks)
+
+    files = args.dirs * args.files
+    chunks = files * args.chunks
+    print(f"tree: {files} files, {chunks} chunks, {chunks * GFS_CHUNK_SIZE / 2 ** 40:.1f} TB at 64 MB per chunk")
+    print(f"{'snapshot':>9} {'ms':>9} {'us/file':>8} {'shared chunks':>14}")
+    for i in range(args.snapshots):
+        with Timer() as timer:
+            res, err = m.snapshot('/data', f'/snap{i}')
+        assert not err, err
+        shared = len(m.chunk_manager.table.shared)
+        print(f"{i:>9} {timer.elapsed * 1e3:>9.1f} {timer.elapsed / files * 1e6:>8.2f} {shared:>14}")
+
+    m.oplog.close()
+    shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
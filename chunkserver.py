@@ -1,23 +1,47 @@
 import os
+import shutil
 import threading
-from typing import Dict, List
-from xmlrpc.server import SimpleXMLRPCServer
+import time
+import xmlrpc.client
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Set
 
 from commons.datastructures import ChunkInfo
-from commons.errors import FileNotFoundErr
+from commons.checksums import ChunkChecksums, Scrubber
+from commons.chunk_locks import ChunkLocks
+from commons.chunk_reporter import ChunkReporter
+from commons.data_channel import DataChannel, start_data_server
+from commons.errors import FileNotFoundErr, ChunkHandleNotFoundErr, ChecksumMismatchErr, ChunkIsSharedErr, \
+    MutationNotReadyErr
+from commons.file_cache import FileCache
 from commons.loggers import request_logger
-from commons.metadata_manager import load_metadata, OplogActions, update_metadata
-from commons.settings import DEFAULT_MASTER_ADDR, DEFAULT_IP, CHUNK_SIZE
+from commons.metadata_manager import load_metadata, OplogActions
+from commons.mutation_order import MutationOrder
+from commons.oplog import OplogWriter
+from commons.rpc_server import make_rpc_server
+from commons.settings import DEFAULT_MASTER_ADDR, DEFAULT_IP, CHUNK_SIZE, RPC_WORKERS, RPC_QUEUE_SIZE, \
+    HEARTBEAT_INTERVAL, ORPHAN_SCAN_INTERVAL, CHUNK_FILE_CACHE_SIZE, STAGING_CAPACITY, STAGING_TTL, \
+    CHECKSUM_BLOCK_SIZE, SCRUB_INTERVAL, SCRUB_BANDWIDTH, SCRUB_IDLE_TIME, SECONDARY_TIMEOUT, FANOUT_WORKERS, \
+    MUTATION_ORDER_TIMEOUT, MUTATION_ORDER_WAITERS, MUTATION_RETRY_DELAY, CHUNK_REPORT_INTERVAL, CHUNK_REPORT_BATCH, \
+    CHUNK_REPORT_TIMEOUT
+from commons.staging_buffer import StagingBuffer
+from commons.stats import InstrumentedLock
 from commons.utils import rpc_call, ensure_dir
 
 
 class ChunkServer:
     chunks: Dict[int, ChunkInfo]
-    pending_extensions: List[int]
-    data: Dict[str, List[bytes]]
-
-    __slots__ = 'my_addr', 'master_addr', 'metadata_file', 'path', 'chunks', 'mutex', \
-                'pending_extensions', 'pendingextensions_lock', 'data', 'data_mutex'
+    pending_extensions: Set[int]
+    changed_chunks: Set[int]
+    deleted_chunks: Set[int]
+    corrupt_chunks: Set[int]
+    shared_chunks: Set[int]
+    data: StagingBuffer
+
+    __slots__ = 'my_addr', 'master_addr', 'metadata_file', 'oplog', 'path', 'files', 'checksums', 'scrubber', \
+                'data_channel', 'chunks', 'mutex', 'chunk_locks', 'mutation_order', 'fanout', 'reporter', \
+                'pending_extensions', 'pendingextensions_lock', 'data', 'bytes_written', \
+                'changed_chunks', 'deleted_chunks', 'corrupt_chunks', 'shared_chunks'
 
     def __init__(self, my_addr, master_addr, path, metadata_file):
         self.my_addr = my_addr
@@ -25,28 +49,94 @@ class ChunkServer:
 
         # Filename of a file that contains chunkserver's meta data
         self.metadata_file = metadata_file
+        self.oplog = None  # opened once the existing metadata has been loaded
         self.path = path
+        # open chunk files
+        self.files = FileCache(path, CHUNK_FILE_CACHE_SIZE)
+        # chunk files are written and read through their block checksums
+        self.checksums = ChunkChecksums(self.files, CHECKSUM_BLOCK_SIZE)
+        self.scrubber = Scrubber(self.checksums, self.get_chunk_handles, self.report_corrupt_chunk,
+                                 SCRUB_INTERVAL, SCRUB_BANDWIDTH, SCRUB_IDLE_TIME)
+        # copies from peers
+        self.data_channel = DataChannel()
         # Store a mapping from handle to information.
         self.chunks = {}
-        self.mutex = threading.Lock()
+        # protects chunks and the sets below, held briefly (no disk or network I/O)
+        self.mutex = InstrumentedLock()
+        # mutations of a chunk are applied one at a time, in arrival order, those of
+        # different chunks in parallel
+        self.chunk_locks = ChunkLocks()
+        # mutations of a chunk reach the secondaries concurrently, they apply them in the primary's order
+        self.mutation_order = MutationOrder(MUTATION_ORDER_TIMEOUT, MUTATION_ORDER_WAITERS)
+        self.fanout = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='fanout')
+        # lengths of grown chunks, sent to the master in batches
+        self.reporter = ChunkReporter(lambda reports: report_chunks(self, reports), CHUNK_REPORT_INTERVAL,
+                                      CHUNK_REPORT_BATCH, HEARTBEAT_INTERVAL)
+        # bytes written to chunks since the last heartbeat (write load)
+        self.bytes_written = 0
+        # chunks created, grown or deleted since the last heartbeat (incremental chunk report)
+        self.changed_chunks = set()
+        self.deleted_chunks = set()
+        # replicas found corrupt since the last heartbeat, the master has them copied again
+        self.corrupt_chunks = set()
+        # chunks shared with snapshots, they are copied (see copy_chunk) instead of being mutated
+        self.shared_chunks = set()
+        # chunks this server mutated as primary, it asks the master to extend their leases
+        self.pending_extensions = set()
+        self.pendingextensions_lock = threading.Lock()
 
         # Stores client's data in memory before commit to disk.
-        self.data = {}
-        self.data_mutex = threading.Lock()
+        self.data = StagingBuffer(STAGING_CAPACITY, STAGING_TTL)
 
     # PushData handles client RPC to store data in memory.
     # Data is identifwrite_helperied with a mapping from DataId:[ClientID, Timestamp] -> Data.
-    def push_data(self, client_id, timestamp, data):
-        log.debug("me=%s: client_id=%s, timestamp=%s, data=%s", self.my_addr, client_id, timestamp, data)
-        with self.data_mutex:
-            key = f'{client_id}|{timestamp}'
-            value = self.data.get(key, None)
-
-            # if data already exists
-            if value:
-                return
-            # else
-            self.data[key] = data.data
+    # The data is forwarded to the chunk servers of chain, one after another, the reply
+    # comes once all of them hold it. The data channel (commons/data_channel.py) pipelines
+    # the same push and calls put_data with the raw bytes.
+    def push_data(self, client_id, timestamp, data, chain=()):
+        log.debug("me=%s: client_id=%s, timestamp=%s, %d bytes", self.my_addr, client_id, timestamp, len(data.data))
+        err = self.put_data(client_id, timestamp, data.data)
+        if err or not chain:
+            return err
+        try:
+            return self.data_channel.push_data(chain[0], client_id, timestamp, data.data, chain[1:])
+        except OSError as e:
+            log.warning("Data channel of %s unreachable, forwarding through RPC: %s", chain[0], e)
+            return rpc_call(chain[0]).push_data(client_id, timestamp, data, chain[1:])
+
+    # Returns StagingBufferFullErr if there is no room for data, reserved tells that room
+    # was reserved with data.reserve before receiving it.
+    def put_data(self, client_id, timestamp, data, reserved=False):
+        key = f'{client_id}|{timestamp}'
+        # if data already exists it is kept
+        return self.data.put(key, data, reserved)
+
+    def get_data(self, key):
+        return self.data.get(key)
+
+    def pop_data(self, key):
+        return self.data.pop(key)
+
+    def get_staging_status(self):
+        """
+        RPC: occupancy of the buffer of pushed data waiting to be written.
+        :return: {entries, bytes, capacity, max_bytes, rejected, expired}
+        """
+        return self.data.status()
+
+    def get_chunk_lock_status(self):
+        """
+        RPC: mutations holding or waiting for the lock of their chunk.
+        :return: {chunks, queued, waits, max_queued}
+        """
+        return self.chunk_locks.status()
+
+    def get_chunk_report_status(self):
+        """
+        RPC: reports of grown chunks waiting to be sent to the master, and batches sent.
+        :return: {pending, reports, batches, failures}
+        """
+        return self.reporter.status()
 
     # Write handles client RPC write requests to the primary chunk. The primary
     # first applies requested write to its local storage, serializes and records
@@ -54,105 +144,185 @@ class ChunkServer:
     # requests to secondary replicas.
     def write(self, client_id, timestamp, path, chunk_index, chunk_handle, offset, chunk_locations):
         log.debug("ChunkServer addr: %s", self.my_addr)
-        with self.mutex:
+        with self.chunk_locks.lock(chunk_handle):
             log.debug("ChunkServer: Write RPC. Lock Acquired")
+            if self.is_shared(chunk_handle):
+                return ChunkIsSharedErr
             # Extract/define arguments.
             key = f'{client_id}|{timestamp}'
-            data = self.data.get(key, None)
+            data = self.get_data(key)
             if not data:
                 log.debug("ChunkServer: Write RPC. Lock Released.")
                 return "ChunkServer.Write: requested data is not in memory"
             length = len(data)
-            filename = f"{chunk_handle}"
 
             # Apply write request to local state.
-            err = self.apply_write(filename, data, offset)
+            err = self.apply_write(chunk_handle, data, offset)
             if err:
                 log.debug("ChunkServer: Write RPC. Lock Released.")
                 return err
             else:
-                del self.data[key]
+                self.pop_data(key)
 
             #   // Update chunkserver metadata.
-            self.report_chunk_info(chunk_handle, chunk_index, path, length, offset)
-
-        # Apply the write to all secondary replicas.
-        # lock automatically release outside context
-        err = self.apply_to_secondary(client_id, timestamp, path, chunk_index, chunk_handle, offset, chunk_locations)
+            new = self.report_chunk_info(chunk_handle, chunk_index, path, length, offset)
+            # Apply the write to all secondary replicas, numbered and sent in the order of
+            # application here.
+            serial = self.mutation_order.assign(chunk_handle)
+            results = self.apply_to_secondary(client_id, timestamp, path, chunk_index, chunk_handle, offset,
+                                              chunk_locations, serial)
+
+        # lock automatically release outside context, the next mutations of the chunk
+        # are sent meanwhile and applied after this one by the secondaries
+        err = self.wait_for_secondary(chunk_handle, serial, results)
         if err:
             log.debug("ChunkServer: Write RPC. Lock Released.")
             return err
 
+        #   // Since we are still writing to the chunk, we must continue request
+        #   // lease extensions on the chunk.
+        self.request_lease_extension(chunk_handle)
+        if new:
+            self.flush_new_chunk(chunk_handle)
+        return None
+
+    def is_shared(self, chunk_handle):
         with self.mutex:
-            #   // Since we are still writing to the chunk, we must continue request
-            #   // lease extensions on the chunk.
-            # TODO: probably need to request for chunk lease extension
-            log.debug("ChunkServer: Write RPC. Lock Released.")
-            return None
+            return chunk_handle in self.shared_chunks
+
+    def set_shared(self, chunk_handles, shared):
+        """
+        RPC called by master when a snapshot shares chunks (they must not be mutated anymore, a
+        writer copies them first), or once a chunk is referenced by a single file again.
+        Mutations of the chunks that are being applied complete first.
+        """
+        for chunk_handle in chunk_handles:
+            with self.chunk_locks.lock(chunk_handle):
+                with self.mutex:
+                    if shared:
+                        self.shared_chunks.add(chunk_handle)
+                    else:
+                        self.shared_chunks.discard(chunk_handle)
 
     # // applyWrite is a helper function for Write and SerializedWrite to apply
     # // writes from memory to local storage.
-    # // Note: ChunkServer.mutex must be held before calling this function.
-    def apply_write(self, filename, data, offset):
-        # Open file that stores the chunk.
-        # FIXME: possible bug, 'w' will truncate existing file
+    # // Note: the lock of the chunk (chunk_locks) must be held before calling this function.
+    # // truncate drops whatever followed the data in the chunk file.
+    def apply_write(self, chunk_handle, data, offset, truncate=False):
+        # The chunk file is created if it does not exist, and written in place at offset.
         try:
-            with open(f'{self.path}/{filename}', 'ab') as fp:
-                # creates the file if not exists
-                pass
-
-            # open in r+ mode so that we don't truncate the existing contents and overwrite only by seeking
-            with open(f'{self.path}/{filename}', 'r+b') as fp:
-                fp.seek(offset)
-                fp.write(data)
+            self.checksums.write(chunk_handle, data, offset, truncate)
         except FileNotFoundError:
             return FileNotFoundErr
+        with self.mutex:
+            self.bytes_written += len(data)
 
     # // reportChunkInfo is a helper function for ChunkServer.Write,
     # // ChunkServer.SerializedWrite and ChunkServer.Append to update chunkserver's
     # // metadata after a write request.
+    # // Note: the lock of the chunk must be held, so that its oplog records are in the
+    # // order of its mutations. The master is told by the reporter, in the background.
+    # // Returns True for a chunk that was not here before (see flush_new_chunk).
     def report_chunk_info(self, chunk_handle, chunk_index, path, length, offset):
         #   // Update chunkserver metadata.
-        ok = self.chunks.get(chunk_handle, None)
+        with self.mutex:
+            ok = self.chunks.get(chunk_handle, None)
 
-        #  // If we have never seen this chunk before,
-        #  // or chunk size has changed, we should
-        #  // report to Master immediately.
+            #  // If we have never seen this chunk before,
+            #  // or chunk size has changed, we should
+            #  // report to Master (new chunks immediately).
 
-        if not ok:  # we have never seen this chunk
-            self.chunks[chunk_handle] = ChunkInfo(path, chunk_handle, chunk_index)  # length will default to zero
+            if not ok:  # we have never seen this chunk
+                self.chunks[chunk_handle] = ChunkInfo(path, chunk_handle, chunk_index)  # length will default to zero
 
-        chunk_info = self.chunks[chunk_handle]
+            chunk_info = self.chunks[chunk_handle]
 
-        if offset + length > chunk_info.length:  # chunk size has changed
+            if offset + length <= chunk_info.length:
+                return not ok
+            # chunk size has changed
             chunk_info.length = offset + length
-
-            # log to oplog
-            update_metadata(self.metadata_file, OplogActions.REPORT_CHUNK, (chunk_info.path,
-                                                                            chunk_info.chunk_handle,
-                                                                            chunk_info.chunk_index,
-                                                                            chunk_info.length))
-            report_chunk(self, chunk_info)
+            self.changed_chunks.add(chunk_handle)
+            self.deleted_chunks.discard(chunk_handle)
+
+        # log to oplog
+        self.oplog.append(OplogActions.REPORT_CHUNK, (chunk_info.path,
+                                                      chunk_info.chunk_handle,
+                                                      chunk_info.chunk_index,
+                                                      offset + length))
+        # coalesced with the next reports of the chunk, new chunks are reported at once
+        self.reporter.report(chunk_handle, chunk_info.chunk_index, offset + length, new=not ok)
+        return not ok
+
+    def flush_new_chunk(self, chunk_handle):
+        """
+        Called by the primary once the first mutation of a chunk is applied everywhere, before it
+        replies: the master then counts the chunk in the length of its file, which clients read
+        to find the last chunk of a file. Lengths within a chunk reach the master later.
+        """
+        if not self.reporter.flush():
+            # sent again in the background, the mutation is applied anyway
+            log.warning("The master does not know the length of new chunk %d yet", chunk_handle)
 
     # // apply_to_secondary is used by the primary replica to apply any modifications
     # // that are serialized by the replica, to all of its secondary replicas.
-    def apply_to_secondary(self, client_id, timestamp, path, chunk_index, chunk_handle, offset, chunk_locations):
-        #   // RPC each secondary chunkserver to apply the write.
-        for address in chunk_locations:
-            if address != self.my_addr:
-                cs = rpc_call(address)
-                err = cs.serialized_write(client_id, timestamp, path, chunk_index, chunk_handle, offset,
-                                          chunk_locations, False)
-                if err:
-                    return err
-        return None
+    # // Assumes the lock of the chunk is acquired, so that the fan-out threads send the mutations of a
+    # // chunk in the order of their serials (a mutation queued behind its successors
+    # // would hold them up at the secondaries).
+    def apply_to_secondary(self, client_id, timestamp, path, chunk_index, chunk_handle, offset, chunk_locations,
+                           serial):
+        #   // RPC all secondary chunkservers at once to apply the write, so that it takes as
+        #   // long as the slowest of them. Returns the pending results, see wait_for_secondary.
+        return [self.fanout.submit(self.serialized_write_helper, address, client_id, timestamp, path, chunk_index,
+                                   chunk_handle, offset, chunk_locations, serial)
+                for address in chunk_locations if address != self.my_addr]
+
+    def wait_for_secondary(self, chunk_handle, serial, results):
+        """Returns the first error of the secondaries, once all of them replied."""
+        errors = [result.result() for result in results]
+        self.mutation_order.completed(chunk_handle, serial)
+        return next((err for err in errors if err), None)
+
+    # // A mutation that reached a secondary before its predecessors, while it could not
+    # // hold it back, is sent again after a while (the fan-out thread waits, not the secondary).
+    def serialized_write_helper(self, address, client_id, timestamp, path, chunk_index, chunk_handle, offset,
+                                chunk_locations, serial):
+        deadline = time.monotonic() + SECONDARY_TIMEOUT
+        while True:
+            try:
+                err = rpc_call(address, SECONDARY_TIMEOUT).serialized_write(client_id, timestamp, path, chunk_index,
+                                                                            chunk_handle, offset, chunk_locations,
+                                                                            False, serial)
+            except (OSError, xmlrpc.client.Error) as e:
+                log.warning("Secondary %s failed to apply a mutation of chunk %s: %s", address, chunk_handle, e)
+                return f"Secondary {address} failed to apply the mutation: {e}"
+            if err != MutationNotReadyErr or time.monotonic() + MUTATION_RETRY_DELAY > deadline:
+                return err
+            time.sleep(MUTATION_RETRY_DELAY)
 
     # // serialized_write handles RPC calls from primary replica's write requests to
     # // secondary replicas.
+    # // serial is the [epoch, number, base] given by the primary (see MutationOrder), the
+    # // mutations of a chunk are applied in its order, None applies at once.
     def serialized_write(self, client_id, timestamp, path, chunk_index, chunk_handle, offset, chunk_locations,
-                         append_mode):
+                         append_mode, serial=None):
         log.debug(self.my_addr)
-        with self.mutex:
+        if serial is None:
+            return self.serialized_write_locked_helper(client_id, timestamp, path, chunk_index, chunk_handle, offset,
+                                                       append_mode)
+        err = self.mutation_order.wait_turn(chunk_handle, serial)
+        if err:
+            return err
+        try:
+            return self.serialized_write_locked_helper(client_id, timestamp, path, chunk_index, chunk_handle, offset,
+                                                       append_mode)
+        finally:
+            self.mutation_order.done(chunk_handle, serial)
+
+    def serialized_write_locked_helper(self, client_id, timestamp, path, chunk_index, chunk_handle, offset,
+                                       append_mode):
+        with self.chunk_locks.lock(chunk_handle):
+            if self.is_shared(chunk_handle):
+                return ChunkIsSharedErr
             key = f'{client_id}|{timestamp}'
             data = None
             if append_mode:
@@ -163,17 +333,16 @@ class ChunkServer:
                 pass
             else:
                 # // Fetch data from chunk_server.data
-                data = self.data.get(key)
+                data = self.get_data(key)
                 if not data:
                     return "ChunkServer.SerializedWrite: requested data is not in memory"
 
             #   // Apply write reqeust to local state.
-            filename = f'{chunk_handle}'
-            err = self.apply_write(filename, data, offset)
+            err = self.apply_write(chunk_handle, data, offset)
             if err:
                 return err
             elif not append_mode:
-                del self.data[key]
+                self.pop_data(key)
 
             #   // Update chunkserver metadata.
             length = len(data)
@@ -183,17 +352,30 @@ class ChunkServer:
 
     # read content from specific chunk
     def read(self, chunk_handle, offset, length):
-        """Called by client to read data from specific chunk"""
+        """Called by client to read data from specific chunk, the blocks read are verified against their checksums"""
         # open file to read data
         log.debug("CHUNK SERVER READ CALLED")
         try:
-            with open(f'{self.path}/{chunk_handle}', 'rb') as file:
-                file.seek(int(offset))  # goes to specific offset in a chunk
-                filecontent = file.read(length)  # read all required content in filecontent
-                log.debug("FileContent %s", filecontent)
-                return filecontent, None
+            filecontent, err = self.checksums.read(chunk_handle, int(offset), length)
         except Exception as err:
-            return None, err
+            return None, str(err)
+        if err == ChecksumMismatchErr:
+            self.report_corrupt_chunk(chunk_handle)
+        return filecontent, err
+
+    def report_corrupt_chunk(self, chunk_handle):
+        """Reports a corrupt replica to the master with the next heartbeat, it is deleted and copied again."""
+        with self.mutex:
+            if chunk_handle in self.chunks:
+                log.error("Chunk %d is corrupt", chunk_handle)
+                self.corrupt_chunks.add(chunk_handle)
+
+    def get_scrub_status(self):
+        """
+        RPC: progress of the background verification of the chunks.
+        :return: {passes, chunks_verified, bytes_verified, corrupt_found}
+        """
+        return self.scrubber.status()
 
     # // Append accepts client append request and append the data to an offset
     # // chosen by the primary replica. It then serializes the request just like
@@ -204,19 +386,20 @@ class ChunkServer:
     # // the data is appended to.
     def append(self, client_id, timestamp, chunk_handle, chunk_index, path, chunk_locations):
         log.debug("ChunkServer addr: %s", self.my_addr)
-        with self.mutex:
+        with self.chunk_locks.lock(chunk_handle):
             log.debug("ChunkServer: Append RPC. Lock Acquired")
+            if self.is_shared(chunk_handle):
+                return ChunkIsSharedErr
             # Extract/define arguments.
             key = f'{client_id}|{timestamp}'
-            data = self.data.get(key, None)
+            data = self.get_data(key)
             if not data:
                 log.debug("ChunkServer: Append RPC. Lock Released.")
                 return "ChunkServer.Append: requested data is not in memory"
             length = len(data)
-            filename = f"{chunk_handle}"
 
             # Get length of the current chunk so we can calculate an offset.
-            chunk_info = self.chunks[chunk_handle]
+            chunk_info = self.chunks.get(chunk_handle, None)
             # If we cannot find chunkInfo, means this is a new chunk, therefore offset
             # should be zero, otherwise the offset should be the chunk length.
             if chunk_info is None:
@@ -232,111 +415,303 @@ class ChunkServer:
                 return "error by padding chunk"
 
             # Apply write request to local state, with chunkLength as offset.
-            err = self.apply_append(filename, data, chunk_length)
+            err = self.apply_append(chunk_handle, data, chunk_length)
             if err:
                 log.debug("ChunkServer: Append RPC. Lock Released.")
                 return "ChunkServer: Append RPC. Lock Released."
+            else:
+                self.pop_data(key)
 
             # Update chunkserver metadata.
-            self.report_chunk_info(chunk_handle, chunk_index, path, length, chunk_length)
-
-            # Apply append to all secondary replicas.
-            err = self.apply_to_secondary(client_id, timestamp, path, chunk_index, chunk_handle, chunk_length,
-                                          chunk_locations)
-            if err:
-                return "cant Apply append to all secondary replicas"
+            new = self.report_chunk_info(chunk_handle, chunk_index, path, length, chunk_length)
+            # Apply append to all secondary replicas, numbered and sent in the order of
+            # application here.
+            serial = self.mutation_order.assign(chunk_handle)
+            results = self.apply_to_secondary(client_id, timestamp, path, chunk_index, chunk_handle, chunk_length,
+                                              chunk_locations, serial)
+
+        # wait without holding the lock, so that the next appends to the chunk are
+        # pipelined behind this one
+        err = self.wait_for_secondary(chunk_handle, serial, results)
+        if err:
+            return "cant Apply append to all secondary replicas"
 
-            # TODO chunk lease extension
+        self.request_lease_extension(chunk_handle)
+        if new:
+            self.flush_new_chunk(chunk_handle)
 
-            print(chunk_length + (chunk_index * CHUNK_SIZE))
-            return chunk_length + (chunk_index * CHUNK_SIZE)
+        print(chunk_length + (chunk_index * CHUNK_SIZE))
+        return chunk_length + (chunk_index * CHUNK_SIZE)
 
-    def apply_append(self, filename, data, offset):
-        # Open file that stores the chunk.
-        # FIXME: possible bug, 'w' will truncate existing file
-        try:
-            with open(f'{self.path}/{filename}', 'ab') as fp:  # TODO: create with 0777 perm
-                fp.seek(offset)
-                fp.write(data)
-        except FileNotFoundError:
-            return FileNotFoundErr
+    def apply_append(self, chunk_handle, data, offset):
+        # offset is the length of the chunk, so this writes at the end of the chunk file
+        return self.apply_write(chunk_handle, data, offset)
 
     def order_chunk_copy_from_peer(self, peer_address, chunk_handle):
         """This RPC is called by master to order a chunkserver to copy some chunks from a peer chunk server
         so as to meet the replication goal for that chunk."""
         peer_chunk_server = rpc_call(peer_address)
         # get chunk_info from peer
-        chunk_index, path, length = peer_chunk_server.get_chunk_info_from_peer(chunk_handle)
-        # get chunk's actual data
-        data, err = peer_chunk_server.read(chunk_handle, 0, length)
+        chunk_index, path, length, shared = peer_chunk_server.get_chunk_info_from_peer(chunk_handle)
+        # get chunk's actual data, through RPC if the data channel of the peer can't be reached
+        try:
+            data, err = self.data_channel.read(peer_address, chunk_handle, 0, length)
+        except OSError as e:
+            log.warning("Data channel of %s unreachable, copying through RPC: %s", peer_address, e)
+            data, err = peer_chunk_server.read(chunk_handle, 0, length)
+            data = data.data if data else None
         if err:
             log.error(err)
             return err
 
-        # write data with that chunk_handle as filename to local filesystem
-        filename = f"{chunk_handle}"
-
-        err = self.apply_write(filename, data.data, 0)
-        if err:
-            return err
-
-        self.report_chunk_info(chunk_handle, chunk_index, path, length, 0)
+        # write data with that chunk_handle as filename to local filesystem,
+        # replacing any stale (possibly longer) replica left here
+        with self.chunk_locks.lock(chunk_handle):
+            err = self.apply_write(chunk_handle, data, 0, truncate=True)
+            if err:
+                return err
+            with self.mutex:
+                self.corrupt_chunks.discard(chunk_handle)  # replaced by a good copy
+                if shared:
+                    self.shared_chunks.add(chunk_handle)
+
+            self.report_chunk_info(chunk_handle, chunk_index, path, length, 0)
+
+    def copy_chunk(self, chunk_handle, copy_handle, path):
+        """
+        RPC called by master to copy a chunk shared with a snapshot, locally, before it is
+        written (copy on write). The copy is a new chunk of file path.
+        """
+        with self.mutex:
+            chunk_info = self.chunks.get(chunk_handle, None)
+            if not chunk_info:
+                return ChunkHandleNotFoundErr
+
+        # shared chunks are not written, so the copy does not need their lock
+        with self.chunk_locks.lock(copy_handle):
+            try:
+                self.checksums.copy(chunk_handle, copy_handle)
+            except OSError as err:
+                return str(err)
+
+            with self.mutex:
+                self.chunks[copy_handle] = ChunkInfo(path, copy_handle, chunk_info.chunk_index, chunk_info.length)
+                self.changed_chunks.add(copy_handle)
+                self.deleted_chunks.discard(copy_handle)
+            self.oplog.append(OplogActions.REPORT_CHUNK, (path, copy_handle, chunk_info.chunk_index,
+                                                          chunk_info.length))
+        return None
 
     def get_chunk_info_from_peer(self, chunk_handle):
         """Called by a chunkserver for another chunkserver to get a chunk's data"""
-        chunk_info = self.chunks.get(chunk_handle, None)
-        return chunk_info.chunk_index, chunk_info.path, chunk_info.length
+        with self.mutex:
+            chunk_info = self.chunks.get(chunk_handle, None)
+            return chunk_info.chunk_index, chunk_info.path, chunk_info.length, chunk_handle in self.shared_chunks
 
     # delete bad chunk
     def delete_bad_chunk(self, bad_chunk):
+        """Deletes the given chunks, deletions are acknowledged to the master with the next heartbeat."""
         for chunk in bad_chunk:
-            if chunk in self.chunks.keys():
-                if os.path.exists(f'{self.path}/{chunk}'):
+            with self.chunk_locks.lock(chunk):
+                with self.mutex:
+                    found = self.chunks.pop(chunk, None) is not None
+                    # also acknowledge chunks that were never here
+                    self.changed_chunks.discard(chunk)
+                    self.corrupt_chunks.discard(chunk)
+                    self.shared_chunks.discard(chunk)
+                    self.deleted_chunks.add(chunk)
+                if found:
                     log.info("Deleting Chunk with chunk handle %s", chunk)
-                    os.remove(f'{self.path}/{chunk}')
-                    del self.chunks[chunk]
-                    update_metadata(self.metadata_file, OplogActions.DEL_BAD_CHUNK, chunk)
-                else:
-                    log.error("Unable to delete chunk %s", chunk)
-                    return False
+                    self.checksums.remove(chunk)
+                    self.mutation_order.forget(chunk)
+                    try:
+                        os.remove(f'{self.path}/{chunk}')
+                    except FileNotFoundError:
+                        log.error("Chunk file of %s is already gone", chunk)
+                    self.oplog.append(OplogActions.DEL_BAD_CHUNK, chunk)
 
         return True  # TODO: should we return success message to master
 
+    def reclaim_orphan_files(self):
+        """Deletes chunk files that are not in this server's metadata (eg. after a crash mid write)."""
+        # list the directory without holding any lock, files are checked again below
+        # chunk files and their checksum files (<chunk handle>.crc)
+        with os.scandir(self.path) as entries:
+            names = [entry.name[:-4] if entry.name.endswith('.crc') else entry.name for entry in entries]
+        found = {int(name) for name in names if name.isdigit()}
+        with self.mutex:
+            candidates = found - self.chunks.keys()
+        reclaimed = 0
+        for chunk_handle in candidates:
+            # the lock of the chunk keeps out a first write, whose file exists before its metadata
+            with self.chunk_locks.lock(chunk_handle):
+                with self.mutex:
+                    if chunk_handle in self.chunks:
+                        continue
+                self.checksums.remove(chunk_handle)
+                try:
+                    os.remove(f'{self.path}/{chunk_handle}')
+                    reclaimed += 1
+                except FileNotFoundError:
+                    pass
+        if reclaimed:
+            log.info("Reclaimed %d orphaned chunk files", reclaimed)
+        return reclaimed
+
+    def request_lease_extension(self, chunk_handle):
+        """Ask for an extension of the lease on chunk_handle with the next heartbeat."""
+        with self.pendingextensions_lock:
+            self.pending_extensions.add(chunk_handle)
+
+    def heartbeat_report(self, interval):
+        """Takes the changes since the previous heartbeat, see Master.heartbeat for the format."""
+        with self.mutex:
+            chunks = [(h, self.chunks[h].chunk_index, self.chunks[h].length) for h in self.changed_chunks]
+            deleted = list(self.deleted_chunks)
+            corrupt = list(self.corrupt_chunks)
+            self.changed_chunks = set()
+            self.deleted_chunks = set()
+            self.corrupt_chunks = set()
+        with self.pendingextensions_lock:
+            lease_extensions = list(self.pending_extensions)
+            self.pending_extensions = set()
+
+        return {
+            'chunks': chunks,
+            'deleted': deleted,
+            'corrupt': corrupt,
+            'lease_extensions': lease_extensions,
+            'stats': self.collect_stats(interval),
+        }
+
+    def heartbeat_failed(self, report):
+        """Puts back the changes of a heartbeat that did not reach the master."""
+        with self.mutex:
+            for chunk_handle, _, _ in report['chunks']:
+                if chunk_handle in self.chunks and chunk_handle not in self.deleted_chunks:
+                    self.changed_chunks.add(chunk_handle)
+            for chunk_handle in report['deleted']:
+                if chunk_handle not in self.chunks:
+                    self.deleted_chunks.add(chunk_handle)
+            self.corrupt_chunks.update(h for h in report['corrupt'] if h in self.chunks)
+        with self.pendingextensions_lock:
+            self.pending_extensions.update(report['lease_extensions'])
+
     def get_chunk_handles(self):
         """RPC called by master to get list of chunk handles in this server."""
-        return list(self.chunks.keys())
-
-
-def report_chunk(cs, chunk_info):
-    ms = rpc_call(cs.master_addr)
-
-    # TODO: receive returned error if any
-    ms.report_chunk(cs.my_addr, chunk_info.chunk_handle, chunk_info.chunk_index, chunk_info.length, chunk_info.path)
+        with self.mutex:
+            return list(self.chunks.keys())
 
+    def get_chunk_report(self):
+        """RPC called by shadow masters to get [chunk handle, chunk index, length] of every chunk in this server."""
+        with self.mutex:
+            return [[info.chunk_handle, info.chunk_index, info.length] for info in self.chunks.values()]
 
-def start_chunkserver(master_addr, my_ip, my_port, path):
+    def collect_stats(self, interval):
+        """Load statistics used by the master to place new chunks, write load is averaged over interval."""
+        usage = shutil.disk_usage(self.path)
+        with self.mutex:
+            written, self.bytes_written = self.bytes_written, 0
+            chunk_count = len(self.chunks)
+
+        # disk sizes are sent as floats since they overflow XML-RPC's 32 bit integers
+        return {
+            'disk_total': float(usage.total),
+            'disk_used': float(usage.used),
+            'chunk_count': chunk_count,
+            'write_load': written / interval,
+        }
+
+
+def report_chunks(cs, reports):
+    """Sends a batch of [chunk handle, chunk index, length] of grown chunks to the master."""
+    ms = rpc_call(cs.master_addr, CHUNK_REPORT_TIMEOUT)
+
+    # unknown chunks are reported again with the next heartbeat, the master deletes them then
+    ms.report_chunks(cs.my_addr, reports)
+
+
+def register(cs):
+    """Tell master about the presence of this chunk server and the chunks present here."""
+    with cs.mutex:
+        chunk_handles = list(cs.chunks.keys())
+        # lengths are only sent in chunk reports, so report every chunk with the next heartbeat
+        cs.changed_chunks.update(chunk_handles)
+    shared = rpc_call(cs.master_addr).notify_master(cs.my_addr, chunk_handles)
+    with cs.mutex:
+        # not persisted here, the master knows which chunks are shared
+        cs.shared_chunks = set(shared)
+
+
+def start_heartbeat(cs, interval):
+    """Periodically send heartbeats to the master in a background thread."""
+    def heartbeat_loop():
+        next_orphan_scan = time.time() + ORPHAN_SCAN_INTERVAL
+        while True:
+            time.sleep(interval)
+            if time.time() >= next_orphan_scan:
+                # lazily, the disk is not scanned on every heartbeat
+                next_orphan_scan = time.time() + ORPHAN_SCAN_INTERVAL
+                try:
+                    cs.reclaim_orphan_files()
+                except OSError as err:
+                    log.error("Unable to reclaim orphaned chunk files: %s", err)
+
+            # drop pushed data whose write never came, even if nothing is pushed anymore
+            cs.data.expire()
+
+            report = cs.heartbeat_report(interval)
+            try:
+                reply = rpc_call(cs.master_addr).heartbeat(cs.my_addr, report)
+            except (OSError, xmlrpc.client.Error) as err:
+                # a fault of the master, or a master restarting, must not stop the heartbeats
+                log.error("Unable to send heartbeat to master: %s", err)
+                cs.heartbeat_failed(report)
+                continue
+
+            if not reply['registered']:
+                # declared dead by, or unknown to a restarted master
+                log.info("Master does not know this chunk server, registering again")
+                try:
+                    register(cs)
+                except (OSError, xmlrpc.client.Error) as err:
+                    log.error("Unable to register with master: %s", err)
+                continue
+
+            if reply['delete']:
+                cs.delete_bad_chunk(reply['delete'])
+            for chunk_handle, expiration in reply['leases']:
+                log.debug("Lease on chunk %d extended until %s", chunk_handle, expiration)
+
+    bg_thread = threading.Thread(target=heartbeat_loop, args=(), daemon=True)
+    bg_thread.start()
+
+
+def start_chunkserver(master_addr, my_ip, my_port, path, workers, queue_size):
     ensure_dir(path)  # make sure this path exists
 
     my_address = f'http://{my_ip}:{my_port}'
-    metadata_filename = f'logs/ck_{my_port}.txt'
+    metadata_filename = f'logs/ck_{my_port}.bin'
 
     cs = ChunkServer(my_address, master_addr, path, metadata_filename)
 
     # Load metadata
     load_metadata(cs)
+    cs.oplog = OplogWriter(cs.metadata_file)
 
     # tell master about the presence of this chunk server
     # and also send the list of chunks present here
     # must do this after loading from oplog
-    ms = rpc_call(cs.master_addr)
-    ms.notify_master(cs.my_addr, list(cs.chunks.keys()))
+    register(cs)
 
-    chunk_server = SimpleXMLRPCServer((my_ip, my_port),
-                                      logRequests=True,
-                                      allow_none=True)
+    start_heartbeat(cs, HEARTBEAT_INTERVAL)
+    cs.scrubber.start()
+    cs.reporter.start()
 
-    chunk_server.register_introspection_functions()
-    chunk_server.register_instance(cs)
+    chunk_server = make_rpc_server(my_ip, my_port, cs, workers, queue_size,
+                                   {'ChunkServer.mutex': cs.mutex, 'ChunkServer.data_mutex': cs.data.mutex})
+    # chunk data travels over the data channel, its requests show in the RPC stats
+    start_data_server(my_ip, my_port, cs, chunk_server.rpc_stats)
     chunk_server.serve_forever()
 
     # TODO: launch heart beat on separate thread
@@ -352,6 +727,10 @@ if __name__ == '__main__':
     parser.add_argument('--port', type=int, required=True)
     parser.add_argument('--master', default=DEFAULT_MASTER_ADDR, help="http://<ip address>:<port>")
     parser.add_argument('--path', help="Defaults to temp/ck<PORT>")
+    parser.add_argument('--workers', type=int, default=RPC_WORKERS, help="number of threads serving RPCs")
+    parser.add_argument('--queue-size', type=int, default=RPC_QUEUE_SIZE,
+                        help="number of RPCs that may wait for a free worker before backpressure kicks in")
     args = parser.parse_args()
 
-    start_chunkserver(args.master, args.ip, args.port, args.path or f"temp/ck{args.port}")
+    start_chunkserver(args.master, args.ip, args.port, args.path or f"temp/ck{args.port}",
+                      args.workers, args.queue_size)
@@ -1,10 +1,13 @@
 import random
 import time
 import xmlrpc.client
+from commons.data_channel import DataChannel
 from commons.datastructures import DataId
-from commons.errors import ChunkAlreadyExistsErr
+from commons.errors import ChunkAlreadyExistsErr, ChunkIsSharedErr, StagingBufferFullErr, MasterPollingErr, \
+    NoChunkServerAliveErr
 from commons.loggers import default_logger
-from commons.settings import DEFAULT_MASTER_ADDR, CHUNK_SIZE, REPLICATION_FACTOR, APPEND_SIZE
+from commons.settings import DEFAULT_MASTER_ADDR, CHUNK_SIZE, REPLICATION_FACTOR, APPEND_SIZE, LIST_PAGE_SIZE, \
+    MAX_LOCATIONS_BATCH, SHADOW_TIMEOUT, PUSH_RETRIES, PUSH_RETRY_DELAY, POLL_TIMEOUT, POLL_RETRY_DELAY
 from commons.utils import rpc_call
 # data structure for client
 from master.chunk_manager import ChunkInfo
@@ -12,10 +15,12 @@ from master.chunk_manager import ChunkInfo
 
 class Client:
     # Read: https://docs.python.org/3/reference/datamodel.html#slots
-    __slots__ = 'client_id', 'master_addr', 'location_cache', 'lease_holder_cache'
+    __slots__ = 'client_id', 'master_addr', 'shadow_addrs', 'location_cache', 'lease_holder_cache', \
+                'data_channel'
 
-    def __init__(self, master_addr):
+    def __init__(self, master_addr, shadow_addrs=None):
         self.master_addr = master_addr
+        self.shadow_addrs = shadow_addrs or []  # read only shadow masters, for lookups
 
         master_server = rpc_call(self.master_addr)
         # call master to get a unique client id
@@ -23,9 +28,38 @@ class Client:
 
         self.location_cache = {}  # TODO: implement cache with timeout. need some kind of expiring dict
         self.lease_holder_cache = {}  # TODO: implement cache with timeout
+        self.data_channel = DataChannel()  # chunk data goes over the chunk servers' data channels
 
     def __repr__(self):
-        return f'Client(client_id={self.client_id!r}, master_addr={self.master_addr!r})'
+        return f'Client(client_id={self.client_id!r}, master_addr={self.master_addr!r}, ' \
+               f'shadow_addrs={self.shadow_addrs!r})'
+
+    # Calls a read only metadata RPC on a random shadow master, falling back to the
+    # master if there is none, it is unreachable or it reports an error (eg. lagging
+    # behind the master, or a file too recent for it to know about).
+    def lookup(self, method, *args):
+        if self.shadow_addrs:
+            shadow = random.choice(self.shadow_addrs)
+            try:
+                result = getattr(rpc_call(shadow, SHADOW_TIMEOUT), method)(*args)
+                if not result[-1]:
+                    return result
+                log.debug("Shadow master %s failed %s: %s", shadow, method, result[-1])
+            except (OSError, xmlrpc.client.Error) as err:
+                log.debug("Shadow master %s unreachable: %s", shadow, err)
+
+        return getattr(rpc_call(self.master_addr), method)(*args)
+
+    # Calls an RPC of the master that leases or adds chunks, asking again while the master
+    # refuses it as it is still polling the chunk servers after a restart.
+    def call_master(self, method, *args):
+        deadline = time.monotonic() + POLL_TIMEOUT
+        while True:
+            result = getattr(rpc_call(self.master_addr), method)(*args)
+            if result[-1] != MasterPollingErr or time.monotonic() + POLL_RETRY_DELAY > deadline:
+                return result
+            log.info("Master is polling the chunk servers, retrying %s in %.1fs", method, POLL_RETRY_DELAY)
+            time.sleep(POLL_RETRY_DELAY)
 
     # create a file
     def create(self, path):
@@ -47,6 +81,9 @@ class Client:
 
         start_idx = 0
 
+        # fetch locations of all existing chunks in a few round trips instead of one per chunk
+        self.prefetch_chunks(path, start_chunk_idx, end_chunk_idx)
+
         for i in range(start_chunk_idx, end_chunk_idx + 1):  # +1 bcoz range end is non inclusive
             start_offset = 0
             end_offset = CHUNK_SIZE  # exclusive
@@ -82,36 +119,36 @@ class Client:
 
     # Returns True if write is successful else false
     def write_helper(self, path, chunk_index, start, end, data):
-        chunk_handle, chunk_locations, err = self.get_chunk_guaranteed(path, chunk_index)
-
-        if err:
-            return False
+        # a chunk the chunk servers refuse to write in place, as it was shared by a snapshot
+        # after its primary was cached, is copied and written again, once
+        for attempt in range(2):
+            # primary = address of primary chunk server
+            chunk_handle, chunk_locations, primary, err = self.get_writable_chunk(path, chunk_index)
 
-        data_id = DataId(self.client_id, time.time())
-
-        # Push data to all replicas' memory.
-        err = self.push_data(chunk_locations, data_id, data)
-        if err:
-            log.error('Data not pushed to all replicas.')
-            return False
+            if err:
+                log.error("Primary chunk server not found. Why? : %s", err)
+                return False
 
-        # Once data is pushed to all replicas, send write request to the primary replica.
-        # primary = address of primary chunk server
-        primary = self.find_lease_holder(chunk_handle)
+            data_id = DataId(self.client_id, time.time())
 
-        if not primary:
-            log.error("Primary chunk server not found.")
-            return False
+            # Push data to all replicas' memory.
+            err = self.push_data(chunk_locations, data_id, data)
+            if err:
+                log.error('Data not pushed to all replicas.')
+                return False
 
-        primary_cs = rpc_call(primary)
-        err = primary_cs.write(data_id.client_id, data_id.timestamp, path,
-                               chunk_index, chunk_handle, start,
-                               chunk_locations)
+            # Once data is pushed to all replicas, send write request to the primary replica.
+            primary_cs = rpc_call(primary)
+            err = primary_cs.write(data_id.client_id, data_id.timestamp, path,
+                                   chunk_index, chunk_handle, start,
+                                   chunk_locations)
 
-        if err:
-            return False
+            if err != ChunkIsSharedErr:
+                return not err
+            if self.chunk_shared(path, chunk_index, chunk_handle):
+                return False
 
-        return True
+        return False
 
     # The get_chunk_details takes in a path name and a chunkIndex and
     # guarantees to return a chunkHandle and chunkLocations.
@@ -131,6 +168,34 @@ class Client:
 
         return chunk_handle, chunk_locations, err
 
+    # Returns the chunk handle, chunk locations and primary of a chunk about to be written.
+    # A chunk shared with a snapshot is copied first, the file writes to its own copy.
+    def get_writable_chunk(self, path, chunk_index):
+        chunk_handle, chunk_locations, err = self.get_chunk_guaranteed(path, chunk_index)
+        if err:
+            return None, None, None, err
+
+        primary, err = self.find_lease_holder(chunk_handle)
+        if err == ChunkIsSharedErr:
+            chunk_handle, chunk_locations, err = self.copy_on_write(path, chunk_index)
+            if err:
+                return None, None, None, err
+            primary, err = self.find_lease_holder(chunk_handle)
+
+        if err:
+            return None, None, None, err
+
+        return chunk_handle, chunk_locations, primary, None
+
+    # Called when a chunk server refuses to mutate a chunk shared with a snapshot. The file
+    # gets its own copy of the chunk, returns errors.
+    def chunk_shared(self, path, chunk_index, chunk_handle):
+        self.lease_holder_cache.pop(f'{chunk_handle}', None)
+        _, _, err = self.copy_on_write(path, chunk_index)
+        if err:
+            log.error("Unable to copy chunk %s shared with a snapshot. Why? : %s", chunk_handle, err)
+        return err
+
     # find chunk handle and locations given filename and chunk index
     def find_chunk(self, path, chunk_index):
         key = f'{path}:{chunk_index}'
@@ -139,9 +204,8 @@ class Client:
             # cached value found
             return value.chunk_handle, value.chunk_locations, None
 
-        # else: not found in cache, get from master server
-        ms = rpc_call(self.master_addr)
-        chunk_locations, chunk_handle, err = ms.find_locations(path, chunk_index)
+        # else: not found in cache, get from a shadow or the master server
+        chunk_locations, chunk_handle, err = self.lookup('find_locations', path, chunk_index)
 
         if not err:
             # Save into location cache
@@ -151,39 +215,83 @@ class Client:
 
         return None, None, err
 
+    # Fill location_cache and lease_holder_cache for chunks start_idx..end_idx (inclusive)
+    # of a file with batched find_locations_range calls, skipping batches that are cached already.
+    def prefetch_chunks(self, path, start_idx, end_idx):
+        for batch_start in range(start_idx, end_idx + 1, MAX_LOCATIONS_BATCH):
+            count = min(MAX_LOCATIONS_BATCH, end_idx + 1 - batch_start)
+            if all(f'{path}:{i}' in self.location_cache for i in range(batch_start, batch_start + count)):
+                continue
+
+            chunks, err = self.lookup('find_locations_range', path, batch_start, count)
+            if err:
+                # eg. a new file without any chunk, chunks get added on demand
+                return
+
+            for chunk in chunks:
+                self.location_cache[f'{path}:{chunk["chunk_index"]}'] = ChunkInfo(chunk['chunk_handle'],
+                                                                                 chunk['chunk_locations'])
+                if chunk['primary']:
+                    self.lease_holder_cache[f'{chunk["chunk_handle"]}'] = {'primary': chunk['primary'],
+                                                                           'lease_ends': chunk['lease_ends']}
+
     # returns chunk_handle and chunklocations of the newly added chunk
     def add_chunk(self, path, chunk_index):
-        ms = rpc_call(self.master_addr)
-        chunk_handle, chunk_locations, err = ms.add_chunk(path, chunk_index)
+        chunk_handle, chunk_locations, err = self.call_master('add_chunk', path, chunk_index)
 
         return chunk_handle, chunk_locations, err
 
-    # find_lease_holder returns the address of current lease holder(one of the chunk servers) of the target chunk.
+    # find_lease_holder returns the address of current lease holder(one of the chunk servers) of the target chunk
+    # and errors.
     def find_lease_holder(self, chunk_handle):
         key = f'{chunk_handle}'
         value = self.lease_holder_cache.get(key)
-        if value:
-            return value['primary']
+        if value and value['lease_ends'] > time.time():
+            return value['primary'], None
 
         # If not found in cache, RPC the master server.
-        ms = rpc_call(self.master_addr)
-        primary, lease_ends, err = ms.find_lease_holder(chunk_handle)
+        primary, lease_ends, err = self.call_master('find_lease_holder', chunk_handle)
 
         if not err:
             self.lease_holder_cache[key] = {'primary': primary, 'lease_ends': lease_ends}
-            return primary
+            return primary, None
 
-        return None
+        return None, err
+
+    # Gives the file its own copy of a chunk it shares with a snapshot.
+    # Returns chunk_handle and chunk_locations of the copy.
+    def copy_on_write(self, path, chunk_index):
+        chunk_handle, chunk_locations, err = self.call_master('copy_on_write', path, chunk_index)
+
+        if not err:
+            self.location_cache[f'{path}:{chunk_index}'] = ChunkInfo(chunk_handle, chunk_locations)
+
+        return chunk_handle, chunk_locations, err
 
-    # The push_data function pushes data to all replica's memory through RPC.
+    # The push_data function pushes data to all replica's memory. It is sent once, to the
+    # first replica, which forwards it down the chain of the other replicas (pipelined
+    # over the data channels, or through RPC if a data channel can't be reached).
+    # Pushes rejected by a replica without room for them are retried with a backoff.
     def push_data(self, chunk_locations, data_id, data):
-        for srv_addr in chunk_locations:
-            cs = rpc_call(srv_addr)
-            err = cs.push_data(data_id.client_id, data_id.timestamp, data)
-            if err:
+        if isinstance(data, str):
+            data = data.encode()
+        if not chunk_locations:  # every replica of the chunk is gone
+            return NoChunkServerAliveErr
+        first, chain = chunk_locations[0], chunk_locations[1:]
+        delay = PUSH_RETRY_DELAY
+        for attempt in range(PUSH_RETRIES + 1):
+            if attempt:
+                log.info("Chunk servers are full, retrying push in %.1fs", delay)
+                time.sleep(delay)
+                delay *= 2
+            try:
+                err = self.data_channel.push_data(first, data_id.client_id, data_id.timestamp, data, chain)
+            except OSError as e:
+                log.warning("Data channel of %s unreachable, pushing through RPC: %s", first, e)
+                err = rpc_call(first).push_data(data_id.client_id, data_id.timestamp, data, chain)
+            if err != StagingBufferFullErr:
                 return err
-
-        return None
+        return err
 
     # get FileLength
     def getfilelength(self, path):
@@ -210,6 +318,7 @@ class Client:
             lastbytetoread = min(byteoffset + bytestoread, filelength)
         startchunkindex = byteoffset // CHUNK_SIZE
         endchunkindex = (lastbytetoread - 1) // CHUNK_SIZE
+        self.prefetch_chunks(path, startchunkindex, endchunkindex)
         with open(filename, "ab") as file:
             for i in range(startchunkindex, endchunkindex + 1):
                 startoffset = 0
@@ -228,22 +337,36 @@ class Client:
                     return err
                 else:
                     log.debug("ChunkData Received: %s, type %s", chunkdata, type(chunkdata))
-                    file.write(chunkdata.data)
+                    file.write(chunkdata)
         return None
 
     # read a chunk
     def read_helper(self, path, chunk_index, start, length):
-        """Call Chunkserver RPC to read chunkdata"""
+        """Reads chunkdata from the data channel of a chunk server, or through RPC if it can't be reached"""
         chunk_handle, chunk_locations, err = self.find_chunk(path, chunk_index)
         if err:
             return None, err
-        random_num = random.randint(1, min(len(chunk_locations), REPLICATION_FACTOR)) - 1  # -1 for zero based index
-        chunk_loc = chunk_locations[random_num]
+        # start with a random replica, the next ones are tried if it is corrupt or gone
+        # (the cached locations may be stale, eg. after a corrupt replica was replaced)
+        first = random.randint(1, min(len(chunk_locations), REPLICATION_FACTOR)) - 1  # -1 for zero based index
         log.debug("Chunk Handle  %s and chunk Locations %s ", chunk_handle, chunk_locations)
+        for chunk_loc in chunk_locations[first:] + chunk_locations[:first]:
+            data, err = self.read_replica_helper(chunk_loc, chunk_handle, start, length)
+            if not err:
+                return data, err
+            log.warning("Unable to read chunk %s from %s, trying another replica: %s", chunk_handle, chunk_loc, err)
+            self.location_cache.pop(f'{path}:{chunk_index}', None)
+        return data, err
+
+    def read_replica_helper(self, chunk_loc, chunk_handle, start, length):
+        try:
+            return self.data_channel.read(chunk_loc, chunk_handle, start, length)
+        except OSError as e:
+            log.warning("Data channel of %s unreachable, reading through RPC: %s", chunk_loc, e)
         chunk_server = rpc_call(chunk_loc)
         data, err = chunk_server.read(chunk_handle, start, length)
         # TODO :Handle case if server is down
-        return data, err
+        return (data.data if data else None), err
 
     # create a dir
     def create_dir(self, path):
@@ -256,14 +379,41 @@ class Client:
 
     # list all files in a directory
     def list_allfiles(self, path):
+        err = None
+        log.debug("List of files in %s:\n", path)
+        for file in self.iter_allfiles(path):
+            if isinstance(file, Exception):
+                err = file
+                break
+            log.debug("%s\n", file)
+        if err:
+            log.error("Error listing files in '%s'. Why? : %s", path, err)
+
+    # Streams the files of a directory page by page, yields an Exception instead
+    # of a path if the master reports an error.
+    def iter_allfiles(self, path, page_size=LIST_PAGE_SIZE):
+        cursor = None
+        while True:
+            files, err = self.lookup('list_allfiles', path, cursor, page_size)
+            if err:
+                yield Exception(err)
+                return
+
+            yield from files
+            if len(files) < page_size:
+                return
+            cursor = files[-1]
+
+    # copy a file or a directory tree, copy on write
+    def snapshot(self, src, dst):
         master_server = rpc_call(self.master_addr)
-        resp, err = master_server.list_allfiles(path)
+        resp, err = master_server.snapshot(src, dst)
         if resp:
-            log.debug("List of files in %s:\n", path)
-            for file in resp:
-                log.debug("%s\n", file)
+            # cached leases on the source chunks were revoked
+            self.lease_holder_cache.clear()
         else:
-            log.error("Error creating file '%s'. Why? : %s", path, err)
+            log.error("Error creating snapshot '%s' of '%s'. Why? : %s", dst, src, err)
+        return err
 
     # remove file
     def delete(self, path):
@@ -287,7 +437,8 @@ class Client:
             log.error("ERROR: Data size exceeds append limit.")
             return "size limit exceeded"
 
-        # To calculate chunkIndex we must get the length.
+        # To calculate chunkIndex we must get the length. The master may not have the latest
+        # length within the last chunk yet, but it counts that chunk (see ChunkServer.flush_new_chunk).
         filelength, err = self.getfilelength(path)
         if err:
             log.error("Error while fetching file length %s", err)
@@ -296,34 +447,36 @@ class Client:
 
         chunk_index = filelength // CHUNK_SIZE
 
-        # Get chunkHandle and chunkLocations
-        chunk_handle, chunk_locations, err = self.get_chunk_guaranteed(path, chunk_index)
-        print("APPEND :: ", chunk_handle, chunk_locations, err)
-        if err:
-            return "can't get chunk handle location"
-        
-        # Construct dataId with clientId and current timestamp.
-        data_id = DataId(self.client_id, time.time())
-
-        # Push data to all replicas' memory.
-        err = self.push_data(chunk_locations, data_id, data)
-        if err:
-            log.error('Data not pushed to all replicas.')
-            return "Data not pushed to all replicas."
+        # a chunk shared by a snapshot meanwhile is copied and appended to again, once (see write_helper)
+        for attempt in range(2):
+            # Get chunkHandle and chunkLocations
+            chunk_handle, chunk_locations, primary, err = self.get_writable_chunk(path, chunk_index)
+            print("APPEND :: ", chunk_handle, chunk_locations, err)
+            if err:
+                return "can't get chunk handle location"
 
-        # Once data is pushed to all replicas, send append request to the primary.
-        primary = self.find_lease_holder(chunk_handle)
+            # Construct dataId with clientId and current timestamp.
+            data_id = DataId(self.client_id, time.time())
 
-        if not primary:
-            log.error("Primary chunk server not found.")
-            return "Primary chunk server not found."
+            # Push data to all replicas' memory.
+            err = self.push_data(chunk_locations, data_id, data)
+            if err:
+                log.error('Data not pushed to all replicas.')
+                return "Data not pushed to all replicas."
+
+            # Once data is pushed to all replicas, send append request to the primary.
+            # Make Append call to primary chunk server
+            primary_cs = rpc_call(primary)
+            offset = primary_cs.append(data_id.client_id, data_id.timestamp,
+                                       chunk_handle, chunk_index, path,
+                                       chunk_locations)
+            print("offset = ", offset)
+            if offset != ChunkIsSharedErr:
+                return offset
+            err = self.chunk_shared(path, chunk_index, chunk_handle)
+            if err:
+                return err
 
-        # Make Append call to primary chunk server
-        primary_cs = rpc_call(primary)
-        offset = primary_cs.append(data_id.client_id, data_id.timestamp,
-                                   chunk_handle, chunk_index, path,
-                                   chunk_locations)
-        print("offset = ", offset)
         return offset
 
     def write_file(self, path, file):
@@ -342,9 +495,10 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--master', default=DEFAULT_MASTER_ADDR, help="http://<ip address>:<port>")
+    parser.add_argument('--shadows', nargs='*', default=[], help="shadow masters serving lookups")
     args = parser.parse_args()
 
-    client = Client(args.master)
+    client = Client(args.master, args.shadows)
 
     log.info("Client: %s", client)
 
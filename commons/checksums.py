@@ -0,0 +1,325 @@
+import os
+import shutil
+import threading
+import time
+import zlib
+from array import array
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List
+
+from commons.errors import ChecksumMismatchErr
+from commons.file_cache import pwrite_all
+from commons.loggers import default_logger
+from commons.locks import RWLock
+
+log = default_logger
+
+SUM_SIZE = array('I').itemsize
+
+
+class ChunkChecksums:
+    """
+    CRC32 checksums of every `block_size` bytes block of the chunk files of a chunk
+    server, so that corrupted replicas are detected instead of being served or copied.
+    The checksums of a chunk are stored next to it, in <chunk handle>.crc, and kept in
+    memory once used (4 bytes per block).
+    Writes recompute the checksums of the blocks they touch only. Reads verify the
+    blocks they touch the first time they read them, and only read the bytes asked for
+    once their blocks are verified, until they are written again. The scrubber verifies
+    all blocks anyway. Chunks that have no checksums yet (written by an older version)
+    get them computed from their current content on first use.
+    Writers hold the write lock of a chunk while they update it and its checksums,
+    readers hold its read lock so that they never see one without the other. Chunks are
+    locked separately, so that they are written in parallel.
+    """
+    sums: Dict[int, array]
+    verified: Dict[int, bytearray]
+    last_write: Dict[int, float]
+    locks: Dict[int, List]
+
+    __slots__ = 'files', 'block_size', 'sums', 'verified', 'last_write', 'mutex', 'locks'
+
+    def __init__(self, files, block_size):
+        self.files = files  # FileCache of the chunk files, also used for the checksum files
+        self.block_size = block_size
+        self.sums = {}  # chunk handle -> checksum of each block
+        self.verified = {}  # chunk handle -> 1 for each block verified since it was last written
+        self.last_write = {}  # chunk handle -> time.monotonic() of its last write
+        self.mutex = threading.Lock()  # protects the locks table only
+        # chunk handle -> [RWLock, number of users, removed], dropped once the chunk is removed and
+        # nobody holds or waits for it
+        self.locks = {}
+
+    def write(self, chunk_handle, data, offset, truncate=False):
+        """Writes data at offset of a chunk (see FileCache.write) and updates the checksums of the blocks it touched."""
+        block_size = self.block_size
+        with self.lock(chunk_handle, write=True), self.files.open(chunk_handle, create=True) as fd:
+            old_size = os.fstat(fd).st_size
+            sums = self.load_helper(chunk_handle, fd, old_size)
+
+            end = offset + len(data)
+            pwrite_all(fd, data, offset)
+            if truncate:
+                os.ftruncate(fd, end)
+                new_size = end
+            else:
+                new_size = max(old_size, end) if data else old_size
+
+            # a write past the end also changes the blocks between the old end and offset (zeros),
+            # a truncation the block the chunk now ends in. The blocks after the data are unchanged.
+            first = min(old_size, offset) // block_size
+            changed_end = new_size if truncate else min(end, new_size)
+            last = (changed_end - 1) // block_size  # -1 if the chunk is empty
+            if truncate:
+                del sums[last + 1:]
+            if first <= last:
+                start = first * block_size
+                blocks = memoryview(os.pread(fd, min((last + 1) * block_size, new_size) - start, start))
+                for block in range(first, last + 1):
+                    piece = blocks[(block - first) * block_size:(block - first + 1) * block_size]
+                    if block < len(sums):
+                        sums[block] = zlib.crc32(piece)
+                    else:
+                        sums.append(zlib.crc32(piece))
+            self.store_helper(chunk_handle, sums, first, last + 1, truncate)
+
+            verified = self.verified[chunk_handle]
+            del verified[len(sums):]
+            verified.extend(bytes(len(sums) - len(verified)))
+            verified[first:last + 1] = bytes(last + 1 - first)
+            self.last_write[chunk_handle] = time.monotonic()
+
+    def read(self, chunk_handle, offset, length):
+        """
+        Reads up to length bytes of a chunk from offset, after verifying the checksums of the
+        blocks they are in. Returns (data, err), err is ChecksumMismatchErr for a corrupted
+        block. Raises FileNotFoundError for an unknown chunk.
+        """
+        block_size = self.block_size
+        with self.lock(chunk_handle), self.files.open(chunk_handle) as fd:
+            # blocks verified already: the bytes asked for are enough (pread stops at the end)
+            first, last = offset // block_size, (offset + length - 1) // block_size
+            verified = self.verified.get(chunk_handle, b'')
+            if length > 0 and last < len(verified) and verified.find(0, first, last + 1) < 0:
+                return os.pread(fd, length, offset), None
+
+            size = os.fstat(fd).st_size
+            end = min(offset + length, size)
+            if end <= offset:
+                return b'', None
+
+            last = (end - 1) // block_size
+            sums = self.load_helper(chunk_handle, fd, size)
+            verified = self.verified[chunk_handle]
+            start = first * block_size
+            data = os.pread(fd, min((last + 1) * block_size, size) - start, start)
+            err = self.verify_helper(chunk_handle, sums, data, first, verified)
+            if err:
+                return None, err
+            # concurrent readers set the same flags, and writers are locked out
+            verified[first:last + 1] = b'\x01' * (last + 1 - first)
+            if start == offset and len(data) == end - start:
+                return data, None
+            return data[offset - start:end - start], None
+
+    def verify(self, chunk_handle, piece_size, throttle=None):
+        """
+        Verifies a whole chunk, piece_size bytes (a multiple of block_size) at a time.
+        throttle(bytes) is called after every piece, outside of the lock.
+        Returns ChecksumMismatchErr or None, a chunk deleted meanwhile is fine.
+        """
+        offset = 0
+        while True:
+            with self.lock(chunk_handle):
+                try:
+                    with self.files.open(chunk_handle) as fd:
+                        size = os.fstat(fd).st_size
+                        if offset >= size:
+                            return None
+                        data = os.pread(fd, min(piece_size, size - offset), offset)
+                        err = self.verify_helper(chunk_handle, self.load_helper(chunk_handle, fd, size), data,
+                                                 offset // self.block_size)
+                except FileNotFoundError:
+                    return None
+                verified = self.verified[chunk_handle]
+                if err:
+                    # reads verify it again, until the chunk is deleted
+                    verified[:] = bytes(len(verified))
+                else:
+                    first = offset // self.block_size
+                    last = (offset + len(data) - 1) // self.block_size
+                    verified[first:last + 1] = b'\x01' * (last + 1 - first)
+            if err:
+                return err
+            offset += len(data)
+            if throttle:
+                throttle(len(data))
+
+    def copy(self, chunk_handle, copy_handle):
+        """Copies a chunk that is not written meanwhile, and its checksums."""
+        with self.lock(chunk_handle), self.lock(copy_handle, write=True):
+            self.files.invalidate(copy_handle)
+            self.files.invalidate(f'{copy_handle}.crc')
+            self.sums.pop(copy_handle, None)
+            self.verified.pop(copy_handle, None)
+            path = self.files.path
+            shutil.copyfile(f'{path}/{chunk_handle}', f'{path}/{copy_handle}')
+            try:
+                shutil.copyfile(f'{path}/{chunk_handle}.crc', f'{path}/{copy_handle}.crc')
+            except FileNotFoundError:
+                pass  # computed on first use
+
+    def remove(self, chunk_handle):
+        """Forgets the checksums of a chunk about to be deleted, and closes its files."""
+        with self.lock(chunk_handle, write=True):
+            self.sums.pop(chunk_handle, None)
+            self.verified.pop(chunk_handle, None)
+            self.last_write.pop(chunk_handle, None)
+            self.files.invalidate(chunk_handle)
+            self.files.invalidate(f'{chunk_handle}.crc')
+            try:
+                os.remove(f'{self.files.path}/{chunk_handle}.crc')
+            except FileNotFoundError:
+                pass
+            self.locks[chunk_handle][2] = True
+
+    @contextmanager
+    def lock(self, chunk_handle, write=False):
+        """Locks a chunk for reading or writing. Its lock lives until the chunk is removed and unused."""
+        with self.mutex:
+            entry = self.locks.get(chunk_handle, None)
+            if entry is None:
+                entry = self.locks[chunk_handle] = [RWLock(), 0, False]
+            entry[1] += 1
+        rw_lock = entry[0]
+        if write:
+            rw_lock.acquire_write()
+        else:
+            rw_lock.acquire_read()
+        try:
+            yield
+        finally:
+            if write:
+                rw_lock.release_write()
+            else:
+                rw_lock.release_read()
+            with self.mutex:
+                entry[1] -= 1
+                if not entry[1] and entry[2]:
+                    del self.locks[chunk_handle]
+
+    # Assumes the lock of the chunk is acquired (read or write)
+    # Verifies data, starting at block first, but the blocks flagged in verified. Blocks past
+    # the known checksums (a crash between the writes of a chunk and of its checksums) don't
+    # verify either.
+    def verify_helper(self, chunk_handle, sums, data, first, verified=b''):
+        block_size = self.block_size
+        view = memoryview(data)
+        for i, start in enumerate(range(0, len(view), block_size)):
+            block = first + i
+            if block < len(verified) and verified[block]:
+                continue
+            if block >= len(sums) or zlib.crc32(view[start:start + block_size]) != sums[block]:
+                log.error("Checksum mismatch in block %d of chunk %d", block, chunk_handle)
+                return ChecksumMismatchErr
+        return None
+
+    # Assumes the lock of the chunk is acquired (read or write)
+    # Checksums of a chunk whose file fd has size bytes, loaded from its checksum file or
+    # computed from the chunk if there is none yet.
+    def load_helper(self, chunk_handle, fd, size):
+        sums = self.sums.get(chunk_handle, None)
+        if sums is not None:
+            return sums
+
+        sums = array('I')
+        try:
+            with self.files.open(f'{chunk_handle}.crc') as crc_fd:
+                sums.frombytes(os.pread(crc_fd, os.fstat(crc_fd).st_size, 0))
+        except FileNotFoundError:
+            for start in range(0, size, self.block_size):
+                sums.append(zlib.crc32(os.pread(fd, self.block_size, start)))
+            self.store_helper(chunk_handle, sums, 0, len(sums), True)
+        # concurrent readers may both load them, either copy is fine
+        self.verified[chunk_handle] = bytearray(len(sums))
+        self.sums[chunk_handle] = sums
+        return sums
+
+    # Assumes the lock of the chunk is acquired
+    # Writes the checksums of blocks first to end (excluded), truncate drops the ones past the last block.
+    def store_helper(self, chunk_handle, sums, first, end, truncate):
+        with self.files.open(f'{chunk_handle}.crc', create=True) as crc_fd:
+            pwrite_all(crc_fd, memoryview(sums)[first:end].cast('B'), first * SUM_SIZE)
+            if truncate:
+                os.ftruncate(crc_fd, len(sums) * SUM_SIZE)
+
+
+class Scrubber:
+    """
+    Verifies the checksums of every chunk in the background, so that corrupted replicas
+    of chunks that are rarely read get replaced too. A pass over all chunks starts every
+    `interval` seconds, reading at most `bandwidth` bytes per second, and skips the chunks
+    written during the last `idle_time` seconds (being written, reads would compete).
+    Corrupted chunks are passed to on_corrupt(chunk handle).
+    """
+    __slots__ = 'checksums', 'list_chunks', 'on_corrupt', 'interval', 'bandwidth', 'idle_time', 'lock', \
+                'passes', 'chunks_verified', 'bytes_verified', 'corrupt_found'
+
+    def __init__(self, checksums: ChunkChecksums, list_chunks: Callable[[], Iterable[int]],
+                 on_corrupt: Callable[[int], None], interval, bandwidth, idle_time):
+        self.checksums = checksums
+        self.list_chunks = list_chunks
+        self.on_corrupt = on_corrupt
+        self.interval = interval
+        self.bandwidth = bandwidth
+        self.idle_time = idle_time
+
+        self.lock = threading.Lock()  # protects the counters below
+        self.passes = 0
+        self.chunks_verified = 0
+        self.bytes_verified = 0
+        self.corrupt_found = 0
+
+    def start(self):
+        threading.Thread(target=self.scrub_loop, args=(), daemon=True).start()
+
+    def scrub_loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.scrub()
+
+    def throttle(self, length):
+        with self.lock:
+            self.bytes_verified += length
+        time.sleep(length / self.bandwidth)
+
+    def scrub(self):
+        """One pass over all chunks, returns the handles of the corrupted ones."""
+        corrupt = []
+        for chunk_handle in self.list_chunks():
+            last_write = self.checksums.last_write.get(chunk_handle, None)
+            if last_write is not None and time.monotonic() - last_write < self.idle_time:
+                continue
+
+            # pieces of 16 blocks, to let writers in between
+            err = self.checksums.verify(chunk_handle, 16 * self.checksums.block_size, self.throttle)
+            with self.lock:
+                self.chunks_verified += 1
+                if err:
+                    self.corrupt_found += 1
+            if err:
+                corrupt.append(chunk_handle)
+                self.on_corrupt(chunk_handle)
+
+        with self.lock:
+            self.passes += 1
+        return corrupt
+
+    def status(self):
+        with self.lock:
+            return {
+                'passes': self.passes,
+                'chunks_verified': self.chunks_verified,
+                'bytes_verified': float(self.bytes_verified),  # may exceed xmlrpc's 32 bit ints
+                'corrupt_found': self.corrupt_found,
+            }
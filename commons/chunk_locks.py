@@ -0,0 +1,61 @@
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Optional
+
+
+class ChunkLocks:
+    """
+    One lock per chunk of a chunk server, held by the mutations of that chunk while they
+    are applied, so that mutations of different chunks run in parallel.
+    The lock of a chunk is a queue: mutations get it in the order they asked for it.
+    A chunk has a queue only while mutations hold or wait for its lock.
+    """
+    queues: Dict[int, Deque[Optional[threading.Lock]]]
+
+    __slots__ = 'mutex', 'queues', 'waits', 'max_queued'
+
+    def __init__(self):
+        self.mutex = threading.Lock()  # protects the queues and the counters
+        # chunk handle -> the holder of the lock (None) followed by a lock per waiting mutation,
+        # each waiter is released by its predecessor
+        self.queues = {}
+
+        # metrics
+        self.waits = 0  # mutations that queued behind another one
+        self.max_queued = 0
+
+    @contextmanager
+    def lock(self, chunk_handle):
+        waiter = None
+        with self.mutex:
+            queue = self.queues.get(chunk_handle, None)
+            if queue is None:
+                queue = self.queues[chunk_handle] = deque([None])
+            else:
+                waiter = threading.Lock()
+                waiter.acquire()
+                queue.append(waiter)
+                self.waits += 1
+                self.max_queued = max(self.max_queued, len(queue) - 1)
+        if waiter is not None:
+            waiter.acquire()
+
+        try:
+            yield
+        finally:
+            with self.mutex:
+                queue.popleft()
+                if queue:
+                    queue[0].release()  # the next mutation now holds the lock
+                else:
+                    del self.queues[chunk_handle]
+
+    def status(self):
+        with self.mutex:
+            return {
+                'chunks': len(self.queues),
+                'queued': sum(len(queue) - 1 for queue in self.queues.values()),
+                'waits': self.waits,
+                'max_queued': self.max_queued,
+            }
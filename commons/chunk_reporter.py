@@ -0,0 +1,99 @@
+import threading
+import time
+import xmlrpc.client
+from typing import Callable, Dict, List, Tuple
+
+from commons.loggers import default_logger
+
+log = default_logger
+
+
+class ChunkReporter:
+    """
+    Tells the master about the chunks of a chunk server that grew, in batches, instead
+    of one RPC per write. Reports are queued and coalesced per chunk, only the latest
+    length is kept, and sent with one call of send([[chunk handle, chunk index, length]])
+    every `interval` seconds, or as soon as `batch_size` chunks are pending. New chunks
+    are sent right away, and the primary of a new chunk flushes them before it replies,
+    so that clients find it in the length of the file (Client.append picks its chunk by
+    it). The master learns the other lengths `interval` seconds later at most.
+    A batch that fails is put back and sent again with the next one, after
+    `retry_interval` seconds, lengths reported meanwhile replace the ones that failed.
+    Heartbeats report all changes anyway.
+    """
+    pending: Dict[int, Tuple[int, int]]
+
+    __slots__ = 'send', 'interval', 'batch_size', 'retry_interval', 'cond', 'sending', 'pending', 'urgent', \
+                'reports', 'batches', 'failures'
+
+    def __init__(self, send: Callable[[List], None], interval, batch_size, retry_interval):
+        self.send = send
+        self.interval = interval
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.cond = threading.Condition()  # protects the fields below, notified when a batch is due
+        self.sending = threading.Lock()  # held while a batch is sent, flush waits for the one in flight
+        self.pending = {}  # chunk handle -> (chunk index, length)
+        self.urgent = False  # a new chunk is pending
+
+        # metrics
+        self.reports = 0  # reports queued, including the coalesced ones
+        self.batches = 0  # batches sent
+        self.failures = 0  # batches that failed
+
+    def report(self, chunk_handle, chunk_index, length, new=False):
+        with self.cond:
+            self.pending[chunk_handle] = (chunk_index, length)
+            self.reports += 1
+            if new:
+                self.urgent = True
+            if new or len(self.pending) >= self.batch_size:
+                self.cond.notify()
+
+    def start(self):
+        threading.Thread(target=self.report_loop, args=(), daemon=True).start()
+
+    def report_loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.urgent or len(self.pending) >= self.batch_size, self.interval)
+            if not self.flush():
+                time.sleep(self.retry_interval)
+
+    def flush(self):
+        """
+        Sends the pending reports, returns False if they could not be sent. The reports queued
+        before the call are at the master when it returns True, including the ones that
+        another thread was sending.
+        """
+        with self.sending:
+            with self.cond:
+                batch, self.pending = self.pending, {}
+                self.urgent = False
+            if not batch:
+                return True
+
+            try:
+                self.send([[chunk_handle, chunk_index, length]
+                           for chunk_handle, (chunk_index, length) in batch.items()])
+            except (OSError, xmlrpc.client.Error) as e:
+                log.warning("Sending %d chunk reports to the master failed: %s", len(batch), e)
+                with self.cond:
+                    self.failures += 1
+                    for chunk_handle, report in batch.items():
+                        # lengths only grow, a report queued meanwhile is the latest
+                        self.pending.setdefault(chunk_handle, report)
+                return False
+
+            with self.cond:
+                self.batches += 1
+            return True
+
+    def status(self):
+        with self.cond:
+            return {
+                'pending': len(self.pending),
+                'reports': self.reports,
+                'batches': self.batches,
+                'failures': self.failures,
+            }
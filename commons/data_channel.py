@@ -0,0 +1,343 @@
+"""
+Binary TCP channel for chunk data, next to the XML-RPC server of every chunk server.
+XML-RPC base64 encodes bytes inside XML, which inflates them by a third and makes both
+ends build the whole payload as strings. The data channel sends the bytes as they are,
+in DATA_PIECE_SIZE pieces. Reads are verified against the checksums of the chunk first.
+The control RPCs (write, append, serialized_write) stay on XML-RPC.
+
+Pushes are pipelined along a chain of replicas: a client sends the payload once, to the
+first chunk server of the chain, which forwards every piece to the next one as soon as
+it has received it, and so on. A chunk server replies once it and the rest of the chain
+hold the payload, so the client's reply covers every replica.
+
+Every frame starts with a fixed size header, the variable parts follow it and are
+length prefixed by the header:
+ request:  op (1 byte), then
+   PUSH:   client id length (2), timestamp (8, double), payload length (8), chain length (2),
+           client id, chain (XML-RPC addresses of the chunk servers to forward to,
+           separated by newlines), payload
+   READ:   chunk handle (8), offset (8), length (8)
+ reply:    error length (2), payload length (8), error, payload
+Integers are unsigned and big endian. A connection carries any number of requests,
+one at a time.
+"""
+import socket
+import socketserver
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+from urllib.parse import urlsplit
+
+from commons.loggers import default_logger
+from commons.settings import DATA_PORT_OFFSET, DATA_PIECE_SIZE, DATA_MAX_PAYLOAD, DATA_TIMEOUT
+
+log = default_logger
+
+PUSH = 1
+READ = 2
+
+OP = struct.Struct('!B')
+PUSH_HEADER = struct.Struct('!HdQH')
+READ_HEADER = struct.Struct('!QQQ')
+REPLY_HEADER = struct.Struct('!HQ')
+
+
+def data_address(rpc_addr):
+    """(host, port) of the data channel of the chunk server serving XML-RPC at rpc_addr."""
+    url = urlsplit(rpc_addr)
+    return url.hostname, url.port + DATA_PORT_OFFSET
+
+
+def push_request(client_id, timestamp, length, chain):
+    client_id = str(client_id).encode()
+    chain = '\n'.join(chain).encode()
+    return OP.pack(PUSH) + PUSH_HEADER.pack(len(client_id), timestamp, length, len(chain)) + client_id + chain
+
+
+def recv_exact(sock, length):
+    """Receives exactly length bytes, or raises ConnectionError if the peer closed the connection."""
+    buf = bytearray(length)
+    view = memoryview(buf)
+    received = 0
+    while received < length:
+        n = sock.recv_into(view[received:], min(length - received, DATA_PIECE_SIZE))
+        if not n:
+            raise ConnectionError("Connection closed by peer")
+        received += n
+    return buf
+
+
+def drain(sock, length):
+    """Reads and drops length bytes."""
+    piece = memoryview(bytearray(min(length, DATA_PIECE_SIZE)))
+    while length:
+        n = sock.recv_into(piece, min(length, len(piece)))
+        if not n:
+            raise ConnectionError("Connection closed by peer")
+        length -= n
+
+
+def send_pieces(sock, data):
+    view = memoryview(data)
+    for start in range(0, len(view), DATA_PIECE_SIZE):
+        sock.sendall(view[start:start + DATA_PIECE_SIZE])
+
+
+class DataRequestHandler(socketserver.BaseRequestHandler):
+    """Serves the requests of one connection until the client closes it."""
+
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            try:
+                op = sock.recv(1)
+                if not op:
+                    return
+                start = time.perf_counter()
+                op, = OP.unpack(op)
+                if op == PUSH:
+                    method, bytes_in, bytes_out, err = self.handle_push(sock)
+                elif op == READ:
+                    method, bytes_in, bytes_out, err = self.handle_read(sock)
+                else:
+                    log.error("Unknown data channel op %d from %s", op, self.client_address)
+                    return
+            except (OSError, EOFError) as e:
+                log.info("Data channel connection from %s closed: %s", self.client_address, e)
+                return
+            self.server.record(method, time.perf_counter() - start, bytes_in, bytes_out, err)
+
+    def handle_push(self, sock):
+        client_id_length, timestamp, length, chain_length = PUSH_HEADER.unpack(recv_exact(sock, PUSH_HEADER.size))
+        if length > DATA_MAX_PAYLOAD:
+            # the payload can't be skipped without reading it, drop the connection
+            raise EOFError(f"Pushed payload of {length} bytes exceeds {DATA_MAX_PAYLOAD}")
+        client_id = recv_exact(sock, client_id_length).decode()
+        chain = recv_exact(sock, chain_length).decode().split('\n') if chain_length else []
+        bytes_in = PUSH_HEADER.size + client_id_length + chain_length + length
+
+        chunk_server = self.server.chunk_server
+        channel = chunk_server.data_channel
+        held = chunk_server.get_data(f'{client_id}|{timestamp}')
+        if held is not None:
+            # pushed again, eg. retried by a client after a chunk server further down the chain
+            # was full: the payload is dropped, the rest of the chain gets the copy held here
+            drain(sock, length)
+            err = channel.finish_push(chain[0], None, client_id, timestamp, held, chain[1:]) if chain else None
+            self.reply(sock, err)
+            return 'data.push_data', bytes_in, REPLY_HEADER.size, err
+
+        # room is reserved before the payload is received, so that a full chunk server does not
+        # hold more than its budget, a rejected payload is read and dropped piece by piece
+        err = chunk_server.data.reserve(length)
+        if err:
+            drain(sock, length)
+            self.reply(sock, err)
+            return 'data.push_data', bytes_in, REPLY_HEADER.size, err
+
+        forward = channel.open_push(chain[0], client_id, timestamp, length, chain[1:]) if chain else None
+
+        # forward every piece while receiving the next one
+        data = bytearray(length)
+        view = memoryview(data)
+        received = 0
+        try:
+            while received < length:
+                n = sock.recv_into(view[received:], min(length - received, DATA_PIECE_SIZE))
+                if not n:
+                    raise ConnectionError("Connection closed by peer")
+                if forward is not None:
+                    try:
+                        forward.sendall(view[received:received + n])
+                    except OSError as e:
+                        log.info("Forwarding pushed data to %s failed, retrying once received: %s", chain[0], e)
+                        forward.close()
+                        forward = None
+                received += n
+        except BaseException:
+            chunk_server.data.release(length)
+            if forward is not None:
+                forward.close()
+            raise
+
+        err = chunk_server.put_data(client_id, timestamp, data, reserved=True)
+        if chain:
+            forward_err = channel.finish_push(chain[0], forward, client_id, timestamp, data, chain[1:])
+            err = err or forward_err
+        self.reply(sock, err)
+        return 'data.push_data', bytes_in, REPLY_HEADER.size, err
+
+    def handle_read(self, sock):
+        chunk_handle, offset, length = READ_HEADER.unpack(recv_exact(sock, READ_HEADER.size))
+        data, err = self.server.chunk_server.read(chunk_handle, offset, length)
+        if err:
+            self.reply(sock, err)
+            return 'data.read', READ_HEADER.size, REPLY_HEADER.size, err
+        # the data has been read to be verified, it can't be sent from the file anymore
+        sock.sendall(REPLY_HEADER.pack(0, len(data)))
+        send_pieces(sock, data)
+        return 'data.read', READ_HEADER.size, REPLY_HEADER.size + len(data), None
+
+    @staticmethod
+    def reply(sock, err):
+        err = err.encode() if err else b''
+        sock.sendall(REPLY_HEADER.pack(len(err), 0) + err)
+
+
+class DataServer(socketserver.ThreadingTCPServer):
+    """
+    The data channel of a chunk server: pushed payloads go to chunk_server.put_data and
+    reads are served by chunk_server.read. Every connection has its own thread.
+    Requests are recorded as 'data.push_data' and 'data.read' in rpc_stats (RpcStats)
+    if given, so that they show in the chunk server's get_stats.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128  # listen backlog
+
+    def __init__(self, addr, chunk_server, rpc_stats=None):
+        super().__init__(addr, DataRequestHandler)
+        self.chunk_server = chunk_server
+        self.rpc_stats = rpc_stats
+
+    def record(self, method, seconds, bytes_in, bytes_out, err):
+        if self.rpc_stats:
+            self.rpc_stats.record(method, seconds, bytes_in, bytes_out, bool(err))
+
+
+def start_data_server(ip, rpc_port, chunk_server, rpc_stats=None):
+    server = DataServer((ip, rpc_port + DATA_PORT_OFFSET), chunk_server, rpc_stats)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class DataChannel:
+    """
+    Client side of the data channels, keeps idle connections to the chunk servers for
+    reuse. Thread safe, a connection is used by one request at a time.
+    Methods raise OSError if the chunk server can't be reached, callers may fall back
+    to XML-RPC. Errors of the chunk server are returned like the RPCs do.
+    """
+    idle: Dict[str, List[socket.socket]]
+
+    __slots__ = 'timeout', 'idle', 'lock'
+
+    def __init__(self, timeout=DATA_TIMEOUT):
+        self.timeout = timeout
+        self.idle = {}  # chunk server (XML-RPC address) -> idle connections
+        self.lock = threading.Lock()
+
+    def connect(self, address):
+        sock = socket.create_connection(data_address(address), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def take_idle(self, address):
+        with self.lock:
+            connections = self.idle.get(address, None)
+            return connections.pop() if connections else None
+
+    def release(self, address, sock):
+        """Keeps a connection whose last request completed for reuse."""
+        with self.lock:
+            self.idle.setdefault(address, []).append(sock)
+
+    @contextmanager
+    def connection_helper(self, address, sock=None):
+        if sock is None:
+            sock = self.connect(address)
+        try:
+            yield sock
+        except BaseException:
+            sock.close()  # the stream is in an unknown state
+            raise
+        self.release(address, sock)
+
+    def request_helper(self, address, send, receive):
+        sock = self.take_idle(address)
+        if sock is not None:
+            # an idle connection may have been closed by a restarted chunk server, requests
+            # are idempotent so they are retried once on a new connection
+            try:
+                with self.connection_helper(address, sock):
+                    send(sock)
+                    return receive(sock)
+            except ConnectionError:
+                pass
+
+        with self.connection_helper(address) as sock:
+            send(sock)
+            return receive(sock)
+
+    @staticmethod
+    def receive_reply(sock):
+        err_length, length = REPLY_HEADER.unpack(recv_exact(sock, REPLY_HEADER.size))
+        err = recv_exact(sock, err_length).decode() if err_length else None
+        data = recv_exact(sock, length)
+        return data, err
+
+    def push_data(self, address, client_id, timestamp, data, chain=()):
+        """
+        Stores data in the memory of chunk server address and of the chunk servers of chain,
+        address forwards it along the chain. See ChunkServer.push_data.
+        """
+        def send(sock):
+            sock.sendall(push_request(client_id, timestamp, len(data), chain))
+            send_pieces(sock, data)
+
+        _, err = self.request_helper(address, send, self.receive_reply)
+        return err
+
+    def open_push(self, address, client_id, timestamp, length, chain):
+        """
+        Starts a push whose payload is then sent piece by piece on the returned connection,
+        and completed with finish_push. Returns None if address can't be reached.
+        """
+        sock = self.take_idle(address)
+        try:
+            if sock is None:
+                sock = self.connect(address)
+            sock.sendall(push_request(client_id, timestamp, length, chain))
+            return sock
+        except OSError as e:
+            log.info("Unable to forward pushed data to %s, retrying once received: %s", address, e)
+            if sock is not None:
+                sock.close()
+            return None
+
+    def finish_push(self, address, sock, client_id, timestamp, data, chain):
+        """
+        Waits for the reply of a push started by open_push. If the connection failed
+        meanwhile (sock is None), data is pushed again, as a whole.
+        Returns the error of address or of the rest of the chain.
+        """
+        if sock is not None:
+            try:
+                _, err = self.receive_reply(sock)
+                self.release(address, sock)
+                return err
+            except OSError as e:
+                log.info("Forwarding pushed data to %s failed, retrying: %s", address, e)
+                sock.close()
+        try:
+            return self.push_data(address, client_id, timestamp, data, chain)
+        except OSError as e:
+            return f"Unable to forward data to {address}: {e}"
+
+    def read(self, address, chunk_handle, offset, length):
+        """Reads up to length bytes of a chunk, see ChunkServer.read. Returns (data, err)."""
+        def send(sock):
+            sock.sendall(OP.pack(READ) + READ_HEADER.pack(chunk_handle, offset, length))
+
+        data, err = self.request_helper(address, send, self.receive_reply)
+        return (None, err) if err else (data, None)
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for sock in connections:
+                    sock.close()
+            self.idle.clear()
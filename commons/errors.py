@@ -12,3 +12,11 @@ FileNotFoundErr = "File not found."
 NoChunkServerAliveErr = "No chunk server is alive"
 DirAlreadyExistsErr = "Directory already exists"
 DirIsNotEmptyErr = "Directory is Not Empty"
+ShadowLaggingErr = "Shadow master is lagging behind the master"
+InvalidSnapshotErr = "Cannot snapshot a path into itself"
+ChunkIsSharedErr = "Chunk is shared with a snapshot, it must be copied before it is written"
+StagingBufferFullErr = "Chunk server has no room for pushed data, retry later"
+ChecksumMismatchErr = "Chunk replica is corrupt, its checksum does not match"
+MutationOutOfOrderErr = "Mutation arrived after its successors were applied, retry it"
+MasterPollingErr = "Master is still polling the chunk servers for their chunks, retry later"
+MutationNotReadyErr = "Mutation arrived before its predecessors while too many mutations wait, retry it"
@@ -0,0 +1,103 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict
+
+
+def pwrite_all(fd, data, offset):
+    """Writes all of data at offset of file fd, os.pwrite may write less."""
+    written = os.pwrite(fd, data, offset)
+    while written < len(data):
+        written += os.pwrite(fd, memoryview(data)[written:], offset + written)
+
+
+class _OpenFile:
+    __slots__ = 'fd', 'users', 'evicted'
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.users = 0  # threads using fd, it is closed once evicted and unused
+        self.evicted = False
+
+
+class FileCache:
+    """
+    LRU cache of open file descriptors of the chunk files of a chunk server, so that
+    reads and writes don't pay for an open and a close each. Files are accessed with
+    os.pread and os.pwrite, which don't move a shared file offset, so threads can use
+    the same descriptor concurrently.
+    A descriptor evicted or invalidated while in use is closed by its last user.
+    Files must be invalidated before they are deleted or replaced, otherwise the cache
+    keeps serving the old file.
+    """
+    files: Dict[int, _OpenFile]
+
+    __slots__ = 'path', 'capacity', 'files', 'lock', 'hits', 'misses'
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.files = OrderedDict()  # chunk handle -> open file, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def open(self, chunk_handle, create=False):
+        """Yields a descriptor of the chunk file, opened for reading and writing."""
+        with self.lock:
+            entry = self.files.get(chunk_handle, None)
+            if entry is not None:
+                self.files.move_to_end(chunk_handle)
+                self.hits += 1
+            else:
+                flags = os.O_RDWR | os.O_CREAT if create else os.O_RDWR
+                entry = _OpenFile(os.open(f'{self.path}/{chunk_handle}', flags, 0o644))
+                self.files[chunk_handle] = entry
+                self.misses += 1
+                while len(self.files) > self.capacity:
+                    self.evict_helper(self.files.popitem(last=False)[1])
+            entry.users += 1
+
+        try:
+            yield entry.fd
+        finally:
+            with self.lock:
+                entry.users -= 1
+                if entry.evicted and not entry.users:
+                    os.close(entry.fd)
+
+    def read(self, chunk_handle, offset, length):
+        with self.open(chunk_handle) as fd:
+            return os.pread(fd, length, offset)
+
+    def write(self, chunk_handle, data, offset, truncate=False):
+        """Writes data at offset, creating the file if needed. truncate drops what follows the data."""
+        with self.open(chunk_handle, create=True) as fd:
+            pwrite_all(fd, data, offset)
+            if truncate:
+                os.ftruncate(fd, offset + len(data))
+
+    def invalidate(self, chunk_handle):
+        """Closes the descriptor of a chunk file (once unused), call it before deleting or replacing the file."""
+        with self.lock:
+            entry = self.files.pop(chunk_handle, None)
+            if entry is not None:
+                self.evict_helper(entry)
+
+    # Assumes lock is acquired
+    def evict_helper(self, entry):
+        entry.evicted = True
+        if not entry.users:
+            os.close(entry.fd)
+
+    def close(self):
+        with self.lock:
+            for entry in self.files.values():
+                self.evict_helper(entry)
+            self.files.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'open_files': len(self.files), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,58 @@
+import threading
+from contextlib import contextmanager
+
+
+class RWLock:
+    """
+    A readers-writer lock. Writers are preferred: once a writer is waiting,
+    new readers block, so a stream of readers cannot starve it.
+    Not re entrant, a thread must not acquire the same lock twice.
+    """
+    __slots__ = 'cond', 'readers', 'writer', 'waiting_writers'
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0  # number of threads holding the read lock
+        self.writer = False  # whether a thread holds the write lock
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if not self.readers:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+    @contextmanager
+    def read_lock(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_lock(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
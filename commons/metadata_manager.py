@@ -1,94 +1,302 @@
-import ast
+import glob
+import os
+import pickle
+import struct
+import zlib
 
-import master.chunk_manager as ch_mgr
 import master.namespace_manager as ns_mgr
 from commons.datastructures import ChunkInfo
 from commons.loggers import default_logger
+from commons.oplog import read_records
+from master.chunk_table import ChunkTable
 
 log = default_logger
 
-SEPARATOR = "|||"
+# Checkpoint file layout: MAGIC | crc32(payload) | payload (pickled builtins and arrays only)
+CHECKPOINT_MAGIC = b'GFSCKPT4'
+CHECKPOINT_HEADER = struct.Struct(f'>{len(CHECKPOINT_MAGIC)}sI')
 
 
 class OplogActions:
     ADD_CHUNK, GRANT_CLIENT_ID, CREATE_FILE, CREATE_DIR, DELETE_FILE, NOTIFY_MASTER, \
-    REPORT_CHUNK, DEL_BAD_CHUNK = range(8)
-
-
-def update_metadata(metadata_file, action, data):
-    # TODO:
-    #  - Maintain meta data as an in memory object
-    #  - Find a way to dump entire meta data object
-    with open(metadata_file, mode="a") as fp:
-        fp.write(f"{action}{SEPARATOR}{data}\n")
+    REPORT_CHUNK, DEL_BAD_CHUNK, SNAPSHOT = range(9)
 
 
 def parse_metadata(m, fp):
-    # TODO: simplify it's too complicated and hard coded
+    # Replay must be idempotent: checkpoints are fuzzy, so the oplog tail may
+    # contain mutations that are already part of the loaded checkpoint.
     log.debug("****Beginning oplog replay****")
+    replayed = 0
 
-    for line in fp:
-        line = line.strip()
-        key, value = line.split(SEPARATOR)
-        key = int(key)
+    for key, value in read_records(fp):
+        replayed += 1
+        apply_record(m, key, value)
 
-        if key == OplogActions.GRANT_CLIENT_ID:
-            log.debug("action GRANT_CLIENT_ID")
-            m.client_id = int(value)
+    log.debug("****Replayed %d oplog records****", replayed)
+    return replayed
 
-        elif key == OplogActions.NOTIFY_MASTER:
-            log.debug("action NOTIFY_MASTER")
-            m.chunk_manager.active_chunk_servers.add(value)
 
-        elif key == OplogActions.CREATE_FILE:
-            log.debug("action CREATE_FILE")
+# Applies one oplog record to the metadata of m.
+# Assumes m is not serving yet, or that its metadata is locked (shadow masters).
+def apply_record(m, key, value):
+    if key == OplogActions.GRANT_CLIENT_ID:
+        m.client_id = max(m.client_id, value)
 
-            path = value
-            m.namespace_manager.paths[path] = ns_mgr.Path(False, 0)
+    elif key == OplogActions.NOTIFY_MASTER:
+        m.chunk_manager.active_chunk_servers.add(value)
 
-        elif key == OplogActions.CREATE_DIR:
-            log.debug("action CREATE_DIR")
+    elif key == OplogActions.CREATE_FILE:
+        path = value
+        if replayable_create(m.namespace_manager, path):
+            m.namespace_manager.insert_path(path, False)
 
-            path = value
-            m.namespace_manager.paths[path] = ns_mgr.Path(True, 0)
+    elif key == OplogActions.CREATE_DIR:
+        path = value
+        if replayable_create(m.namespace_manager, path):
+            m.namespace_manager.insert_path(path, True)
 
-        elif key == OplogActions.DELETE_FILE:
-            log.debug("action DELETE_FILE")
+    elif key == OplogActions.DELETE_FILE:
+        path = value
+        if m.namespace_manager.exists_helper(path):
+            file_id = m.namespace_manager.file_id_helper(path)
+            if file_id is not None:
+                m.chunk_manager.drop_chunks_of_file(file_id)
+            m.namespace_manager.remove_path(path)
 
-            path = value
-            del m.namespace_manager.paths[path]
+    elif key == OplogActions.ADD_CHUNK:
+        path, chunk_index, handle, locations, chunk_handle_counter = value
 
-        elif key == OplogActions.ADD_CHUNK:
-            log.debug("Replaying add chunk")
+        # chunk metadata refers to the current incarnation of the file, chunks of a file
+        # that is deleted further down the oplog are dropped with it anyway
+        file_id = m.namespace_manager.file_id_helper(path)
+        if file_id is not None:
+            m.chunk_manager.table.add(handle, file_id, chunk_index, locations)
+        # the next handle to be granted must be greater than every replayed one
+        m.chunk_manager.chunk_handle = max(m.chunk_manager.chunk_handle, chunk_handle_counter + 1)
 
-            path, chunk_index, handle, locations, chunk_handle_counter = ast.literal_eval(value)
+    elif key == OplogActions.SNAPSHOT:
+        src, dst = value
+        if m.namespace_manager.exists_helper(src) and replayable_create(m.namespace_manager, dst):
+            for file_id, copy_id in m.namespace_manager.copy_path(src, dst):
+                m.chunk_manager.table.share_file(file_id, copy_id)
 
-            # update our dicts
-            chunk = m.chunk_manager.chunks.get(path, None)
-            if not chunk:  # prevent NPE when updating chunks[path][chunk_index]
-                m.chunk_manager.chunks[path] = {}
+    # Chunkserver specific actions
+    elif key == OplogActions.REPORT_CHUNK:
+        path, chunk_handle, chunk_index, length = value
+        m.chunks[chunk_handle] = ChunkInfo(path, chunk_handle, chunk_index, length)
 
-            m.chunk_manager.chunks[path][chunk_index] = ch_mgr.Chunk(handle)
-            m.chunk_manager.locations[handle] = ch_mgr.ChunkInfo(handle, locations)
-            m.chunk_manager.handles[handle] = ch_mgr.PathIndex(path, chunk_index)
-            m.chunk_manager.chunk_handle = chunk_handle_counter
+    elif key == OplogActions.DEL_BAD_CHUNK:
+        m.chunks.pop(value, None)
 
-        # Chunkserver specific actions
-        elif key == OplogActions.REPORT_CHUNK:
-            path, chunk_handle, chunk_index, length = ast.literal_eval(value)
-            m.chunks[chunk_handle] = ChunkInfo(path, chunk_handle, chunk_index, length)
+    else:
+        log.error('Invalid meta data key: %s with value: %s', key, value)
 
-        elif key == OplogActions.DEL_BAD_CHUNK:
-            del m.chunks[value]
 
-        else:
-            log.error('Invalid meta data key: %s with value: %s', key, value)
+def replayable_create(namespace_manager, path):
+    """Whether a create of path has not been applied yet and can be applied."""
+    return not namespace_manager.exists_helper(path) and namespace_manager.is_dir_helper(ns_mgr.get_parent(path))
 
 
 def load_metadata(server):
     try:
-        with open(server.metadata_file) as fp:
+        with open(server.metadata_file, 'r+b') as fp:
             parse_metadata(server, fp)
+            # drop a torn trailing record so that new records are appended right after the last good one
+            fp.truncate()
         log.debug("****oplog replay completed****")
     except FileNotFoundError:
         log.error("Can't open meta data file: %s", server.metadata_file)
+
+
+def oplog_segment_name(metadata_file, epoch):
+    """Name of the oplog segment that was closed when checkpoint `epoch` was started."""
+    return f'{metadata_file}.{epoch}'
+
+
+def oplog_segments(metadata_file):
+    """Returns a sorted list of (epoch, filename) of all rotated oplog segments."""
+    segments = []
+    for filename in glob.glob(f'{glob.escape(metadata_file)}.*'):
+        suffix = filename[len(metadata_file) + 1:]
+        if suffix.isdigit():
+            segments.append((int(suffix), filename))
+    return sorted(segments)
+
+
+def take_checkpoint(m):
+    """
+    Writes a checkpoint of the master's persistent state to m.checkpoint_file.
+    Locks are held only while shallow copies of the tables are taken, RPCs are
+    not blocked while the checkpoint is serialized and written.
+    """
+    # Skip past segments left behind by a failed checkpoint so they are never overwritten.
+    segments = oplog_segments(m.metadata_file)
+    epoch = max(m.checkpoint_epoch, segments[-1][0] if segments else 0) + 1
+
+    ns = m.namespace_manager
+    cm = m.chunk_manager
+
+    # Freeze mutations just long enough to close the current oplog segment and
+    # take shallow copies of the tables. Records written from now on go to a
+    # fresh oplog and form the tail that is replayed on top of this checkpoint.
+    # Only mutations that were applied but not yet logged at this instant are
+    # both in the copies and in the tail, they are replayed idempotently.
+    # ns.mutex before cm.lock, in the order chunk reports take them
+    with m.mutex, ns.freeze(), ns.mutex, cm.lock:
+        m.oplog.rotate(oplog_segment_name(m.metadata_file, epoch))
+
+        client_id = m.client_id
+        namespace = ns.snapshot_helper()
+        path_count = len(ns.inodes)
+        chunk_handle = cm.chunk_handle
+        chunk_count = len(cm.table)
+        chunks = cm.table.snapshot()
+        chunk_servers = list(cm.active_chunk_servers)
+
+    state = {
+        'epoch': epoch,
+        'client_id': client_id,
+        'chunk_handle': chunk_handle,
+        'chunk_servers': chunk_servers,
+        'namespace': namespace,
+        'chunks': chunks,
+    }
+    payload = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+    tmp_file = f'{m.checkpoint_file}.tmp'
+    with open(tmp_file, 'wb') as fp:
+        fp.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, zlib.crc32(payload)))
+        fp.write(payload)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_file, m.checkpoint_file)
+    m.checkpoint_epoch = epoch
+
+    # The checkpoint is durable, older oplog segments are no longer needed. The segment just
+    # closed is kept until the next checkpoint, for shadow masters still reading its end.
+    for seg_epoch, filename in oplog_segments(m.metadata_file):
+        if seg_epoch < epoch:
+            os.remove(filename)
+
+    log.info("Checkpoint %d written: %d paths, %d chunks", epoch, path_count, chunk_count)
+    return epoch
+
+
+def load_checkpoint(m, read_only=False):
+    """
+    Restores master state from the latest checkpoint (if any) and replays the
+    oplog segments rotated after it. The live oplog tail must be replayed
+    afterwards with load_metadata.
+    Shadow masters load the files of their master read_only, leaving segments
+    that are no longer needed for the master to remove.
+    """
+    try:
+        with open(m.checkpoint_file, 'rb') as fp:
+            header = fp.read(CHECKPOINT_HEADER.size)
+            payload = fp.read()
+    except FileNotFoundError:
+        log.info("No checkpoint found at %s", m.checkpoint_file)
+    else:
+        magic, crc = CHECKPOINT_HEADER.unpack(header)
+        if magic != CHECKPOINT_MAGIC or zlib.crc32(payload) != crc:
+            raise ValueError(f"Corrupted checkpoint file: {m.checkpoint_file}")
+
+        restore_checkpoint(m, pickle.loads(payload))
+        log.info("Loaded checkpoint %d from %s", m.checkpoint_epoch, m.checkpoint_file)
+
+    # Segments newer than the checkpoint belong to a checkpoint that never completed.
+    for seg_epoch, filename in oplog_segments(m.metadata_file):
+        if seg_epoch <= m.checkpoint_epoch:
+            if not read_only:
+                os.remove(filename)
+            continue
+        log.info("Replaying oplog segment %s", filename)
+        with open(filename, 'rb') as fp:
+            parse_metadata(m, fp)
+        m.checkpoint_epoch = seg_epoch
+
+
+class OplogGapError(Exception):
+    """Raised when records of an oplog being followed were removed before they could be read."""
+
+
+class OplogFollower:
+    """
+    Follows the oplog of a master from another process, like tail -F: poll() returns
+    the records appended since the previous call. When the master rotates its oplog
+    for a checkpoint, the rest of the rotated segment is read before moving on to
+    the next segment, or to the fresh live oplog.
+    """
+    __slots__ = 'metadata_file', 'fp'
+
+    def __init__(self, metadata_file):
+        self.metadata_file = metadata_file
+        self.fp = open(metadata_file, 'rb')
+
+    def close(self):
+        self.fp.close()
+
+    def is_following(self, stat):
+        """Whether the file being read is the one stat was taken of."""
+        current = os.fstat(self.fp.fileno())
+        return (current.st_dev, current.st_ino) == (stat.st_dev, stat.st_ino)
+
+    def is_live(self):
+        """Whether the file being read still is the oplog the master appends to."""
+        try:
+            return self.is_following(os.stat(self.metadata_file))
+        except FileNotFoundError:  # in the middle of a rotation
+            return True
+
+    def poll(self):
+        """
+        Returns the (action, data) of the records appended since the previous call.
+        Raises OplogGapError if a rotated segment was removed before it could be
+        read to its end, the follower has to start over from the latest checkpoint.
+        """
+        records = []
+        while True:
+            # once rotated, the master never appends to the file again: read after checking
+            live = self.is_live()
+            records.extend(read_records(self.fp, following=True))
+            if live:
+                return records
+
+            next_fp = self.open_next_helper()
+            if not next_fp:
+                return records  # the fresh oplog is not created yet, try again later
+            self.fp.close()
+            self.fp = next_fp
+
+    def open_next_helper(self):
+        segments = oplog_segments(self.metadata_file)
+        epoch = None
+        for seg_epoch, filename in segments:
+            try:
+                if self.is_following(os.stat(filename)):
+                    epoch = seg_epoch
+                    break
+            except FileNotFoundError:
+                continue
+        if epoch is None:
+            raise OplogGapError(f"Rotated oplog segment of {self.metadata_file} removed by a checkpoint")
+
+        later = [filename for seg_epoch, filename in segments if seg_epoch > epoch]
+        try:
+            return open(later[0] if later else self.metadata_file, 'rb')
+        except FileNotFoundError:
+            if later:
+                raise OplogGapError(f"Oplog segment {later[0]} removed by a checkpoint")
+            return None
+
+
+def restore_checkpoint(m, state):
+    m.checkpoint_epoch = state['epoch']
+    m.client_id = state['client_id']
+
+    m.namespace_manager.load_snapshot(state['namespace'])
+
+    cm = m.chunk_manager
+    cm.chunk_handle = state['chunk_handle']
+    cm.active_chunk_servers = set(state['chunk_servers'])
+    cm.table = ChunkTable.from_snapshot(state['chunks'])
@@ -0,0 +1,112 @@
+import threading
+import time
+import uuid
+from typing import Dict, List, Set
+
+from commons.errors import MutationOutOfOrderErr, MutationNotReadyErr
+
+
+class MutationOrder:
+    """
+    Keeps the mutations of a chunk in the order assigned by its primary, while the
+    primary sends them to the secondaries without waiting for each other (pipelined).
+    As primary, a chunk server numbers the mutations of each chunk in the order it
+    applied them (assign), and notes when all secondaries replied (completed). As
+    secondary, it applies them in that order: a mutation waits for its predecessors
+    (wait_turn), and lets its successor go once applied (done).
+    Serials are [epoch, number, base]: the epoch is new at every start of the chunk server,
+    base is the oldest mutation of the chunk the primary still waits for. Mutations before
+    base are over, applied or failed, so a secondary starts a new epoch (eg. the lease
+    moved to another primary) at base, and never waits for them. A predecessor that does
+    not arrive within `timeout` seconds (its RPC failed, and so did its write) is skipped,
+    it is rejected if it comes later. Either way its client got an error, as in GFS the
+    region is then undefined until the client retries.
+    At most `max_waiters` mutations wait at a time, each holds an RPC worker: the next ones
+    are told to come back (MutationNotReadyErr), so that workers are left for their
+    predecessors.
+    """
+    assigned: Dict[int, int]
+    in_flight: Dict[int, Set[int]]
+    applied: Dict[int, List]
+
+    __slots__ = 'timeout', 'max_waiters', 'epoch', 'cond', 'assigned', 'in_flight', 'applied', 'waiters'
+
+    def __init__(self, timeout, max_waiters):
+        self.timeout = timeout
+        self.max_waiters = max_waiters
+        self.epoch = uuid.uuid4().hex  # of the mutations numbered by this chunk server
+        self.cond = threading.Condition()
+        self.assigned = {}  # chunk handle -> number of mutations numbered as primary
+        self.in_flight = {}  # chunk handle -> numbers of the mutations sent to the secondaries, not completed yet
+        self.applied = {}  # chunk handle -> [epoch, number of the next mutation to apply] as secondary
+        self.waiters = 0  # mutations waiting for their predecessors
+
+    def assign(self, chunk_handle):
+        """Serial of the next mutation of a chunk, to be called in the order they are applied by the primary."""
+        with self.cond:
+            number = self.assigned.get(chunk_handle, 0)
+            self.assigned[chunk_handle] = number + 1
+            in_flight = self.in_flight.setdefault(chunk_handle, set())
+            in_flight.add(number)
+            return [self.epoch, number, min(in_flight)]
+
+    def completed(self, chunk_handle, serial):
+        """All secondaries replied to a mutation numbered by assign."""
+        number = serial[1]
+        with self.cond:
+            in_flight = self.in_flight.get(chunk_handle, None)
+            if in_flight is not None:
+                in_flight.discard(number)
+                if not in_flight:
+                    del self.in_flight[chunk_handle]
+
+    def wait_turn(self, chunk_handle, serial):
+        """
+        Waits until the predecessors of a mutation are applied. Returns MutationOutOfOrderErr
+        if it is too late, MutationNotReadyErr if it has to wait and too many mutations do already.
+        """
+        epoch, number, base = serial
+        deadline = time.monotonic() + self.timeout
+        with self.cond:
+            state = self.applied.get(chunk_handle, None)
+            if state is None or state[0] != epoch:
+                state = self.applied[chunk_handle] = [epoch, base]
+            elif state[1] < base:
+                state[1] = base  # the predecessors failed here, no need to wait for them
+                self.cond.notify_all()
+
+            if number > state[1]:
+                if self.waiters >= self.max_waiters:
+                    return MutationNotReadyErr
+                self.waiters += 1
+                try:
+                    while number > state[1]:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            state[1] = number  # the predecessors are lost, skip them
+                            break
+                        self.cond.wait(remaining)
+                        if self.applied.get(chunk_handle, None) is not state:
+                            return MutationOutOfOrderErr  # a newer primary took over, or the chunk is gone
+                finally:
+                    self.waiters -= 1
+
+            if number < state[1]:
+                return MutationOutOfOrderErr
+            return None
+
+    def done(self, chunk_handle, serial):
+        """A mutation has been applied (or failed), its successor may go."""
+        epoch, number = serial[:2]
+        with self.cond:
+            state = self.applied.get(chunk_handle, None)
+            if state is not None and state[0] == epoch and state[1] == number:
+                state[1] = number + 1
+                self.cond.notify_all()
+
+    def forget(self, chunk_handle):
+        """Drops the state of a deleted chunk."""
+        with self.cond:
+            self.assigned.pop(chunk_handle, None)
+            self.in_flight.pop(chunk_handle, None)
+            self.applied.pop(chunk_handle, None)
@@ -0,0 +1,154 @@
+"""
+Binary operation log shared by master and chunkservers.
+
+Every record is framed as:
+    length (u32) | crc32 of action and payload (u32) | action (u8) | payload
+where payload is the pickled data of the action (builtins only).
+"""
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+from commons.loggers import default_logger
+
+log = default_logger
+
+RECORD_HEADER = struct.Struct('>IIB')  # payload length, crc32, action
+
+
+class OplogCorruptedError(Exception):
+    """Raised when a record in the middle of an oplog fails its checksum."""
+
+
+def encode_record(action, data):
+    payload = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+    crc = zlib.crc32(payload, zlib.crc32(bytes((action,))))
+    return RECORD_HEADER.pack(len(payload), crc, action) + payload
+
+
+def read_records(fp, following=False):
+    """
+    Streaming decoder for a binary oplog opened in 'rb' mode, yields (action, data).
+    A torn trailing record (left by a crash in the middle of a write) is skipped
+    and fp is left positioned at the end of the last complete record, so that
+    the caller can truncate the garbage away.
+    When following a log that is still being written, the trailing record may
+    simply be incomplete yet: it is not reported, the next call reads it.
+    """
+    file_size = os.fstat(fp.fileno()).st_size
+    while True:
+        offset = fp.tell()
+        header = fp.read(RECORD_HEADER.size)
+        if not header:
+            return
+
+        torn = len(header) < RECORD_HEADER.size
+        if not torn:
+            length, crc, action = RECORD_HEADER.unpack(header)
+            payload = fp.read(length)
+            torn = len(payload) < length
+            if not torn and zlib.crc32(payload, zlib.crc32(bytes((action,)))) != crc:
+                if fp.tell() < file_size:
+                    raise OplogCorruptedError(f"Bad checksum in {fp.name} at offset {offset}")
+                torn = True
+
+        if torn:
+            if not following:
+                log.warning("Skipping torn record at the end of %s (offset %d)", fp.name, offset)
+            fp.seek(offset)
+            return
+
+        yield action, pickle.loads(payload)
+
+
+class OplogWriter:
+    """
+    Keeps the oplog open and group-commits concurrent appends: records appended
+    while an fsync is in progress are written and synced together by the next
+    flush, so every append() pays for at most one fsync shared with its peers.
+    """
+    __slots__ = 'filename', 'fp', 'cond', 'pending', 'last_seq', 'durable_seq', 'flushing', 'error'
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = open(filename, 'ab')
+        self.cond = threading.Condition()
+
+        self.pending = []  # encoded records not yet written
+        self.last_seq = 0  # sequence number of the last appended record
+        self.durable_seq = 0  # records up to this sequence number are on disk
+        self.flushing = False  # whether some appender is writing a batch right now
+        self.error = None  # a failed flush leaves the log unusable
+
+    def append(self, action, data):
+        """Appends a record and returns once it is durable on disk."""
+        record = encode_record(action, data)
+        with self.cond:
+            self.pending.append(record)
+            self.last_seq += 1
+            seq = self.last_seq
+
+            while self.durable_seq < seq:
+                if self.error:
+                    raise self.error
+                if self.flushing:
+                    self.cond.wait()
+                else:
+                    # become the leader of the next group commit
+                    self._flush()
+
+    # Assumes cond is acquired, releases it during the actual I/O.
+    def _flush(self):
+        batch, self.pending = self.pending, []
+        batch_seq = self.last_seq
+        self.flushing = True
+        self.cond.release()
+        try:
+            self.fp.write(b''.join(batch))
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+        except OSError as err:
+            self.error = err
+            raise
+        finally:
+            self.cond.acquire()
+            self.flushing = False
+            if not self.error:
+                self.durable_seq = batch_seq
+            self.cond.notify_all()
+
+    def sync(self):
+        """Waits until every record appended so far is durable."""
+        with self.cond:
+            while self.durable_seq < self.last_seq or self.flushing:
+                if self.error:
+                    raise self.error
+                if self.flushing:
+                    self.cond.wait()
+                else:
+                    self._flush()
+
+    def rotate(self, segment_name):
+        """
+        Flushes pending records, renames the current log to segment_name and
+        continues appending to a fresh, empty log.
+        """
+        with self.cond:
+            while self.flushing or self.pending:
+                if self.error:
+                    raise self.error
+                if self.flushing:
+                    self.cond.wait()
+                else:
+                    self._flush()
+
+            self.fp.close()
+            os.replace(self.filename, segment_name)
+            self.fp = open(self.filename, 'ab')
+
+    def close(self):
+        self.sync()
+        with self.cond:
+            self.fp.close()
@@ -0,0 +1,137 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from xmlrpc.server import SimpleXMLRPCServer
+
+from commons.loggers import default_logger
+from commons.stats import RpcStats, is_error, format_stats
+
+log = default_logger
+
+
+class ThreadPoolXMLRPCServer(SimpleXMLRPCServer):
+    """
+    An XML-RPC server that handles requests on a bounded pool of worker threads.
+    At most `workers` requests run at a time and at most `queue_size` more wait
+    for a free worker. When both are full the server stops accepting connections,
+    so further clients queue up in the listen backlog of the socket instead of
+    piling up in memory (backpressure).
+    Every RPC is measured (calls, errors, bytes, latency), see get_stats.
+    """
+    allow_reuse_address = True
+    request_queue_size = 128  # listen backlog
+
+    def __init__(self, addr, workers, queue_size, locks=None, **kwargs):
+        super().__init__(addr, **kwargs)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rpc')
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+
+        self.stats_lock = threading.Lock()
+        self.queued = 0  # accepted requests waiting for a worker
+        self.in_flight = 0  # requests being handled by a worker
+        self.max_queued = 0
+        self.completed = 0
+        self.saturated = 0  # times the server had to stop accepting
+
+        self.rpc_stats = RpcStats()
+        self.locks = locks or {}  # name -> InstrumentedLock reported by get_stats
+        self.current = threading.local()  # method name and outcome of the RPC handled by a worker
+
+        # published next to the methods of the registered instance
+        self.register_function(self.get_server_stats)
+        self.register_function(self.get_stats)
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            with self.stats_lock:
+                self.saturated += 1
+            log.warning("RPC server saturated (%d workers, %d queued), applying backpressure",
+                        self.workers, self.queue_size)
+            self.slots.acquire()
+
+        with self.stats_lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        with self.stats_lock:
+            self.queued -= 1
+            self.in_flight += 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.stats_lock:
+                self.in_flight -= 1
+                self.completed += 1
+            self.slots.release()
+
+    def _marshaled_dispatch(self, data, dispatch_method=None, path=None):
+        start = time.perf_counter()
+        current = self.current
+        current.method, current.error = '<malformed>', True
+        response = super()._marshaled_dispatch(data, dispatch_method, path)
+        self.rpc_stats.record(current.method, time.perf_counter() - start, len(data), len(response), current.error)
+        return response
+
+    def _dispatch(self, method, params):
+        current = self.current
+        current.method, current.error = method, True  # stays an error if the call raises
+        result = super()._dispatch(method, params)
+        current.error = is_error(result)
+        return result
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+    def get_server_stats(self):
+        """RPC: request queue depth and in-flight metrics of this server."""
+        with self.stats_lock:
+            return {
+                'workers': self.workers,
+                'queue_size': self.queue_size,
+                'queued': self.queued,
+                'in_flight': self.in_flight,
+                'max_queued': self.max_queued,
+                'completed': self.completed,
+                'saturated': self.saturated,
+            }
+
+    def get_stats(self, as_text=False):
+        """
+        RPC: per method statistics of the RPCs served so far, and the time spent waiting for
+        the instrumented locks. Times are in seconds.
+        :return: {uptime, server: get_server_stats(),
+                  rpcs: {method: {calls, errors, bytes_in, bytes_out, latency: {count, mean, p50, p90, p99, max}}},
+                  locks: {name: {acquisitions, contended, wait_total, wait: {count, mean, p50, p90, p99, max}}}}
+            or a text dump of it if as_text is set.
+        """
+        stats = {
+            'uptime': time.monotonic() - self.rpc_stats.started,
+            'server': self.get_server_stats(),
+            'rpcs': self.rpc_stats.snapshot(),
+            'locks': {name: lock.snapshot() for name, lock in sorted(self.locks.items())},
+        }
+        return format_stats(stats) if as_text else stats
+
+
+def make_rpc_server(ip, port, instance, workers, queue_size, locks=None):
+    """Creates a thread pool XML-RPC server publishing all methods of instance,
+    locks maps names to the InstrumentedLocks of instance reported by get_stats."""
+    server = ThreadPoolXMLRPCServer((ip, port), workers, queue_size, locks,
+                                    logRequests=True,
+                                    allow_none=True)
+
+    # Read: https://gist.github.com/abnvanand/199cacf6c8f45258ff096b842b77b216
+    server.register_introspection_functions()
+
+    # register all methods to be available to client
+    # All the methods of the instance are published as XML-RPC methods
+    server.register_instance(instance)
+    return server
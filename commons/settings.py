@@ -3,10 +3,91 @@
 CHUNK_SIZE = 5  # 4 Bytes # FIXME remove in production
 APPEND_SIZE = 2  # for testing purpose, idealy it shoud be 1/4th of the chunk size
 REPLICATION_FACTOR = 3
-HEARTBEAT_INTERVAL = 15  # seconds to sleep the HB thread
+HEARTBEAT_INTERVAL = 5  # seconds between two heartbeats of a chunk server
+HEARTBEAT_TIMEOUT = 3 * HEARTBEAT_INTERVAL  # a chunk server missing heartbeats for this long is declared dead
 
 DEFAULT_IP = "127.0.0.1"
 DEFAULT_MASTER_PORT = 9001
 DEFAULT_MASTER_ADDR = f'http://{DEFAULT_IP}:{DEFAULT_MASTER_PORT}'
 
-OP_LOG_FILENAME = "logs/master_metadata.txt"
+OP_LOG_FILENAME = "logs/master_metadata.bin"
+CHECKPOINT_FILENAME = "logs/master_checkpoint.bin"
+CHECKPOINT_INTERVAL = 300  # seconds between two checkpoints of master metadata
+LIST_PAGE_SIZE = 1000  # number of files fetched per list_allfiles call
+RPC_WORKERS = 16  # threads serving RPCs on master and chunkservers
+RPC_QUEUE_SIZE = 64  # RPCs waiting for a free worker before the server stops accepting
+MAX_LOCATIONS_BATCH = 1024  # max number of chunks returned by one find_locations_range call
+POLL_WORKERS = 32  # chunk servers polled in parallel for their chunks when the master starts
+POLL_TIMEOUT = 10  # seconds a chunk server has to answer the startup poll
+POLL_RETRY_DELAY = 0.5  # seconds before a client asks again for a lease or a chunk refused during the poll
+COPY_ON_WRITE_TIMEOUT = 30  # seconds a chunk server has to copy a chunk shared with a snapshot
+SHARE_TIMEOUT = 10  # seconds a chunk server has to take note of the chunks a snapshot shares
+CHUNK_FILE_CACHE_SIZE = 256  # chunk files a chunk server keeps open, must stay below its file descriptor limit
+
+# Checksums
+CHECKSUM_BLOCK_SIZE = 64 * (1 << 10)  # bytes covered by one checksum of a chunk file
+SCRUB_INTERVAL = 3600  # seconds between two passes of the scrubber over all chunks of a chunk server
+SCRUB_BANDWIDTH = 4 * (1 << 20)  # bytes per second read by the scrubber
+SCRUB_IDLE_TIME = 60  # seconds since their last write after which chunks are scrubbed
+
+# Data channel (binary TCP transport of chunk data, see commons/data_channel.py)
+DATA_PORT_OFFSET = 1000  # a chunk server's data channel listens on its XML-RPC port plus this
+DATA_PIECE_SIZE = 1 << 20  # bytes sent or received per socket call
+DATA_MAX_PAYLOAD = 64 * (1 << 20)  # largest payload accepted by push_data
+DATA_TIMEOUT = 30  # seconds a client waits on a data channel socket
+
+# Staging of pushed data on chunk servers (commons/staging_buffer.py)
+STAGING_CAPACITY = 256 * (1 << 20)  # bytes of pushed data a chunk server holds until they are written
+STAGING_TTL = 60  # seconds after which pushed data that was not written is dropped
+
+# Pushes of data by clients
+PUSH_RETRIES = 5  # retries of a push rejected by a full chunk server
+PUSH_RETRY_DELAY = 0.2  # seconds, doubled after every rejection
+
+# Mutations
+SECONDARY_TIMEOUT = 10  # seconds a primary waits for a secondary to apply a mutation
+FANOUT_WORKERS = 32  # threads of a primary sending mutations to secondaries, all chunks together
+MUTATION_ORDER_TIMEOUT = 5  # seconds a secondary waits for the preceding mutations of a chunk before skipping them
+MUTATION_ORDER_WAITERS = RPC_WORKERS * 3 // 4  # mutations a secondary holds back at once, on RPC workers
+MUTATION_RETRY_DELAY = 0.01  # seconds before a mutation told to come back is sent again
+
+# Chunk reports (commons/chunk_reporter.py)
+CHUNK_REPORT_INTERVAL = 0.1  # seconds during which a chunk server coalesces the lengths of grown chunks
+CHUNK_REPORT_BATCH = 256  # chunks reported in one batch, a full batch is sent without waiting
+CHUNK_REPORT_TIMEOUT = 10  # seconds a chunk server waits for the master to take a batch of reports
+
+# Shadow masters
+SHADOW_POLL_INTERVAL = 0.1  # seconds between two reads of the master's oplog
+SHADOW_MAX_LAG = 5  # seconds behind the master's oplog after which a shadow refuses lookups
+SHADOW_REFRESH_INTERVAL = 30  # seconds between two polls of the chunk servers for locations and lengths
+SHADOW_TIMEOUT = 2  # seconds a client waits for a shadow before asking the master
+
+# Chunk placement
+MAX_DISK_UTILIZATION = 0.95  # servers fuller than this only get new chunks if nothing else is left
+NEW_SERVER_PERIOD = 300  # seconds during which a newly joined chunk server is throttled
+NEW_SERVER_MAX_ALLOCATIONS = 50  # max new chunks a throttled server receives per ALLOCATION_WINDOW
+ALLOCATION_WINDOW = 60  # seconds
+MAX_RECENT_ALLOCATION_SKEW = 1.5  # max ratio of a server's recent allocations to its fair share
+MAX_WRITE_LOAD_SKEW = 3.0  # servers reporting more write traffic than this times the average get no new chunks
+
+# Re-replication
+REPLICATION_WORKERS = 8  # max chunk copies in flight
+MAX_COPIES_PER_SOURCE = 2  # max copies reading from one chunk server at a time
+MAX_COPIES_PER_DEST = 2  # max copies writing to one chunk server at a time
+REPLICATION_BANDWIDTH = 50 * (1 << 20)  # bytes per second for all copies together
+REPLICATION_RETRIES = 3  # retries of a failed copy before it is left to the next scan
+REPLICATION_RETRY_DELAY = 5  # seconds, multiplied by the number of failed attempts
+REPLICATION_SCAN_INTERVAL = 60  # seconds between two scans for under replicated chunks
+REPLICATION_COPY_TIMEOUT = 60  # seconds a chunk server has to copy a chunk from a peer, a copy taking longer failed
+
+# Rebalancing
+REBALANCE_INTERVAL = 30  # seconds between two rebalancing rounds
+REBALANCE_THRESHOLD = 0.1  # servers holding within this fraction of the mean chunk count are balanced
+REBALANCE_BATCH = 32  # max replicas moved per round
+REBALANCE_WORKERS = 2  # max replica moves in flight
+REBALANCE_BANDWIDTH = 10 * (1 << 20)  # bytes per second for all moves together, below re-replication
+REBALANCE_COPY_TIMEOUT = 60  # seconds a chunk server has to copy a chunk from a peer, a move taking longer is given up
+
+# Garbage collection
+GC_BATCH_SIZE = 100  # max chunk deletions sent to a chunk server with one heartbeat reply
+ORPHAN_SCAN_INTERVAL = 600  # seconds between two scans of a chunk server's disk for unreferenced chunk files
@@ -0,0 +1,125 @@
+import time
+from collections import OrderedDict
+from typing import Dict
+
+from commons.errors import StagingBufferFullErr
+from commons.stats import InstrumentedLock
+
+
+class _Staged:
+    __slots__ = 'data', 'expiration'
+
+    def __init__(self, data, expiration):
+        self.data = data
+        self.expiration = expiration
+
+
+class StagingBuffer:
+    """
+    Data pushed by clients to a chunk server, waiting for the write or append that
+    consumes it, keyed by '<client id>|<timestamp>'.
+    At most `capacity` bytes are held: a push that does not fit is rejected with
+    StagingBufferFullErr, clients retry it later (backpressure). Entries that are not
+    consumed within `ttl` seconds (the client crashed, or the write failed) are dropped.
+    The pushed buffers are stored as they are, without copies.
+    """
+    entries: Dict[str, _Staged]
+
+    __slots__ = 'capacity', 'ttl', 'entries', 'used', 'mutex', 'max_used', 'rejected', 'expired'
+
+    def __init__(self, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()  # oldest first, so expired entries are at the front
+        self.used = 0  # bytes held or reserved
+        self.mutex = InstrumentedLock()
+
+        # metrics
+        self.max_used = 0
+        self.rejected = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def reserve(self, length):
+        """Reserves room for a push of length bytes before it is received, returns an error if there is none."""
+        with self.mutex:
+            return self.reserve_helper(length)
+
+    # Assumes mutex is acquired
+    def reserve_helper(self, length):
+        self.expire_helper(time.monotonic())
+        if self.used + length > self.capacity:
+            self.rejected += 1
+            return StagingBufferFullErr
+        self.used += length
+        self.max_used = max(self.max_used, self.used)
+        return None
+
+    def release(self, length):
+        """Gives back a reservation whose data was not put."""
+        with self.mutex:
+            self.used -= length
+
+    def put(self, key, data, reserved=False):
+        """Stores data unless key is already there, room for it must have been reserved if reserved is set."""
+        with self.mutex:
+            if key in self.entries:
+                # pushed again, eg. retried along a chain
+                if reserved:
+                    self.used -= len(data)
+                return None
+            if not reserved:
+                err = self.reserve_helper(len(data))
+                if err:
+                    return err
+            self.entries[key] = _Staged(data, time.monotonic() + self.ttl)
+            return None
+
+    def get(self, key):
+        with self.mutex:
+            entry = self.entries.get(key, None)
+            return entry.data if entry else None
+
+    def pop(self, key):
+        with self.mutex:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            self.used -= len(entry.data)
+            return entry.data
+
+    def expire(self):
+        with self.mutex:
+            self.expire_helper(time.monotonic())
+
+    # Assumes mutex is acquired
+    def expire_helper(self, now):
+        entries = self.entries
+        while entries:
+            key, entry = next(iter(entries.items()))
+            if entry.expiration > now:
+                break
+            del entries[key]
+            self.used -= len(entry.data)
+            self.expired += 1
+
+    def clear(self):
+        with self.mutex:
+            for entry in self.entries.values():
+                self.used -= len(entry.data)
+            self.entries.clear()
+
+    def status(self):
+        with self.mutex:
+            self.expire_helper(time.monotonic())
+            # byte counts are sent as floats since they may overflow XML-RPC's 32 bit integers
+            return {
+                'entries': len(self.entries),
+                'bytes': float(self.used),
+                'capacity': float(self.capacity),
+                'max_bytes': float(self.max_used),
+                'rejected': self.rejected,
+                'expired': self.expired,
+            }
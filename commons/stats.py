@@ -0,0 +1,184 @@
+"""
+Lightweight instrumentation of the RPC servers: per method call counts, error counts,
+bytes in and out and latency histograms, and the time threads wait for the hot locks.
+"""
+import math
+import threading
+import time
+from typing import Dict, List
+
+# Histogram buckets grow by 2 ** (1 / BUCKETS_PER_DOUBLING), percentiles are exact to ~20%
+BUCKETS_PER_DOUBLING = 4
+BUCKETS = 32 * BUCKETS_PER_DOUBLING  # 1 us .. ~70 minutes
+
+
+class Histogram:
+    """Latency histogram with logarithmic buckets, from 1 microsecond up. Not thread safe."""
+    counts: List[int]
+
+    __slots__ = 'counts', 'count', 'total', 'max'
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0  # seconds
+        self.max = 0.0
+
+    def record(self, seconds):
+        micros = seconds * 1e6
+        bucket = int(math.log2(micros) * BUCKETS_PER_DOUBLING) if micros > 1 else 0
+        self.counts[min(bucket, BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, in seconds."""
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(2 ** ((bucket + 1) / BUCKETS_PER_DOUBLING) / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': float(self.count),
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class MethodStats:
+    __slots__ = 'calls', 'errors', 'bytes_in', 'bytes_out', 'latency'
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0  # calls that raised or returned an error
+        self.bytes_in = 0  # request bodies
+        self.bytes_out = 0  # response bodies
+        self.latency = Histogram()  # unmarshalling, call and marshalling
+
+
+class RpcStats:
+    """Statistics of the RPCs served by one server, by method name."""
+    methods: Dict[str, MethodStats]
+
+    __slots__ = 'lock', 'methods', 'started'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+        self.started = time.monotonic()
+
+    def record(self, method, seconds, bytes_in, bytes_out, error):
+        with self.lock:
+            stats = self.methods.get(method, None)
+            if stats is None:
+                stats = self.methods[method] = MethodStats()
+            stats.calls += 1
+            stats.errors += error
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+            stats.latency.record(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            # counters may exceed xmlrpc's 32 bit ints, they are sent as floats
+            return {method: {
+                'calls': float(stats.calls),
+                'errors': float(stats.errors),
+                'bytes_in': float(stats.bytes_in),
+                'bytes_out': float(stats.bytes_out),
+                'latency': stats.latency.snapshot(),
+            } for method, stats in sorted(self.methods.items())}
+
+
+def is_error(result):
+    """Whether an RPC result is an error: RPCs return errors as a string, alone or last in a tuple."""
+    if isinstance(result, tuple):
+        return len(result) > 1 and isinstance(result[-1], str) and bool(result[-1])
+    return isinstance(result, str) and bool(result)
+
+
+class InstrumentedLock:
+    """
+    A threading.Lock recording how long threads wait to acquire it. An uncontended
+    acquisition costs one extra call, only waits are timed. The counters are updated
+    while the lock is held, so they need no lock of their own.
+    """
+    __slots__ = 'lock', 'acquisitions', 'contended', 'wait'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0  # acquisitions that had to wait
+        self.wait = Histogram()  # of the contended acquisitions
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            self.acquisitions += 1
+            return True
+        if not blocking:
+            return False
+
+        start = time.perf_counter()
+        if not self.lock.acquire(True, timeout):
+            return False
+        self.wait.record(time.perf_counter() - start)
+        self.acquisitions += 1
+        self.contended += 1
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+    def snapshot(self):
+        return {
+            'acquisitions': float(self.acquisitions),
+            'contended': float(self.contended),
+            'wait_total': self.wait.total,
+            'wait': self.wait.snapshot(),
+        }
+
+
+def format_stats(stats):
+    """Text dump of the dict returned by the get_stats RPC."""
+    def ms(seconds):
+        return f'{seconds * 1e3:.3f}'
+
+    lines = [f"uptime {stats['uptime']:.0f}s, " +
+             ', '.join(f'{key} {value}' for key, value in sorted(stats['server'].items())), '']
+
+    lines.append(f"{'rpc':<32} {'calls':>10} {'errors':>8} {'bytes_in':>12} {'bytes_out':>12} "
+                 f"{'mean_ms':>9} {'p50_ms':>9} {'p90_ms':>9} {'p99_ms':>9} {'max_ms':>9}")
+    for method, rpc in stats['rpcs'].items():
+        latency = rpc['latency']
+        lines.append(f"{method:<32} {rpc['calls']:>10.0f} {rpc['errors']:>8.0f} {rpc['bytes_in']:>12.0f} "
+                     f"{rpc['bytes_out']:>12.0f} {ms(latency['mean']):>9} {ms(latency['p50']):>9} "
+                     f"{ms(latency['p90']):>9} {ms(latency['p99']):>9} {ms(latency['max']):>9}")
+
+    lines.append('')
+    lines.append(f"{'lock':<32} {'acquired':>10} {'contended':>10} {'wait_ms':>12} "
+                 f"{'p50_ms':>9} {'p99_ms':>9} {'max_ms':>9}")
+    for name, lock in stats['locks'].items():
+        wait = lock['wait']
+        lines.append(f"{name:<32} {lock['acquisitions']:>10.0f} {lock['contended']:>10.0f} "
+                     f"{ms(lock['wait_total']):>12} {ms(wait['p50']):>9} {ms(wait['p99']):>9} {ms(wait['max']):>9}")
+    return '\n'.join(lines)
@@ -3,10 +3,25 @@ import xmlrpc.client
 from cachetools import TTLCache
 
 
+class TimeoutTransport(xmlrpc.client.Transport):
+    """Transport whose socket operations give up after timeout seconds."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout  # used when the connection is opened
+        return connection
+
+
 # Helper functions
-def rpc_call(server_addr):
-    """A wrapper around the actual xmlrpc call to specified server address."""
+def rpc_call(server_addr, timeout=None):
+    """A wrapper around the actual xmlrpc call to specified server address.
+    Without a timeout a call to an unreachable server may block forever."""
     return xmlrpc.client.ServerProxy(server_addr,
+                                     transport=TimeoutTransport(timeout) if timeout else None,
                                      verbose=False,
                                      allow_none=True)
 
@@ -14,6 +29,7 @@ def rpc_call(server_addr):
 def pick_randomly(seq, n):
     """Randomly picks n elements from a given SEQuence and returns a LIST of picked elements."""
     import random
+    seq = list(seq)  # random.sample() does not accept sets anymore
     return random.sample(seq,
                          min(len(seq), n))
 
@@ -1,25 +1,39 @@
+import os
 import threading
-from xmlrpc.server import SimpleXMLRPCServer
+import time
+import xmlrpc.client
+from concurrent.futures import ThreadPoolExecutor
 
+from commons.errors import FileNotFoundErr, ShadowLaggingErr, ChunkHandleNotFoundErr
 from commons.loggers import default_logger, request_logger
-from commons.metadata_manager import load_metadata, update_metadata, OplogActions
-from commons.settings import CHUNK_SIZE, DEFAULT_MASTER_PORT, DEFAULT_IP, OP_LOG_FILENAME
+from commons.metadata_manager import load_metadata, OplogActions, load_checkpoint, take_checkpoint, apply_record, \
+    oplog_segments, OplogFollower, OplogGapError
+from commons.oplog import OplogWriter, OplogCorruptedError
+from commons.rpc_server import make_rpc_server
+from commons.settings import DEFAULT_MASTER_PORT, DEFAULT_IP, OP_LOG_FILENAME, CHECKPOINT_FILENAME, \
+    CHECKPOINT_INTERVAL, RPC_WORKERS, RPC_QUEUE_SIZE, MAX_LOCATIONS_BATCH, POLL_WORKERS, POLL_TIMEOUT, \
+    SHADOW_POLL_INTERVAL, SHADOW_MAX_LAG, SHADOW_REFRESH_INTERVAL
+from commons.utils import rpc_call
 from master.chunk_manager import ChunkManager
 from master.namespace_manager import NamespaceManager
+from master.placement import PLACEMENT_POLICIES
 
 
 class Master:
     __slots__ = 'my_addr', 'client_id', 'mutex', \
-                'metadata_file', 'namespace_manager', 'chunk_manager'
+                'metadata_file', 'oplog', 'checkpoint_file', 'checkpoint_epoch', 'namespace_manager', 'chunk_manager'
 
-    def __init__(self, my_addr, metadata_file):
+    def __init__(self, my_addr, metadata_file, checkpoint_file, placement=None):
         self.my_addr = my_addr
         self.client_id = 0  # counter to give next client ID
         self.mutex = threading.Lock()  # TODO: probably use a re entrant lock
         self.metadata_file = metadata_file  # File that contains masters metadata
+        self.oplog = OplogWriter(metadata_file)  # Appends to metadata_file with group commit
+        self.checkpoint_file = checkpoint_file  # Binary snapshot of masters metadata
+        self.checkpoint_epoch = 0  # epoch of the latest durable checkpoint
 
         self.namespace_manager = NamespaceManager()
-        self.chunk_manager = ChunkManager()
+        self.chunk_manager = ChunkManager(placement)
 
     def __repr__(self):
         return f"""Master(me={self.my_addr},
@@ -40,11 +54,13 @@ class Master:
 
         with self.mutex:
             self.client_id += 1
+            client_id = self.client_id
 
-            # make client id persistent in metadata file
-            update_metadata(self.metadata_file, OplogActions.GRANT_CLIENT_ID, self.client_id)
+        # make client id persistent in metadata file
+        # outside the mutex, so that concurrent grants share a single fsync
+        self.oplog.append(OplogActions.GRANT_CLIENT_ID, client_id)
 
-            return self.client_id
+        return client_id
 
     def create(self, path):
         """
@@ -53,13 +69,9 @@ class Master:
         :return: True if successful and errors if any.
         """
         rlog.info("args: path=%s", path)
-        res, err = self.namespace_manager.create(path)
-
-        if not err:
-            # Log this operation to oplog
-            update_metadata(self.metadata_file, OplogActions.CREATE_FILE, path)
-
-        return res, err
+        # Log this operation to oplog, with the path locked so that it is logged in the order
+        # of the deletes and creates of the same path
+        return self.namespace_manager.create(path, lambda: self.oplog.append(OplogActions.CREATE_FILE, path))
 
     def add_chunk(self, path, chunk_index):
         """
@@ -69,13 +81,20 @@ class Master:
         :return: chunk_handle of the chunk created and address of chunkservers containing that chunk
         """
         rlog.info("args: path=%s, chunk_index=%d", path, chunk_index)
-        info, err = self.chunk_manager.add_chunk(path, chunk_index)
-        if err:
-            return None, None, err
+        # the file stays locked until the chunk is logged, so that snapshots and deletes
+        # of the file are logged either before or after it
+        with self.namespace_manager.path_locks.lock(path):
+            file_id = self.namespace_manager.file_id_helper(path)
+            if file_id is None:
+                return None, None, FileNotFoundErr
 
-        # Log this operation to oplog
-        update_metadata(self.metadata_file, OplogActions.ADD_CHUNK,
-                        (path, chunk_index, info.chunk_handle, info.chunk_locations, info.chunk_handle))
+            info, err = self.chunk_manager.add_chunk(file_id, chunk_index)
+            if err:
+                return None, None, err
+
+            # Log this operation to oplog
+            self.oplog.append(OplogActions.ADD_CHUNK,
+                              (path, chunk_index, info.chunk_handle, info.chunk_locations, info.chunk_handle))
 
         return info.chunk_handle, info.chunk_locations, None
 
@@ -87,10 +106,90 @@ class Master:
         :return: chunk_info {chunk_handle, chunk_locations} and errors.
         """
         rlog.info("args: path=%s, chunk_index=%d", path, chunk_index)
-        chunk_locations, chunk_handle, err = self.chunk_manager.find_locations(path, chunk_index)
+        # file ids are reused, the file must not be deleted before its chunks are looked up
+        with self.namespace_manager.path_locks.lock(path):
+            file_id = self.namespace_manager.file_id_helper(path)
+            if file_id is None:
+                return None, None, FileNotFoundErr
+
+            chunk_locations, chunk_handle, err = self.chunk_manager.find_locations(file_id, chunk_index)
 
         return chunk_locations, chunk_handle, err
 
+    def find_locations_range(self, path, start_index, count):
+        """
+        Batched find_locations: returns handles, locations and current lease holders
+        of up to `count` chunks starting at chunk index start_index, in one round trip.
+        :param path:
+        :param start_index:
+        :param count: capped to MAX_LOCATIONS_BATCH
+        :return: list of {chunk_index, chunk_handle, chunk_locations, primary, lease_ends} and errors.
+        """
+        rlog.info("args: path=%s, start_index=%d, count=%d", path, start_index, count)
+        with self.namespace_manager.path_locks.lock(path):  # see find_locations
+            file_id = self.namespace_manager.file_id_helper(path)
+            if file_id is None:
+                return [], FileNotFoundErr
+
+            chunks, err = self.chunk_manager.find_locations_range(file_id, start_index,
+                                                                  min(count, MAX_LOCATIONS_BATCH))
+
+        return chunks, err
+
+    def snapshot(self, src, dst):
+        """
+        Will be called by client to copy a file or a directory tree to dst, copy on write:
+        the copies share the chunks of src, a chunk is only copied (locally on the chunk
+        servers) when it is first written through any of the files sharing it.
+        :return: True if successful and errors if any.
+        """
+        rlog.info("args: src=%s, dst=%s", src, dst)
+        shared = []
+
+        def share(files):
+            shared.extend(self.chunk_manager.share_chunks(files))
+
+        def copied():
+            # logged while src and dst are locked, before creates under dst or new chunks of src
+            self.oplog.append(OplogActions.SNAPSHOT, (src, dst))
+
+        # the chunk metadata of the copies is complete before anyone can look them up
+        res, err = self.namespace_manager.copy(src, dst, share, copied)
+        # the chunk servers refuse to write the shared chunks in place from now on, told once
+        # the paths are unlocked (the leases on the chunks are revoked already)
+        if shared:
+            self.chunk_manager.mark_shared(shared)
+        return res, err
+
+    def copy_on_write(self, path, chunk_index):
+        """
+        Client calls it when find_lease_holder reports that the chunk it wants to write is shared
+        with a snapshot. The file gets its own copy of the chunk, made by the chunk servers.
+        :return: chunk_handle and locations of the chunk to write and errors.
+        """
+        rlog.info("args: path=%s, chunk_index=%d", path, chunk_index)
+        ns = self.namespace_manager
+        with ns.path_locks.lock(path):
+            file_id = ns.file_id_helper(path)
+        if file_id is None:
+            return None, None, FileNotFoundErr
+
+        def copied(info, commit):
+            # the file is not locked while the chunk servers copy the chunk, it may have been deleted
+            # (and its id reused) meanwhile. Locked until the copy is logged, like in add_chunk.
+            with ns.path_locks.lock(path):
+                if ns.file_id_helper(path) != file_id or not commit():
+                    return False
+                # the copy replaces the shared chunk in this file only
+                self.oplog.append(OplogActions.ADD_CHUNK,
+                                  (path, chunk_index, info.chunk_handle, info.chunk_locations, info.chunk_handle))
+                return True
+
+        info, err = self.chunk_manager.copy_on_write(file_id, chunk_index, path, copied)
+        if err:
+            return None, None, err
+        return info.chunk_handle, info.chunk_locations, None
+
     def find_lease_holder(self, chunk_handle):
         """
         Client calls to get the PRIMARY chunk server for a given chunk handle.
@@ -121,56 +220,62 @@ class Master:
             f"received request from chunk server:{server} with args: "
             f"chunk_handle={chunk_handle}, length={length}, chunk_index={chunk_index}, path={path}")
 
-        # FIXME: path_index looks unnecessary :/
-        path_index, err = self.chunk_manager.get_path_index_from_handle(chunk_handle)
-
-        if err:
-            return None, err
-
-        assert path_index.index == chunk_index
-
-        self.chunk_manager.set_chunk_location(chunk_handle, server)
-
-        # Update file size information
-        file_length, err = self.namespace_manager.get_file_length(path_index.path)
-
-        new_length = CHUNK_SIZE * path_index.index + length
+        return self.report_chunk_helper(server, chunk_handle, chunk_index, length)
 
-        log.debug(f"new calculated file size= {new_length},  "
-                  f"old_file_size={file_length}, "
-                  f"this chunk's size={length}, "
-                  f"chunk index={path_index.index}")
-
-        if new_length > file_length:
-            self.namespace_manager.set_file_length(path_index.path, new_length)
+    def report_chunks(self, server, reports):
+        """
+        Called by chunk servers with the chunks that grew, in batches.
+        :param server: http://<ip_addr>:<port>
+        :param reports: [[chunk_handle, chunk_index, length]] the latest length of each chunk
+        :return: [chunk_handle] of the chunks unknown to the master (deleted meanwhile)
+        """
+        rlog.debug("received %d chunk reports from chunk server %s", len(reports), server)
+        return self.report_chunks_helper(server, reports)
 
+    # Record a replica of a chunk and grow the file to the chunk's length.
+    def report_chunk_helper(self, server, chunk_handle, chunk_index, length):
+        if self.report_chunks_helper(server, [(chunk_handle, chunk_index, length)]):
+            return None, ChunkHandleNotFoundErr
         return None
 
+    # Record the replicas of many chunks and grow the files to their lengths, taking the
+    # locks of the chunk manager and of the namespace once. Returns the unknown chunk handles.
+    def report_chunks_helper(self, server, reports):
+        # the files can't be deleted (and their ids reused) until they are grown
+        with self.namespace_manager.mutex:
+            file_lengths, unknown = self.chunk_manager.chunks_reported(server, reports)
+            # Update file size information of every file sharing the chunks
+            self.namespace_manager.extend_file_lengths_helper(file_lengths)
+        return unknown
+
     def create_dir(self, path):
         """Will be called by client to create a dir in the namespace"""
         rlog.info("CREATE DIR API called")
-        res, err = self.namespace_manager.create_dir(path)
-        if not err:
-            update_metadata(self.metadata_file, OplogActions.CREATE_DIR, path)
-
-        return res, err
+        # logged with the path locked, see create
+        return self.namespace_manager.create_dir(path, lambda: self.oplog.append(OplogActions.CREATE_DIR, path))
 
-    def list_allfiles(self, path):
-        """Will be called by client to list all files present in given directory path"""
+    def list_allfiles(self, path, cursor=None, limit=None):
+        """
+        Will be called by client to list all files present in given directory path.
+        Huge directories can be streamed page by page: at most `limit` files
+        (sorted by path) are returned, starting after `cursor`, which is the
+        last path of the previous page.
+        """
         rlog.info("LIST FILES API called")
-        res, err = self.namespace_manager.list_allfiles(path)
+        res, err = self.namespace_manager.list_allfiles(path, cursor, limit)
         return res, err
 
     def delete(self, path):
         """Will be called by client to delete a specific file"""
         rlog.info("DELETE FILE API called")
-        self.chunk_manager.update_deletechunk_list(path)
-        err = self.namespace_manager.delete(path)
 
-        if not err:
-            update_metadata(self.metadata_file, OplogActions.DELETE_FILE, path)
+        # with the file locked, so that no chunk is added meanwhile, and logged before the path is created again
+        def delete(file_id):
+            if file_id is not None:
+                self.chunk_manager.update_deletechunk_list(file_id)
+            self.oplog.append(OplogActions.DELETE_FILE, path)
 
-        return err
+        return self.namespace_manager.delete(path, delete)
 
     def get_file_length(self, path):
         """Will be called by client to get the file length"""
@@ -185,49 +290,295 @@ class Master:
         Then master adds this address to its chunkserver list
         :param chunk_handles: list of chunk handles at that chunk server
         :param chunksrv_addr: http://<ip_addr>:<port>
-        :return: None
+        :return: [chunk_handle] of the chunks shared with snapshots, the chunk server must not mutate them
         """
         rlog.info("Received registration request from chunk server at: %s", chunksrv_addr)
-        self.chunk_manager.update_chunkserver_list(chunksrv_addr)
-
-        for chunk_handle in chunk_handles:
-            self.chunk_manager.set_chunk_location(chunk_handle, chunksrv_addr)
+        self.chunk_manager.update_chunkserver_list(chunksrv_addr, len(chunk_handles))
+        shared = self.chunk_manager.register_chunks(chunksrv_addr, chunk_handles)
         # Log this operation to oplog
-        update_metadata(self.metadata_file, OplogActions.NOTIFY_MASTER, chunksrv_addr)
+        self.oplog.append(OplogActions.NOTIFY_MASTER, chunksrv_addr)
+        return shared
 
-    def heartbeat(self):
-        import threading
-        bg_thread = threading.Thread(target=self.chunk_manager.beat, args=())
+    def heartbeat(self, chunksrv_addr, report):
+        """
+        Called periodically by chunk servers to prove they are alive.
+        :param chunksrv_addr: http://<ip_addr>:<port>
+        :param report: {chunks: [[chunk_handle, chunk_index, length]] new or grown since the previous heartbeat,
+                        deleted: [chunk_handle] removed since the previous heartbeat,
+                        corrupt: [chunk_handle] replicas whose checksums do not match,
+                        lease_extensions: [chunk_handle] of chunks being mutated while this server is primary,
+                        stats: {disk_total, disk_used, chunk_count, write_load}}
+        :return: {registered, delete: [chunk_handle] next batch of garbage, acknowledged by reporting them as deleted,
+                  leases: [[chunk_handle, expiration]]}
+            If not registered the chunk server must call notify_master again with all its chunks.
+        """
+        rlog.debug("heartbeat of %s: %s", chunksrv_addr, report)
+        if not self.chunk_manager.heartbeat(chunksrv_addr):
+            log.info("Heartbeat from unregistered chunk server %s", chunksrv_addr)
+            return {'registered': False, 'delete': [], 'leases': []}
+
+        self.chunk_manager.update_server_stats(chunksrv_addr, report['stats'])
+
+        # deletions first: they acknowledge pending garbage before the next batch is picked
+        self.chunk_manager.chunks_deleted(chunksrv_addr, report['deleted'])
+
+        # unknown chunk handles, their files have been deleted
+        orphans = self.report_chunks_helper(chunksrv_addr, report['chunks'])
+        self.chunk_manager.add_orphans(chunksrv_addr, orphans)
+        self.chunk_manager.corrupt_replicas_found(chunksrv_addr, report.get('corrupt', ()))
+
+        leases = self.chunk_manager.extend_leases(chunksrv_addr, report['lease_extensions'])
+
+        return {'registered': True, 'delete': self.chunk_manager.garbage_batch(chunksrv_addr), 'leases': leases}
+
+    def get_replication_status(self):
+        """
+        Progress of re-replication.
+        :return: {under_replicated, by_missing_replicas, queued, in_flight, completed, failed, abandoned, bytes_copied}
+        """
+        return self.chunk_manager.replication.status()
+
+    def get_rebalance_status(self):
+        """
+        Balance of the cluster and progress of rebalancing.
+        :return: {imbalance: coefficient of variation of the chunk counts (0 is balanced), max_over_mean,
+                  chunks_per_server, disk_utilization, rounds, in_flight, moved, failed, aborted, skipped_leased,
+                  bytes_moved}
+        """
+        return self.chunk_manager.rebalancer.status()
+
+    def get_gc_status(self):
+        """
+        Garbage collection of deleted chunks.
+        :return: {backlog: replicas waiting for deletion, backlog_per_server, collected, orphans_found,
+                  corrupt_replicas: replicas dropped because their checksums did not match}
+        """
+        return self.chunk_manager.gc_status()
+
+    def get_poll_status(self):
+        """
+        Progress of rebuilding the chunk locations from the chunk servers after the master started.
+        Locations returned before convergence may miss replicas of servers not polled yet.
+        :return: {converged, servers, polled, failed: [chunk server], pending, seconds, chunks,
+                  chunks_without_replicas}
+        """
+        return self.chunk_manager.poll_progress()
+
+    def monitor_chunkservers(self):
+        """Start re-replication, rebalancing and the detection of chunk servers that stopped sending heartbeats."""
+        self.chunk_manager.replication.start()
+        self.chunk_manager.rebalancer.start()
+
+        bg_thread = threading.Thread(target=self.chunk_manager.detect_failures, args=())
         # Run the thread in daemon mode.
         # This allows the main application to exit even though the thread is running.
         # It will also (therefore) make it possible to use ctrl+c to terminate the application.
         bg_thread.daemon = True
         bg_thread.start()
 
+    def checkpoint(self, interval):
+        """Periodically checkpoint master's metadata in a background thread."""
+        def checkpoint_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    take_checkpoint(self)
+                except OSError as err:
+                    log.error("Checkpoint failed: %s", err)
+
+        bg_thread = threading.Thread(target=checkpoint_loop, args=(), daemon=True)
+        bg_thread.start()
 
-def start_master(ip, port):
-    m = Master(f'http://{ip}:{port}', OP_LOG_FILENAME)
 
-    # restore previous launch's meta data
+class ShadowMaster:
+    """
+    Read only replica of a master, serving metadata lookups to spread their load.
+    It loads the master's checkpoint, then follows the master's oplog and applies
+    every logged mutation to its own namespace and chunk manager. Chunk locations
+    and file lengths are not logged, the shadow polls the chunk servers for them.
+    Lookups are refused while the shadow is more than SHADOW_MAX_LAG seconds behind
+    the oplog, clients then ask the master.
+    """
+    __slots__ = 'my_addr', 'client_id', 'metadata_file', 'checkpoint_file', 'checkpoint_epoch', \
+                'namespace_manager', 'chunk_manager', 'follower', 'caught_up', 'applied'
+
+    def __init__(self, my_addr, metadata_file, checkpoint_file):
+        self.my_addr = my_addr
+        self.metadata_file = metadata_file  # oplog of the master, never written
+        self.checkpoint_file = checkpoint_file
+        self.follower = None
+        self.caught_up = float('-inf')  # when the whole oplog had been applied last
+        self.applied = 0  # oplog records applied while following
+        self.reset_helper()
+
+    def __repr__(self):
+        return f"""ShadowMaster(me={self.my_addr},
+        namespace_manager={self.namespace_manager},
+        chunk_manager={self.chunk_manager})"""
+
+    def reset_helper(self):
+        self.client_id = 0
+        self.checkpoint_epoch = 0
+        self.namespace_manager = NamespaceManager()
+        self.chunk_manager = ChunkManager()
+
+    def test_ok(self):
+        """A quick test to see if server is working fine"""
+        return "Ok"
+
+    def lagging(self):
+        return time.monotonic() - self.caught_up > SHADOW_MAX_LAG
+
+    def find_locations(self, path, chunk_index):
+        """See Master.find_locations, the chunk locations may be SHADOW_REFRESH_INTERVAL seconds old."""
+        if self.lagging():
+            return None, None, ShadowLaggingErr
+        return Master.find_locations(self, path, chunk_index)
+
+    def find_locations_range(self, path, start_index, count):
+        """See Master.find_locations_range, shadows know no lease holders."""
+        if self.lagging():
+            return [], ShadowLaggingErr
+        return Master.find_locations_range(self, path, start_index, count)
+
+    def get_file_length(self, path):
+        """See Master.get_file_length, the length may be SHADOW_REFRESH_INTERVAL seconds old."""
+        if self.lagging():
+            return 0, ShadowLaggingErr
+        return Master.get_file_length(self, path)
+
+    def list_allfiles(self, path, cursor=None, limit=None):
+        """See Master.list_allfiles."""
+        if self.lagging():
+            return [], ShadowLaggingErr
+        return Master.list_allfiles(self, path, cursor, limit)
+
+    def get_shadow_status(self):
+        """
+        :return: {lagging, seconds_behind: since the whole oplog had been applied last,
+                  applied: oplog records applied since started, checkpoint_epoch, paths, chunks}
+        """
+        return {
+            'lagging': self.lagging(),
+            'seconds_behind': min(time.monotonic() - self.caught_up, 1e9),
+            'applied': self.applied,
+            'checkpoint_epoch': self.checkpoint_epoch,
+            'paths': len(self.namespace_manager.inodes),
+            'chunks': len(self.chunk_manager.table),
+        }
+
+    def load(self):
+        """(Re)loads the master's latest checkpoint and starts following its oplog right after it."""
+        while True:
+            self.reset_helper()
+            try:
+                live = os.stat(self.metadata_file)
+                load_checkpoint(self, read_only=True)
+                follower = OplogFollower(self.metadata_file)
+            except FileNotFoundError as err:
+                # the master has not started yet, or a checkpoint removed a segment meanwhile
+                log.info("Unable to load the metadata of the master: %s", err)
+                time.sleep(1)
+                continue
+
+            # the live oplog must directly follow the loaded segments: retry if it was rotated meanwhile
+            if follower.is_following(live) and all(epoch <= self.checkpoint_epoch
+                                                   for epoch, _ in oplog_segments(self.metadata_file)):
+                self.follower = follower
+                log.info("Loaded checkpoint %d of the master, following its oplog", self.checkpoint_epoch)
+                return
+
+            follower.close()
+            log.debug("The oplog of the master was rotated while loading, retrying")
+
+    def follow(self, interval):
+        """Applies the records appended to the master's oplog, every interval seconds."""
+        while True:
+            polled = time.monotonic()
+            try:
+                records = self.follower.poll()
+            except (OplogGapError, OplogCorruptedError, OSError) as err:
+                log.warning("Lost track of the oplog of the master (%s), reloading its checkpoint", err)
+                self.caught_up = float('-inf')
+                self.follower.close()
+                self.load()
+                continue
+
+            if records:
+                ns, cm = self.namespace_manager, self.chunk_manager
+                # lookups see either none or all of the records of a poll
+                with ns.freeze(), ns.mutex, cm.lock:
+                    for key, value in records:
+                        apply_record(self, key, value)
+                self.applied += len(records)
+            self.caught_up = polled
+            time.sleep(interval)
+
+    def refresh_locations(self, interval):
+        """Polls the chunk servers for their chunks every interval seconds."""
+        with ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix='refresh') as pool:
+            while True:
+                with self.chunk_manager.lock:
+                    chunk_servers = list(self.chunk_manager.active_chunk_servers)
+                list(pool.map(self.refresh_chunkserver, chunk_servers))
+                time.sleep(interval)
+
+    def refresh_chunkserver(self, chunk_server):
+        handle_limit = self.chunk_manager.chunk_handle
+        try:
+            report = rpc_call(chunk_server, POLL_TIMEOUT).get_chunk_report()
+        except (OSError, xmlrpc.client.Error) as err:
+            # polled again next time, the master tells if it is back
+            log.info("Polling failed for chunkserver %s: %s", chunk_server, err)
+            report = []
+
+        self.chunk_manager.replace_locations(chunk_server, [chunk_handle for chunk_handle, _, _ in report],
+                                             handle_limit)
+        # file lengths are only known to the master from chunk reports
+        self.report_chunks_helper(chunk_server, report)
+
+    report_chunks_helper = Master.report_chunks_helper
+
+    def start(self):
+        self.load()
+        threading.Thread(target=self.follow, args=(SHADOW_POLL_INTERVAL,), daemon=True).start()
+        threading.Thread(target=self.refresh_locations, args=(SHADOW_REFRESH_INTERVAL,), daemon=True).start()
+
+
+def start_shadow_master(ip, port, metadata_file, checkpoint_file, workers, queue_size):
+    shadow = ShadowMaster(f'http://{ip}:{port}', metadata_file, checkpoint_file)
+    shadow.start()
+
+    shadow_server = make_rpc_server(ip, port, shadow, workers, queue_size,
+                                    {'ChunkManager.lock': shadow.chunk_manager.lock,
+                                     'NamespaceManager.mutex': shadow.namespace_manager.mutex})
+
+    print("Shadow master running at: ", shadow.my_addr)
+
+    shadow_server.serve_forever()
+
+
+def start_master(ip, port, metadata_file, checkpoint_file, checkpoint_interval, workers, queue_size, placement):
+    m = Master(f'http://{ip}:{port}', metadata_file, checkpoint_file, PLACEMENT_POLICIES[placement]())
+
+    # restore previous launch's meta data:
+    # the latest checkpoint first, then only the oplog written after it
+    recovery_start = time.perf_counter()
+    load_checkpoint(m)
     load_metadata(m)
+    log.info("Master recovered in %.3f seconds", time.perf_counter() - recovery_start)
 
-    # one time polling to get the list of chunks from each chunk server
+    # one time polling to get the list of chunks from each chunk server,
+    # in the background: metadata is served while the chunk locations fill in
     m.chunk_manager.poll_chunkservers()
 
-    # call heartbeat
-    m.heartbeat()
-
-    master_server = SimpleXMLRPCServer((ip, port),
-                                       logRequests=True,
-                                       allow_none=True)
+    m.monitor_chunkservers()
 
-    # Read: https://gist.github.com/abnvanand/199cacf6c8f45258ff096b842b77b216
-    master_server.register_introspection_functions()
+    m.checkpoint(checkpoint_interval)
 
-    # register all methods to be available to client
-    # can either use register_function(<function's_name>)
-    # or register_instance(<class's_instance>)  # All the methods of the instance are published as XML-RPC methods
-    master_server.register_instance(m)
+    master_server = make_rpc_server(ip, port, m, workers, queue_size,
+                                    {'ChunkManager.lock': m.chunk_manager.lock,
+                                     'NamespaceManager.mutex': m.namespace_manager.mutex})
 
     print("Master running at: ", m.my_addr)
 
@@ -236,15 +587,30 @@ def start_master(ip, port):
     # TODO: launch background tasks (eg. gc, heartbeat) in a separate thread
 
 
-if __name__ == '__main__':
-    log = default_logger
-    rlog = request_logger
+log = default_logger
+rlog = request_logger
 
+if __name__ == '__main__':
     import argparse
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--ip', default=DEFAULT_IP)
     parser.add_argument('--port', type=int, default=DEFAULT_MASTER_PORT)
+    parser.add_argument('--checkpoint-interval', type=int, default=CHECKPOINT_INTERVAL,
+                        help="seconds between two checkpoints of master's metadata")
+    parser.add_argument('--workers', type=int, default=RPC_WORKERS, help="number of threads serving RPCs")
+    parser.add_argument('--queue-size', type=int, default=RPC_QUEUE_SIZE,
+                        help="number of RPCs that may wait for a free worker before backpressure kicks in")
+    parser.add_argument('--placement', choices=sorted(PLACEMENT_POLICIES), default='load_aware',
+                        help="policy used to place replicas of new chunks")
+    parser.add_argument('--oplog', default=OP_LOG_FILENAME, help="oplog of the master")
+    parser.add_argument('--checkpoint', default=CHECKPOINT_FILENAME, help="checkpoint file of the master")
+    parser.add_argument('--shadow', action='store_true',
+                        help="run a read only shadow master following the oplog and checkpoints of a master")
     args = parser.parse_args()
 
-    start_master(args.ip, args.port)
+    if args.shadow:
+        start_shadow_master(args.ip, args.port, args.oplog, args.checkpoint, args.workers, args.queue_size)
+    else:
+        start_master(args.ip, args.port, args.oplog, args.checkpoint, args.checkpoint_interval, args.workers,
+                     args.queue_size, args.placement)
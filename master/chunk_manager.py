@@ -1,27 +1,29 @@
 import random
 import threading
 import time
+import xmlrpc.client
 from collections import defaultdict
-from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
 from typing import List, Dict, Set
 
 from commons.errors import FileNotFoundErr, ChunkAlreadyExistsErr, ChunkhandleDoesNotExistErr, NoChunkServerAliveErr, \
-    ChunkHandleNotFoundErr
+    ChunkHandleNotFoundErr, ChunkIsSharedErr, MasterPollingErr
 from commons.loggers import default_logger
-from commons.settings import REPLICATION_FACTOR, HEARTBEAT_INTERVAL
-from commons.utils import pick_randomly, rpc_call
+from commons.settings import CHUNK_SIZE, REPLICATION_FACTOR, HEARTBEAT_TIMEOUT, GC_BATCH_SIZE, POLL_WORKERS, \
+    POLL_TIMEOUT, COPY_ON_WRITE_TIMEOUT, SHARE_TIMEOUT
+from commons.stats import InstrumentedLock
+from commons.utils import rpc_call
+from master.chunk_table import ChunkTable
+from master.failure_detector import FailureDetector
+from master.placement import LoadAwarePlacement, ServerStats
+from master.rebalancer import Rebalancer
+from master.replication import ReplicationScheduler
 
 LEASE_TIMEOUT = 60  # expires in 1 minute
 
 
-class Chunk:
-    chunk_handle: int
-    __slots__ = 'chunk_handle'
-
-    def __init__(self, chunk_handle=0):
-        self.chunk_handle = chunk_handle
-
-
 # In-memory detailed information of a specific chunk.
 class ChunkInfo:
     chunk_locations: List[str]
@@ -36,13 +38,13 @@ class ChunkInfo:
         return f'ChunkInfo(chunk_handle={self.chunk_handle}, chunk_locations={self.chunk_locations})'
 
 
-class PathIndex:
+class FileIndex:
     index: int
-    path: str
-    __slots__ = 'path', 'index'
+    file_id: int
+    __slots__ = 'file_id', 'index'
 
-    def __init__(self, path="", index=0):
-        self.path = path
+    def __init__(self, file_id=0, index=0):
+        self.file_id = file_id  # inode id of the file in the namespace
         self.index = index
 
 
@@ -56,86 +58,147 @@ class Lease:
         self.expiration = 0  # Lease expiration time.
 
 
+class PollStatus:
+    """Progress of rebuilding the chunk locations from the chunk servers after a (re)start."""
+    failed: List[str]
+
+    __slots__ = 'servers', 'pending', 'polled', 'failed', 'started', 'finished', 'converged'
+
+    def __init__(self):
+        self.servers = 0  # chunk servers to poll
+        self.pending = 0  # chunk servers that have not answered or failed yet
+        self.polled = 0
+        self.failed = []  # chunk servers that did not answer in time
+        self.started = self.finished = time.monotonic()
+        self.converged = threading.Event()  # set once every chunk server answered or failed
+        self.converged.set()  # nothing to poll yet
+
+    def begin(self, servers):
+        self.servers = self.pending = servers
+        self.polled = 0
+        self.failed = []
+        self.started = time.monotonic()
+        self.converged.clear()
+
+
 class ChunkManager:
-    lock: Lock
+    lock: InstrumentedLock
     chunk_handle: int
-    chunks: Dict[str, Dict[int, Chunk]]
-    handles: Dict[int, PathIndex]
-    locations: Dict[int, ChunkInfo]
+    table: ChunkTable
     active_chunk_servers: Set[str]
     leases: Dict[int, Lease]
-    chunks_to_delete: List[int]
-    chunks_of_chunk_server: Dict[str, List[int]]
+    garbage: Dict[str, Set[int]]
+    server_stats: Dict[str, ServerStats]
 
-    __slots__ = 'lock', 'chunk_handle', 'chunks', 'handles', 'locations', 'active_chunk_servers', \
-                'leases', 'chunks_to_delete', 'chunks_of_chunk_server'
+    __slots__ = 'lock', 'chunk_handle', 'table', 'active_chunk_servers', 'leases', \
+                'garbage', 'garbage_collected', 'orphans_found', 'corrupt_replicas', 'placement', 'server_stats', \
+                'replication', 'rebalancer', 'failure_detector', 'poll_status', 'claims', 'claimed'
 
-    def __init__(self):
-        self.lock = threading.Lock()
+    def __init__(self, placement=None):
+        self.lock = InstrumentedLock()  # wait times are reported by get_stats
         self.chunk_handle = 0  # incremented by 1 whenever a new chunk is created
 
-        # (path, chunk index) -> chunk information (persistent)
-        self.chunks = {}
-        # chunk handle -> (path, chunk index) (inverse of chunks)
-        self.handles = {}
-        # chunk handle -> chunk locations (in-memory)
-        self.locations = {}
+        # (file id, chunk index) <-> chunk handle (persistent) and chunk handle -> chunk locations (in-memory),
+        # plus the chunks of every chunk server
+        self.table = ChunkTable(REPLICATION_FACTOR)
         # a list if chunk servers
         self.active_chunk_servers = set()
         #  chunk handle -> lease
         self.leases = {}
-        # a list of chunk handles to be deleted
-        self.chunks_to_delete = []
-        self.chunks_of_chunk_server = defaultdict(list)
+        # chunk server -> handles of replicas it has to delete, until it acknowledges the deletion
+        self.garbage = defaultdict(set)
+        self.garbage_collected = 0  # deletions acknowledged by chunk servers
+        self.orphans_found = 0  # replicas of chunks unknown to the master, reported by chunk servers
+        self.corrupt_replicas = 0  # replicas found corrupt by their chunk servers
+        # decides where replicas of new chunks go, using the load reported by chunk servers
+        self.placement = placement or LoadAwarePlacement()
+        self.server_stats = {}
+        # restores the replication goal of chunks that lost replicas
+        self.replication = ReplicationScheduler(self)
+        # spreads existing replicas over chunk servers that joined later
+        self.rebalancer = Rebalancer(self)
+        # chunk servers that stop sending heartbeats are declared dead
+        self.failure_detector = FailureDetector(HEARTBEAT_TIMEOUT)
+        # chunk locations are only complete once every chunk server has been polled
+        self.poll_status = PollStatus()
+        # serializes the copies on write of a chunk, so that concurrent writers copy it once, and
+        # the RPCs marking it as shared on its chunk servers, without holding a lock during RPCs
+        self.claims = threading.Condition(threading.Lock())  # protects claimed
+        self.claimed = set()  # handles of the chunks being copied or marked
 
     def __repr__(self):
         return f""" ChunkManager(chunk_handle={self.chunk_handle},
-                                 chunks={self.chunks},
-                                 handles={self.handles},
-                                 locations={self.locations},
+                                 chunks={len(self.table)},
                                  chunk_servers={self.active_chunk_servers}
                                  leases={self.leases})"""
 
-    def find_locations(self, path, chunk_index):
+    def find_locations(self, file_id, chunk_index):
         with self.lock:
-            chunk_locations, chunk_handle, err = self.get_chunk_info(path, chunk_index)
+            chunk_locations, chunk_handle, err = self.get_chunk_info(file_id, chunk_index)
             return chunk_locations, chunk_handle, err
 
     # Assumes lock is acquired
     # Get chunk information associated with a file and a chunk index.
     # Returns chunk information and errors.
-    def get_chunk_info(self, path, chunk_index):
-        value = self.chunks.get(path, None)
-        if not value:
+    def get_chunk_info(self, file_id, chunk_index):
+        if not self.table.has_file(file_id):
             log.debug(FileNotFoundErr)
             return None, None, FileNotFoundErr
 
-        chunk = value.get(chunk_index, None)
-        if not chunk:
+        chunk_handle = self.table.handle_of(file_id, chunk_index)
+        if chunk_handle is None:
             log.debug("Chunk index not found.")
             return None, None, "Chunk index not found."
 
-        chunk_info = self.locations.get(chunk.chunk_handle, None)
-        if not chunk_info:
-            log.debug("Locations not found.")
-            return None, None, "Locations not found"
-
-        return chunk_info.chunk_locations, chunk_info.chunk_handle, None
+        return self.table.locations(chunk_handle), chunk_handle, None
 
-    def add_chunk(self, path, chunk_index):
+    def find_locations_range(self, file_id, start_index, count):
+        """
+        Chunk information of chunks start_index .. start_index + count - 1 of a file,
+        looked up under a single lock acquisition. Chunks that do not exist are skipped.
+        Lease holders are only reported for unexpired leases, no new lease is granted.
+        """
         with self.lock:
-            return self.add_chunk_helper(path, chunk_index)
+            if not self.table.has_file(file_id):
+                return [], FileNotFoundErr
+
+            now = time.time()
+            chunks = []
+            for chunk_index in range(start_index, start_index + count):
+                chunk_handle = self.table.handle_of(file_id, chunk_index)
+                if chunk_handle is None:
+                    continue
+
+                lease = self.leases.get(chunk_handle, None)
+                valid_lease = lease and lease.expiration >= now
+                chunks.append({
+                    'chunk_index': chunk_index,
+                    'chunk_handle': chunk_handle,
+                    'chunk_locations': self.table.locations(chunk_handle),
+                    'primary': lease.primary if valid_lease else None,
+                    'lease_ends': lease.expiration if valid_lease else None,
+                })
+
+            return chunks, None
+
+    def add_chunk(self, file_id, chunk_index):
+        if not self.poll_status.converged.is_set():
+            # replicas of servers not polled yet would be missing, see find_lease_holder
+            return None, MasterPollingErr
+        with self.lock:
+            return self.add_chunk_helper(file_id, chunk_index)
 
     # Assumes lock is acquired
-    def add_chunk_helper(self, path, chunk_index):
-        chunk = self.chunks.get(path, None)
-        if not chunk:
-            self.chunks[path] = {}
-
-        chunk_info = self.chunks[path].get(chunk_index, None)
-        if chunk_info:
+    def add_chunk_helper(self, file_id, chunk_index):
+        chunk_handle = self.table.handle_of(file_id, chunk_index)
+        if chunk_handle is not None:
             log.debug("Chunk index already exists.")
-            return chunk_info, ChunkAlreadyExistsErr
+            return ChunkInfo(chunk_handle, self.table.locations(chunk_handle)), ChunkAlreadyExistsErr
+
+        locations = self.placement.place(list(self.active_chunk_servers), REPLICATION_FACTOR, self.server_stats)
+        if not locations:
+            return None, NoChunkServerAliveErr
+        self.placement.record(locations, self.server_stats)
 
         # get a unique chunk handle
         handle = self.chunk_handle
@@ -143,21 +206,24 @@ class ChunkManager:
         # increment for future
         self.chunk_handle += 1
 
-        locations = pick_randomly(self.active_chunk_servers, REPLICATION_FACTOR)
-
-        # update our dicts
-        self.chunks[path][chunk_index] = Chunk(handle)
-        self.locations[handle] = ChunkInfo(handle, locations)
-        self.handles[handle] = PathIndex(path, chunk_index)
+        self.table.add(handle, file_id, chunk_index, locations)
 
-        return self.locations[handle], None
+        return ChunkInfo(handle, locations), None
 
     # Find lease holder and return its location.
     def find_lease_holder(self, chunk_handle):
         with self.lock:
+            if self.table.refs(chunk_handle) > 1:
+                # snapshots share it, see copy_on_write
+                return Lease(), ChunkIsSharedErr
+
             ok = self.check_lease(chunk_handle)
             # If no lease holder, then grant a new lease.
             if not ok:
+                if not self.poll_status.converged.is_set():
+                    # the replicas of servers not polled yet would miss the mutations, and this
+                    # tree has no chunk versions to tell such stale replicas apart later
+                    return Lease(), MasterPollingErr
                 err = self.add_lease(chunk_handle)
                 if err:
                     return Lease(), err
@@ -183,10 +249,9 @@ class ChunkManager:
     # will grant a lease to a randomly selected server as the primary.
     # returns err if any or None
     def add_lease(self, chunk_handle):
-        chunk_info = self.locations.get(chunk_handle, None)
-
-        if not chunk_info:
+        if chunk_handle not in self.table:
             return ChunkhandleDoesNotExistErr
+        chunk_locations = self.table.locations(chunk_handle)
 
         lease = self.leases.get(chunk_handle, None)
 
@@ -196,149 +261,475 @@ class ChunkManager:
             self.leases[chunk_handle] = lease
 
         #  If no chunk server is alive, can't grant a new lease.
-        if len(chunk_info.chunk_locations) == 0:
+        if len(chunk_locations) == 0:
             return NoChunkServerAliveErr
 
         # Assign new values to lease.
         # pick primary randomly
-        lease.primary = chunk_info.chunk_locations[
+        lease.primary = chunk_locations[
             random.randint(1,
-                           min(len(chunk_info.chunk_locations), REPLICATION_FACTOR)) - 1]  # -1 for zero based indexing
+                           min(len(chunk_locations), REPLICATION_FACTOR)) - 1]  # -1 for zero based indexing
 
         lease.expiration = time.time() + LEASE_TIMEOUT
         self.leases[chunk_handle] = lease
 
         return None
 
-    # // Get (file, chunk index) associated with the specified chunk handle.
-    def get_path_index_from_handle(self, chunk_handle):
-        with self.lock:  # Fixme : might need an rlock here
-            path_index = self.handles.get(chunk_handle, None)
-            if not path_index:
+    def share_chunks(self, files):
+        """
+        Makes the copies of files made by a snapshot reference the chunks of their source,
+        files is a list of (source file id, copy file id). Leases on the shared chunks are
+        revoked: they must not be written anymore, writers have to ask for a lease again
+        and get their own copy of the chunk then. The chunk servers still have to be told,
+        see mark_shared. Returns the handles of the shared chunks.
+        """
+        with self.lock:
+            shared = []
+            for file_id, copy_id in files:
+                for chunk_handle in self.table.share_file(file_id, copy_id):
+                    self.leases.pop(chunk_handle, None)
+                    shared.append(chunk_handle)
+            return shared
+
+    @contextmanager
+    def claim(self, chunk_handles):
+        """Waits until nobody copies or marks the given chunks, and keeps them for the caller meanwhile."""
+        with self.claims:
+            while not self.claimed.isdisjoint(chunk_handles):
+                self.claims.wait()
+            self.claimed.update(chunk_handles)
+        try:
+            yield
+        finally:
+            with self.claims:
+                self.claimed.difference_update(chunk_handles)
+                self.claims.notify_all()
+
+    def mark_shared(self, chunk_handles):
+        """
+        Tells the chunk servers with replicas of the chunks whether they are shared with snapshots:
+        they refuse to mutate shared chunks, also for clients that still hold a lease or cached the
+        primary, until a single file is left and a writer asks for a copy (see copy_on_write).
+        The chunks are claimed, so that the marks of a chunk reach its chunk servers in the order
+        its sharing changed.
+        """
+        with self.claim(chunk_handles):
+            self.mark_shared_helper(chunk_handles)
+
+    # Assumes the chunks are claimed (see claim)
+    # Marks the chunks as they are shared when it is called. A chunk server that can't be told is
+    # declared dead, it registers again with its next heartbeat and learns which of its chunks
+    # are shared then.
+    def mark_shared_helper(self, chunk_handles):
+        handles = defaultdict(lambda: ([], []))  # chunk server -> (shared handles, unshared handles)
+        with self.lock:
+            for chunk_handle in chunk_handles:
+                if chunk_handle in self.table:
+                    shared = self.table.refs(chunk_handle) > 1
+                    for chunk_server in self.table.locations(chunk_handle):
+                        handles[chunk_server][0 if shared else 1].append(chunk_handle)
+
+        unreachable = []
+        for chunk_server, marks in handles.items():
+            try:
+                for shared, marked in zip((True, False), marks):
+                    if marked:
+                        rpc_call(chunk_server, SHARE_TIMEOUT).set_shared(marked, shared)
+            except (OSError, xmlrpc.client.Error) as e:
+                log.error("Unable to mark chunks of %s as shared: %s", chunk_server, e)
+                unreachable.append(chunk_server)
+        if not unreachable:
+            return
+
+        with self.lock:
+            self.active_chunk_servers.difference_update(unreachable)
+            lost_chunks = [chunk_handle for chunk_server in unreachable
+                           for chunk_handle in self.remove_chunk_server_helper(chunk_server)]
+        for chunk_server in unreachable:
+            self.failure_detector.forget(chunk_server)
+        self.replication.enqueue(lost_chunks)
+
+    def copy_on_write(self, file_id, chunk_index, path, on_copied):
+        """
+        Gives a file its own copy of a chunk it shares with snapshots, before it is written.
+        Every chunk server with a replica copies it locally to a new chunk handle, no data is
+        sent over the network. The other files keep the original chunk.
+        No lock is held while the chunk servers copy it, on_copied(info, commit) is called then:
+        commit() makes the copy the chunk of the file, unless the file no longer has the original
+        chunk, and returns whether it did. on_copied returns whether the copy was committed.
+        Returns chunk information of the chunk to write and errors.
+        """
+        if not self.poll_status.converged.is_set():
+            return None, MasterPollingErr  # see find_lease_holder
+        while True:
+            with self.lock:
+                chunk_handle = self.table.handle_of(file_id, chunk_index)
+            if chunk_handle is None:
                 return None, ChunkHandleNotFoundErr
-            return path_index, None
+
+            # concurrent writers of the chunk wait for its copy instead of copying it again
+            with self.claim([chunk_handle]):
+                with self.lock:
+                    if self.table.handle_of(file_id, chunk_index) != chunk_handle:
+                        continue  # copied by a concurrent writer meanwhile
+                    if self.table.refs(chunk_handle) <= 1:
+                        # not shared (anymore), eg. the snapshots were deleted: the chunk servers may
+                        # still refuse to write it
+                        info = ChunkInfo(chunk_handle, self.table.locations(chunk_handle))
+                    else:
+                        info = None
+                        copy_handle = self.chunk_handle
+                        self.chunk_handle += 1
+                        locations = self.table.locations(chunk_handle)
+
+                if info:
+                    self.mark_shared_helper([chunk_handle])
+                    return info, None
+                return self.copy_chunk_helper(file_id, chunk_index, path, chunk_handle, copy_handle, locations,
+                                              on_copied)
+
+    # Assumes the chunk is claimed (see claim)
+    def copy_chunk_helper(self, file_id, chunk_index, path, chunk_handle, copy_handle, locations, on_copied):
+        copied = []
+        for chunk_server in locations:
+            try:
+                err = rpc_call(chunk_server, COPY_ON_WRITE_TIMEOUT).copy_chunk(chunk_handle, copy_handle, path)
+            except (OSError, xmlrpc.client.Error) as e:
+                err = str(e)
+            if err:
+                log.error("Copy of chunk %d to %d failed on %s: %s", chunk_handle, copy_handle, chunk_server, err)
+            else:
+                copied.append(chunk_server)
+
+        if not copied:
+            return None, NoChunkServerAliveErr
+
+        def commit():
+            with self.lock:
+                if self.table.handle_of(file_id, chunk_index) != chunk_handle:
+                    return False
+                self.table.add(copy_handle, file_id, chunk_index, copied)
+                return True
+
+        info = ChunkInfo(copy_handle, copied)
+        if not on_copied(info, commit):
+            # the file was deleted meanwhile
+            with self.lock:
+                for chunk_server in copied:
+                    self.garbage[chunk_server].add(copy_handle)
+            return None, FileNotFoundErr
+
+        log.debug("Chunk %d copied to %d on %s", chunk_handle, copy_handle, copied)
+        # replicas that failed to copy are restored by the replication scheduler
+        if len(copied) < REPLICATION_FACTOR:
+            self.replication.enqueue([copy_handle])
+        return info, None
+
+    # // Get (file, chunk index) associated with the specified chunk handle,
+    # // for every file referencing it (snapshots share chunks).
+    def get_file_indexes_from_handle(self, chunk_handle):
+        with self.lock:  # Fixme : might need an rlock here
+            file_ids = self.table.file_ids_of(chunk_handle)
+            if not file_ids:
+                return [], ChunkHandleNotFoundErr
+            chunk_index = self.table.indexes[chunk_handle]
+            return [FileIndex(file_id, chunk_index) for file_id in file_ids], None
+
+    def chunks_reported(self, address, reports):
+        """
+        Records the replicas of reported chunks, reports are [chunk_handle, chunk_index, length].
+        Returns ([(file_id, length)] the length each file grows to, [chunk_handle] unknown to the master).
+        """
+        file_lengths, unknown = [], []
+        with self.lock:
+            for chunk_handle, chunk_index, length in reports:
+                file_ids = self.table.file_ids_of(chunk_handle)
+                if not file_ids:
+                    unknown.append(chunk_handle)
+                    continue
+                self.set_chunk_location_helper(chunk_handle, address)
+                file_length = CHUNK_SIZE * self.table.indexes[chunk_handle] + length
+                file_lengths.extend((file_id, file_length) for file_id in file_ids)
+        return file_lengths, unknown
 
     # // Set the location associated with a chunk handle.
     def set_chunk_location(self, chunk_handle, address):
         with self.lock:
-            info = self.locations.get(chunk_handle, None)
-            if not info:
-                info = ChunkInfo(chunk_handle, [])
-                self.locations[chunk_handle] = info
-
-            # Add address into the locations array.
-            # Need to ensure the there are no duplicates in the array.
-            if address not in info.chunk_locations:
-                info.chunk_locations.append(address)
-            self.chunks_of_chunk_server[address].append(chunk_handle)
-
-    def poll_chunkservers(self):
-        """A one time polling function, runs when master is started to get list of chunks from active chunk servers
-            and update the chunks_of_chunkserver dict."""
-        log.debug("****Polling active chunkservers start***")
-        for chunk_server in self.active_chunk_servers:
-            log.debug("Polling chunkserver %s", chunk_server)
-            cs = rpc_call(chunk_server)
-            try:
-                chunk_handles = cs.get_chunk_handles()
-                # update chunks_of_chunkserver dict
-                self.chunks_of_chunk_server[chunk_server] = chunk_handles
-                log.debug("Polling complete for chunkserver: %s", chunk_server)
-            except ConnectionRefusedError:
-                log.error("Polling failed for chunkserver: %s", chunk_server)
-
-        log.debug("****Polling active chunkservers end***")
-
-    def update_chunkserver_list(self, chunksrv_addr):
-        self.active_chunk_servers.add(chunksrv_addr)
-
-    # // delete all chunk handles related to given path.
-    # // and them into chunks_to_delete[]
-    def update_deletechunk_list(self, path):
-        chunk_dict = self.chunks.get(path, None)
-        if chunk_dict:
-            for chunk_index, chunk in chunk_dict.items():
-                self.chunks_to_delete.append(int(chunk.chunk_handle))
-            del self.chunks[path]
-
-    def test_connection(self, chunk_server_addr):
-        chunk_server = rpc_call(chunk_server_addr)
+            self.set_chunk_location_helper(chunk_handle, address)
+
+    # Assumes lock is acquired
+    # Chunks unknown to the master (deleted meanwhile) are ignored.
+    def set_chunk_location_helper(self, chunk_handle, address):
+        self.table.add_location(chunk_handle, address)
+
+    def poll_chunkservers(self, workers=POLL_WORKERS, timeout=POLL_TIMEOUT):
+        """
+        Polls the chunk servers known from the metadata for their chunks, to rebuild the chunk
+        locations after the master (re)started. Up to `workers` servers are polled in parallel,
+        each one has `timeout` seconds to answer. Returns right away: the master serves
+        metadata reads meanwhile with the locations known so far, which fill in as servers
+        answer, and poll_status.converged is set once all of them answered or failed. Leases
+        and new chunks are refused with MasterPollingErr until then.
+        A server that does not answer is dropped, its next heartbeat makes it register again
+        with all its chunks.
+        """
+        with self.lock:
+            chunk_servers = list(self.active_chunk_servers)
+            self.poll_status.begin(len(chunk_servers))
+        log.info("Polling %d chunk servers for their chunks", len(chunk_servers))
+        if not chunk_servers:
+            self.poll_done()
+            return
+
+        pool = ThreadPoolExecutor(max_workers=min(workers, len(chunk_servers)), thread_name_prefix='poll')
+        for chunk_server in chunk_servers:
+            pool.submit(self.poll_chunkserver, chunk_server, timeout)
+        pool.shutdown(wait=False)  # workers exit once the queue is drained
+
+    def poll_chunkserver(self, chunk_server, timeout):
+        log.debug("Polling chunkserver %s", chunk_server)
         try:
-            # try to connect with chunkserver
-            resp = chunk_server.delete_bad_chunk(self.chunks_to_delete)
-            if resp:
-                log.info("%s has deleted all bad chunks", chunk_server_addr)
-                return True
-            else:
-                log.info("%s is unable to delete all bad chunk handle", chunk_server_addr)
-                return True
-        except ConnectionRefusedError:
-            log.info("Unable to connect with %s", chunk_server_addr)
-            return False
+            chunk_handles = rpc_call(chunk_server, timeout).get_chunk_handles()
+        except (OSError, xmlrpc.client.Error) as e:
+            log.error("Polling failed for chunkserver %s: %s", chunk_server, e)
+            with self.lock:
+                self.active_chunk_servers.discard(chunk_server)
+                self.poll_status.failed.append(chunk_server)
+            self.failure_detector.forget(chunk_server)
+        else:
+            # replicas of chunks deleted while the master was down are orphans
+            self.register_chunks(chunk_server, chunk_handles)
+            with self.lock:
+                self.poll_status.polled += 1
+            log.debug("Polling complete for chunkserver: %s", chunk_server)
+
+        with self.lock:
+            self.poll_status.pending -= 1
+            done = not self.poll_status.pending
+        if done:
+            self.poll_done()
+
+    def poll_done(self):
+        status = self.poll_status
+        with self.lock:
+            status.finished = time.monotonic()
+            lost = sum(1 for _ in self.table.under_replicated(1))
+            log.info("Chunk locations converged in %.2f seconds: %d of %d chunk servers answered, "
+                     "%d chunks, %d of them without any replica",
+                     status.finished - status.started, status.polled, status.servers, len(self.table), lost)
+        status.converged.set()
+        # replica counts are complete now, repair what was lost while the master was down
+        self.replication.scan()
+
+    def poll_progress(self):
+        """See Master.get_poll_status."""
+        with self.lock:
+            status = self.poll_status
+            converged = status.converged.is_set()
+            return {
+                'converged': converged,
+                'servers': status.servers,
+                'polled': status.polled,
+                'failed': list(status.failed),
+                'pending': status.pending,
+                'seconds': (status.finished if converged else time.monotonic()) - status.started,
+                'chunks': len(self.table),
+                'chunks_without_replicas': sum(1 for _ in self.table.under_replicated(1)),
+            }
+
+    def update_chunkserver_list(self, chunksrv_addr, chunk_count=0):
+        with self.lock:
+            self.active_chunk_servers.add(chunksrv_addr)
+            # (re)joined just now, placement throttles new servers for a while
+            server_stats = self.server_stats[chunksrv_addr] = ServerStats()
+            server_stats.chunk_count = chunk_count
+        self.failure_detector.beat(chunksrv_addr)
+
+    def heartbeat(self, chunksrv_addr):
+        """
+        Records a heartbeat of a chunk server. Returns False if the server is not
+        registered (it was declared dead, or the master restarted and the server
+        was never polled), it then has to register again with its full chunk list.
+        """
+        with self.lock:
+            registered = chunksrv_addr in self.active_chunk_servers
+        if registered:
+            self.failure_detector.beat(chunksrv_addr)
+        return registered
+
+    def update_server_stats(self, chunksrv_addr, report):
+        with self.lock:
+            server_stats = self.server_stats.get(chunksrv_addr, None)
+            if not server_stats:
+                # registered before the master (re)started, not a new server
+                server_stats = self.server_stats[chunksrv_addr] = ServerStats(joined=0)
+            server_stats.update(report)
+
+    # // delete all chunk handles related to given file.
+    # // and hand their replicas over to the garbage collection of their chunk servers
+    def update_deletechunk_list(self, file_id):
+        with self.lock:
+            for chunk_handle, chunk_locations in self.drop_chunks_of_file(file_id).items():
+                for chunk_server in chunk_locations:
+                    self.garbage[chunk_server].add(chunk_handle)
+
+    # Assumes lock is acquired (or that the master is not serving yet, during oplog replay)
+    # Forget all chunk metadata of a deleted file.
+    # Returns a dict of the dropped chunk handles -> their last known locations.
+    def drop_chunks_of_file(self, file_id):
+        dropped = self.table.drop_file(file_id)
+        for chunk_handle in dropped:
+            self.leases.pop(chunk_handle, None)
+        return dropped
+
+    def register_chunks(self, chunksrv_addr, chunk_handles):
+        """
+        Records the replicas a chunk server has. Replicas of chunks the master does not know
+        (their file was deleted while the server was down, or before the master restarted)
+        are orphans, the chunk server is told to delete them.
+        Returns the handles of the chunks shared with snapshots, see mark_shared.
+        """
+        with self.lock:
+            orphans, shared = [], []
+            for chunk_handle in chunk_handles:
+                if chunk_handle in self.table:
+                    self.set_chunk_location_helper(chunk_handle, chunksrv_addr)
+                    if self.table.refs(chunk_handle) > 1:
+                        shared.append(chunk_handle)
+                else:
+                    orphans.append(chunk_handle)
+            self.add_garbage_helper(chunksrv_addr, orphans)
+            return shared
+
+    def replace_locations(self, chunksrv_addr, chunk_handles, handle_limit):
+        """
+        Makes the given chunks the only replicas recorded on a chunk server. Used by shadow
+        masters, which poll the chunk servers instead of receiving their reports.
+        Chunks from handle_limit on were added after the chunk server was asked for its
+        chunks, their locations are kept.
+        """
+        with self.lock:
+            chunk_handles = set(chunk_handles)
+            for chunk_handle in self.table.chunks_of(chunksrv_addr).difference(chunk_handles):
+                if chunk_handle < handle_limit:
+                    self.table.remove_location(chunk_handle, chunksrv_addr)
+            for chunk_handle in chunk_handles:
+                self.set_chunk_location_helper(chunk_handle, chunksrv_addr)
+
+    def add_orphans(self, chunksrv_addr, chunk_handles):
+        with self.lock:
+            self.add_garbage_helper(chunksrv_addr, chunk_handles)
+
+    # Assumes lock is acquired
+    def add_garbage_helper(self, chunksrv_addr, orphans):
+        # chunks of a just deleted file may still show up in reports, they are already pending
+        orphans = set(orphans).difference(self.garbage.get(chunksrv_addr, ()))
+        if orphans:
+            log.info("%d orphaned chunks on %s will be deleted", len(orphans), chunksrv_addr)
+            self.orphans_found += len(orphans)
+            self.garbage[chunksrv_addr].update(orphans)
+
+    def corrupt_replicas_found(self, chunksrv_addr, chunk_handles):
+        """
+        Drops replicas whose chunk server found them corrupt: they are deleted by the garbage
+        collection, and copied again from a good replica. The last replica of a chunk is kept.
+        """
+        lost_chunks = []
+        with self.lock:
+            for chunk_handle in chunk_handles:
+                if chunk_handle not in self.table or chunksrv_addr not in self.table.locations(chunk_handle):
+                    continue
+                if self.table.replica_count(chunk_handle) < 2:
+                    log.error("The only replica of chunk %d, on %s, is corrupt", chunk_handle, chunksrv_addr)
+                    continue
+                log.warning("Replica of chunk %d on %s is corrupt, replacing it", chunk_handle, chunksrv_addr)
+                self.table.remove_location(chunk_handle, chunksrv_addr)
+                self.garbage[chunksrv_addr].add(chunk_handle)
+                self.corrupt_replicas += 1
+                lost_chunks.append(chunk_handle)
+        if lost_chunks:
+            self.replication.enqueue(lost_chunks)
+
+    def garbage_batch(self, chunksrv_addr):
+        """
+        The next GC_BATCH_SIZE chunks a chunk server has to delete. They stay pending
+        (and are sent again) until the chunk server acknowledges their deletion.
+        """
+        with self.lock:
+            pending = self.garbage.get(chunksrv_addr, None)
+            return list(islice(pending, GC_BATCH_SIZE)) if pending else []
+
+    def chunks_deleted(self, chunksrv_addr, chunk_handles):
+        """A chunk server no longer has the given replicas, acknowledges pending deletions."""
+        with self.lock:
+            for chunk_handle in chunk_handles:
+                self.table.remove_location(chunk_handle, chunksrv_addr)
+
+            pending = self.garbage.get(chunksrv_addr, None)
+            if pending:
+                before = len(pending)
+                pending.difference_update(chunk_handles)
+                self.garbage_collected += before - len(pending)
+                if not pending:
+                    del self.garbage[chunksrv_addr]
+
+    def gc_status(self):
+        """See Master.get_gc_status."""
+        with self.lock:
+            return {
+                'backlog': sum(len(pending) for pending in self.garbage.values()),
+                'backlog_per_server': {server: len(pending) for server, pending in self.garbage.items()},
+                'collected': self.garbage_collected,
+                'orphans_found': self.orphans_found,
+                'corrupt_replicas': self.corrupt_replicas,
+            }
+
+    def detect_failures(self):
+        # servers known before a restart get a full timeout to send their first heartbeat
+        with self.lock:
+            chunk_servers = list(self.active_chunk_servers)
+        for chunk_server in chunk_servers:
+            self.failure_detector.beat(chunk_server)
 
-    def beat(self):
-        # FIXME: Simplify
         while True:
-            time.sleep(HEARTBEAT_INTERVAL)
-            log.debug("Heart Beating %s", self.locations)
-            log.debug("Heart Beating %s", self.active_chunk_servers)
-
-            # build list of dead chunk servers
-            # by testing a connection to them
-            dead_chunk_servers = [cs for cs in self.active_chunk_servers if not self.test_connection(cs)]
-
-            log.debug("Dead chunk servers list = %s", dead_chunk_servers)
-
-            # delete dead chunk server from active chunk servers list
-            self.active_chunk_servers.difference_update(dead_chunk_servers)
-
-            # loop over all chunk handles of dead chunk server
-            for dead_chunk_server in dead_chunk_servers:
-                # get list of chunks that need to be replicated
-                chunk_handles = self.chunks_of_chunk_server.get(dead_chunk_server, [])
-
-                for chunk_handle in chunk_handles:
-                    chunk_info = self.locations.get(chunk_handle, None)
-
-                    if chunk_info and dead_chunk_server in chunk_info.chunk_locations:
-                        # remove dead chunkserver from chunk's chunk_info.chunk_locations
-                        chunk_info.chunk_locations.remove(dead_chunk_server)
-
-                        dest_cs = None
-                        # if replication is needed
-                        # and we have enough number of active chunkservers
-                        # then perform replication
-                        if REPLICATION_FACTOR - len(chunk_info.chunk_locations) > 0 \
-                                and len(
-                            self.active_chunk_servers) >= REPLICATION_FACTOR:  # TODO: Probably handle with semaphore
-
-                            while True:
-                                # keep looping until we pick a chunk server which does not already contain this chunk
-                                # TODO: don't run infinitely, set a fixed max number of times this is executed
-                                rand_loc = pick_randomly(self.active_chunk_servers, 1)[0]
-                                if rand_loc not in chunk_info.chunk_locations:
-                                    dest_cs = rand_loc
-                                    break
-
-                        if not dest_cs:
-                            # if no valid destination chunkserver found, skip this chunks replication
-                            continue
-
-                        # else perform replication
-                        # call order_chunk copy_from_peer
-                        peer_address = pick_randomly(chunk_info.chunk_locations, 1)[0]
-                        cs_proxy = rpc_call(dest_cs)
-
-                        try:
-                            err = cs_proxy.order_chunk_copy_from_peer(peer_address, chunk_handle)
-                            if err:
-                                log.info("Unable to replicate to %s due to %s", dest_cs, err)
-                        except ConnectionRefusedError:
-                            log.info("Unable to connect to %s for %s replication", dest_cs, chunk_handle)
-
-                # delete dead_chunk_server from chunks_of_chunk_server_list
-                # TODO: donot remove if replication was not performed
-                self.chunks_of_chunk_server.pop(dead_chunk_server, None)
+            time.sleep(self.failure_detector.time_to_next_deadline())
+            dead_chunk_servers = self.failure_detector.expired()
+            if not dead_chunk_servers:
+                continue
+
+            log.info("Chunk servers missed their heartbeats, declaring them dead: %s", dead_chunk_servers)
+            with self.lock:
+                # delete dead chunk server from active chunk servers list
+                self.active_chunk_servers.difference_update(dead_chunk_servers)
+                lost_chunks = [chunk_handle for dead_chunk_server in dead_chunk_servers
+                               for chunk_handle in self.remove_chunk_server_helper(dead_chunk_server)]
+
+            # copies run in the background, most endangered chunks first
+            self.replication.enqueue(lost_chunks)
+
+    def extend_leases(self, primary, chunk_handles):
+        """
+        Extends the unexpired leases held by primary on the given chunks.
+        Returns a list of (chunk handle, new expiration) for the extended leases.
+        """
+        extended = []
+        with self.lock:
+            now = time.time()
+            for chunk_handle in chunk_handles:
+                lease = self.leases.get(chunk_handle, None)
+                if lease and lease.primary == primary and lease.expiration >= now:
+                    lease.expiration = now + LEASE_TIMEOUT
+                    extended.append((chunk_handle, lease.expiration))
+        return extended
+
+    # Assumes lock is acquired
+    # Removes a dead chunk server from the locations of all its chunks.
+    # Returns the handles of the chunks that lost a replica.
+    def remove_chunk_server_helper(self, dead_chunk_server):
+        lost_chunks = self.table.remove_server(dead_chunk_server)
+        # a server coming back registers all its chunks again, deleted ones are found as orphans then
+        self.garbage.pop(dead_chunk_server, None)
+        return lost_chunks
 
 
 log = default_logger
@@ -0,0 +1,325 @@
+from array import array
+from collections import defaultdict
+from typing import Dict, List, Set
+
+EMPTY = 0  # server id of an unused replica slot
+FREE = -1  # chunk index of an unused chunk handle, chunk handle of a missing chunk index
+
+
+class ServerIds:
+    """Interns chunk server addresses as small integers, ids are never reused."""
+    ids: Dict[str, int]
+    addresses: List[str]
+
+    __slots__ = 'ids', 'addresses'
+
+    def __init__(self, addresses=None):
+        self.addresses = list(addresses) if addresses else [None]  # id 0 is EMPTY
+        self.ids = {address: server_id for server_id, address in enumerate(self.addresses) if server_id}
+
+    def intern(self, address):
+        server_id = self.ids.get(address, None)
+        if server_id is None:
+            server_id = self.ids[address] = len(self.addresses)
+            self.addresses.append(address)
+        return server_id
+
+
+class ChunkTable:
+    """
+    Chunk metadata of the master, stored column wise in arrays indexed by chunk handle
+    (handles are granted by a counter, so the columns are dense):
+     - file_ids: the inode id of the file of each chunk (see InodeTable)
+     - indexes: the chunk index of each chunk within its file, FREE for unused handles
+     - replicas: `slots` fixed width slots per chunk holding the interned ids of the
+       chunk servers with a replica, a chunk with more replicas keeps the extra ones
+       in `overflow`
+    Files map to an array of their chunk handles by chunk index, and every chunk
+    server to the set of handles it holds (reverse index for failure handling).
+    Snapshots share chunks between files: a chunk referenced by several files lists
+    all of them in `shared`, file_ids holds one of them. Shared chunks are never
+    written, a file writing one first gets its own copy (copy on write).
+    Not thread safe, ChunkManager.lock protects it.
+    """
+    files: Dict[int, array]
+    overflow: Dict[int, List[int]]
+    shared: Dict[int, List[int]]
+    chunks_of_server: Dict[int, Set[int]]
+
+    __slots__ = 'slots', 'file_ids', 'indexes', 'replicas', 'overflow', 'shared', 'files', 'servers', \
+                'chunks_of_server', 'count'
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.file_ids = array('q')  # chunk handle -> file id
+        self.indexes = array('i')  # chunk handle -> chunk index
+        self.replicas = array('H')  # chunk handle * slots + slot -> server id
+        self.overflow = {}  # chunk handle -> server ids of replicas that did not fit in the slots
+        self.shared = {}  # chunk handle -> ids of the files referencing it, for chunks of more than one file
+        self.files = {}  # file id -> chunk index -> chunk handle
+        self.servers = ServerIds()
+        self.chunks_of_server = defaultdict(set)  # server id -> chunk handles
+        self.count = 0  # number of chunks
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, chunk_handle):
+        return 0 <= chunk_handle < len(self.indexes) and self.indexes[chunk_handle] != FREE
+
+    def grow_helper(self, chunk_handle):
+        missing = chunk_handle + 1 - len(self.indexes)
+        if missing > 0:
+            self.file_ids.extend(array('q', [FREE]) * missing)
+            self.indexes.extend(array('i', [FREE]) * missing)
+            self.replicas.extend(array('H', [EMPTY]) * (missing * self.slots))
+
+    def add(self, chunk_handle, file_id, chunk_index, locations):
+        """Adds (or replaces) a chunk of a file. A replaced chunk shared with other files is kept for them."""
+        if chunk_handle in self:
+            if self.indexes[chunk_handle] == chunk_index and \
+                    file_id in self.shared.get(chunk_handle, (self.file_ids[chunk_handle],)):
+                # added already (oplog replay), it may have been shared by a snapshot since
+                for address in locations:
+                    self.add_location(chunk_handle, address)
+                return
+            self.remove_helper(chunk_handle)
+        self.grow_helper(chunk_handle)
+
+        handles = self.files.get(file_id, None)
+        if handles is None:
+            handles = self.files[file_id] = array('q')
+        if chunk_index >= len(handles):
+            handles.extend(array('q', [FREE]) * (chunk_index + 1 - len(handles)))
+        elif handles[chunk_index] != FREE:
+            if handles[chunk_index] in self.shared:
+                self.unshare_helper(handles[chunk_index], file_id)
+            else:
+                self.remove_helper(handles[chunk_index])
+        handles[chunk_index] = chunk_handle
+
+        self.file_ids[chunk_handle] = file_id
+        self.indexes[chunk_handle] = chunk_index
+        self.count += 1
+        for address in locations:
+            self.add_location(chunk_handle, address)
+
+    def handle_of(self, file_id, chunk_index):
+        """Handle of a chunk of a file, or None if there is no such chunk."""
+        handles = self.files.get(file_id, None)
+        if handles is None or not 0 <= chunk_index < len(handles) or handles[chunk_index] == FREE:
+            return None
+        return handles[chunk_index]
+
+    def has_file(self, file_id):
+        return file_id in self.files
+
+    def refs(self, chunk_handle):
+        """Number of files referencing a chunk."""
+        sharing = self.shared.get(chunk_handle, None)
+        return len(sharing) if sharing else int(chunk_handle in self)
+
+    def share_file(self, file_id, copy_id):
+        """Makes file copy_id reference all chunks of file_id, returns their handles."""
+        handles = self.files.get(file_id, None)
+        if handles is None:
+            return []
+
+        self.files[copy_id] = array('q', handles)
+        chunk_handles = [chunk_handle for chunk_handle in handles if chunk_handle != FREE]
+        for chunk_handle in chunk_handles:
+            sharing = self.shared.get(chunk_handle, None)
+            if sharing is None:
+                sharing = self.shared[chunk_handle] = [self.file_ids[chunk_handle]]
+            sharing.append(copy_id)
+        return chunk_handles
+
+    def unshare_helper(self, chunk_handle, file_id):
+        # the chunk stays with the other files referencing it
+        sharing = self.shared[chunk_handle]
+        sharing.remove(file_id)
+        if self.file_ids[chunk_handle] == file_id:
+            self.file_ids[chunk_handle] = sharing[0]
+        if len(sharing) == 1:
+            del self.shared[chunk_handle]
+
+    def file_index(self, chunk_handle):
+        """(file id, chunk index) of a chunk, or None for unknown handles."""
+        if chunk_handle not in self:
+            return None
+        return self.file_ids[chunk_handle], self.indexes[chunk_handle]
+
+    def file_ids_of(self, chunk_handle):
+        """Ids of all files referencing a chunk, empty for unknown handles."""
+        if chunk_handle not in self:
+            return []
+        return list(self.shared.get(chunk_handle, (self.file_ids[chunk_handle],)))
+
+    def replica_ids_helper(self, chunk_handle):
+        start = chunk_handle * self.slots
+        server_ids = [server_id for server_id in self.replicas[start:start + self.slots] if server_id != EMPTY]
+        server_ids.extend(self.overflow.get(chunk_handle, ()))
+        return server_ids
+
+    def locations(self, chunk_handle):
+        """Addresses of the chunk servers having a replica of a chunk, empty for unknown handles."""
+        if chunk_handle not in self:
+            return []
+        addresses = self.servers.addresses
+        return [addresses[server_id] for server_id in self.replica_ids_helper(chunk_handle)]
+
+    def replica_count(self, chunk_handle):
+        if chunk_handle not in self:
+            return 0
+        start = chunk_handle * self.slots
+        return self.slots - self.replicas[start:start + self.slots].count(EMPTY) \
+            + len(self.overflow.get(chunk_handle, ()))
+
+    def add_location(self, chunk_handle, address):
+        """Records a replica, returns False if it was already known or the chunk does not exist."""
+        if chunk_handle not in self:
+            return False
+        server_id = self.servers.intern(address)
+        start = chunk_handle * self.slots
+        slots = self.replicas[start:start + self.slots]
+        if server_id in slots or server_id in self.overflow.get(chunk_handle, ()):
+            return False
+
+        if EMPTY in slots:
+            self.replicas[start + slots.index(EMPTY)] = server_id
+        else:
+            self.overflow.setdefault(chunk_handle, []).append(server_id)
+        self.chunks_of_server[server_id].add(chunk_handle)
+        return True
+
+    def remove_location(self, chunk_handle, address):
+        """Forgets a replica, returns False if it was not known."""
+        server_id = self.servers.ids.get(address, None)
+        if server_id is None or chunk_handle not in self:
+            return False
+        self.chunks_of_server[server_id].discard(chunk_handle)
+        return self.remove_replica_helper(chunk_handle, server_id)
+
+    def remove_replica_helper(self, chunk_handle, server_id):
+        extra = self.overflow.get(chunk_handle, None)
+        if extra and server_id in extra:
+            extra.remove(server_id)
+        else:
+            start = chunk_handle * self.slots
+            slots = self.replicas[start:start + self.slots]
+            if server_id not in slots:
+                return False
+            # keep the slots filled while there are extra replicas
+            self.replicas[start + slots.index(server_id)] = extra.pop() if extra else EMPTY
+
+        if extra is not None and not extra:
+            del self.overflow[chunk_handle]
+        return True
+
+    def remove_helper(self, chunk_handle):
+        for server_id in self.replica_ids_helper(chunk_handle):
+            self.chunks_of_server[server_id].discard(chunk_handle)
+        start = chunk_handle * self.slots
+        self.replicas[start:start + self.slots] = array('H', [EMPTY]) * self.slots
+        self.overflow.pop(chunk_handle, None)
+
+        chunk_index = self.indexes[chunk_handle]
+        for file_id in self.shared.pop(chunk_handle, (self.file_ids[chunk_handle],)):
+            handles = self.files.get(file_id, None)
+            if handles is not None and chunk_index < len(handles) and handles[chunk_index] == chunk_handle:
+                handles[chunk_index] = FREE
+        self.file_ids[chunk_handle] = FREE
+        self.indexes[chunk_handle] = FREE
+        self.count -= 1
+
+    def drop_file(self, file_id):
+        """
+        Removes all chunks of a file, returns a dict of their handles -> last known locations.
+        Chunks shared with other files are kept for them, and not returned.
+        """
+        handles = self.files.pop(file_id, None)
+        if handles is None:
+            return {}
+
+        dropped = {}
+        for chunk_handle in handles:
+            if chunk_handle in self.shared:
+                self.unshare_helper(chunk_handle, file_id)
+            elif chunk_handle != FREE and chunk_handle in self:
+                dropped[chunk_handle] = self.locations(chunk_handle)
+                self.remove_helper(chunk_handle)
+        return dropped
+
+    def chunks_of(self, address):
+        """Handles of the chunks with a replica on a chunk server (do not modify)."""
+        server_id = self.servers.ids.get(address, None)
+        return self.chunks_of_server.get(server_id, set()) if server_id else set()
+
+    def remove_server(self, address):
+        """Removes a chunk server from the locations of all its chunks, returns their handles."""
+        server_id = self.servers.ids.get(address, None)
+        if server_id is None:
+            return []
+        chunk_handles = list(self.chunks_of_server.pop(server_id, ()))
+        for chunk_handle in chunk_handles:
+            self.remove_replica_helper(chunk_handle, server_id)
+        return chunk_handles
+
+    def items(self):
+        """Yields (chunk handle, file id, chunk index) of all chunks."""
+        file_ids, indexes = self.file_ids, self.indexes
+        for chunk_handle, chunk_index in enumerate(indexes):
+            if chunk_index != FREE:
+                yield chunk_handle, file_ids[chunk_handle], chunk_index
+
+    def under_replicated(self, goal):
+        """Yields (chunk handle, number of replicas) of the chunks with less than goal replicas."""
+        slots, replicas, overflow = self.slots, self.replicas, self.overflow
+        for chunk_handle, chunk_index in enumerate(self.indexes):
+            if chunk_index == FREE:
+                continue
+            start = chunk_handle * slots
+            count = slots - replicas[start:start + slots].count(EMPTY) + len(overflow.get(chunk_handle, ()))
+            if count < goal:
+                yield chunk_handle, count
+
+    def snapshot(self):
+        """Copy of the columns, made of builtins and arrays only (for checkpoints)."""
+        return {
+            'slots': self.slots,
+            'file_ids': array('q', self.file_ids),
+            'indexes': array('i', self.indexes),
+            'replicas': array('H', self.replicas),
+            'overflow': {chunk_handle: list(extra) for chunk_handle, extra in self.overflow.items()},
+            'shared': {chunk_handle: list(sharing) for chunk_handle, sharing in self.shared.items()},
+            'servers': list(self.servers.addresses),
+        }
+
+    @classmethod
+    def from_snapshot(cls, state):
+        table = cls(state['slots'])
+        table.file_ids = state['file_ids']
+        table.indexes = state['indexes']
+        table.replicas = state['replicas']
+        table.overflow = state['overflow']
+        table.shared = state['shared']
+        table.servers = ServerIds(state['servers'])
+
+        # rebuild the indexes
+        slots = table.slots
+        for chunk_handle, file_id, chunk_index in table.items():
+            for sharing_id in table.shared.get(chunk_handle, (file_id,)):
+                handles = table.files.get(sharing_id, None)
+                if handles is None:
+                    handles = table.files[sharing_id] = array('q')
+                if chunk_index >= len(handles):
+                    handles.extend(array('q', [FREE]) * (chunk_index + 1 - len(handles)))
+                handles[chunk_index] = chunk_handle
+            table.count += 1
+            for server_id in table.replicas[chunk_handle * slots:(chunk_handle + 1) * slots]:
+                if server_id != EMPTY:
+                    table.chunks_of_server[server_id].add(chunk_handle)
+        for chunk_handle, extra in table.overflow.items():
+            for server_id in extra:
+                table.chunks_of_server[server_id].add(chunk_handle)
+        return table
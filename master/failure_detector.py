@@ -0,0 +1,55 @@
+import heapq
+import threading
+import time
+from typing import Dict
+
+
+class FailureDetector:
+    """
+    Tracks heartbeat deadlines of chunk servers. A heartbeat pushes the new deadline
+    of its server on a min heap, superseded entries are skipped when they reach the
+    top. Heartbeats cost O(log n) and finding the dead servers only looks at expired
+    entries, so no server is ever probed.
+    """
+    deadlines: Dict[str, float]
+
+    __slots__ = 'timeout', 'clock', 'heap', 'deadlines', 'lock'
+
+    def __init__(self, timeout, clock=time.monotonic):
+        self.timeout = timeout  # a server missing heartbeats for this long is dead
+        self.clock = clock
+        self.heap = []  # (deadline, server), may contain superseded deadlines
+        self.deadlines = {}  # server -> current deadline
+        self.lock = threading.Lock()
+
+    def beat(self, server):
+        """Records a heartbeat, returns False if the server was not being tracked (new or declared dead)."""
+        deadline = self.clock() + self.timeout
+        with self.lock:
+            known = server in self.deadlines
+            self.deadlines[server] = deadline
+            heapq.heappush(self.heap, (deadline, server))
+            return known
+
+    def forget(self, server):
+        with self.lock:
+            self.deadlines.pop(server, None)
+
+    def expired(self):
+        """Removes and returns the servers whose deadline has passed."""
+        now = self.clock()
+        dead = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, server = heapq.heappop(self.heap)
+                if self.deadlines.get(server, None) == deadline:
+                    del self.deadlines[server]
+                    dead.append(server)
+        return dead
+
+    def time_to_next_deadline(self):
+        """Seconds until the earliest deadline, or the timeout if no server is tracked."""
+        with self.lock:
+            if not self.heap:
+                return self.timeout
+            return max(0.0, self.heap[0][0] - self.clock())
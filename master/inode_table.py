@@ -0,0 +1,159 @@
+import bisect
+import sys
+from array import array
+from typing import Dict, List
+
+ROOT = 0  # inode id of '/'
+FREE = -1  # parent of an unused inode id
+
+
+class InodeTable:
+    """
+    The namespace tree. Every file and directory is an inode, its id indexes the columns:
+     - names: last component of the path, interned so that a name used in many
+       directories is stored once
+     - parents: inode id of the parent directory
+     - lengths: file length in bytes
+     - dirs: 1 for directories
+    A path is only stored as the chain of its components, every prefix is stored once
+    for the whole subtree below it. Directories map the names of their children to
+    inode ids, and keep the names sorted for paged listings.
+    The ids of removed inodes are reused, so that the columns do not grow with every
+    create and delete. Chunk metadata refers to files by inode id: it must be dropped
+    before the file is removed.
+    Not thread safe, NamespaceManager.mutex protects it.
+    """
+    names: List[str]
+    children: Dict[int, Dict[str, int]]
+    listing: Dict[int, List[str]]
+    free: List[int]
+
+    __slots__ = 'names', 'parents', 'lengths', 'dirs', 'children', 'listing', 'count', 'free'
+
+    def __init__(self):
+        self.names = ['/']
+        self.parents = array('q', [ROOT])
+        self.lengths = array('q', [0])
+        self.dirs = bytearray(b'\x01')
+        self.children = {ROOT: {}}  # directory inode id -> name -> inode id
+        self.listing = {ROOT: []}  # directory inode id -> sorted names of its children
+        self.count = 1  # number of inodes, including the root
+        self.free = []  # ids of removed inodes, reused by add
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, path):
+        """Inode id of a path, or None if it does not exist."""
+        inode = ROOT
+        for name in path.split('/'):
+            if not name:
+                continue
+            children = self.children.get(inode, None)
+            if children is None:  # not a directory
+                return None
+            inode = children.get(name, None)
+            if inode is None:
+                return None
+        return inode
+
+    def is_dir(self, inode):
+        return bool(self.dirs[inode])
+
+    def path_of(self, inode):
+        names = []
+        while inode != ROOT:
+            names.append(self.names[inode])
+            inode = self.parents[inode]
+        return '/' + '/'.join(reversed(names))
+
+    def add(self, parent, name, is_dir, length=0):
+        """Adds a child to directory parent and returns its inode id."""
+        name = sys.intern(name)
+        if self.free:
+            inode = self.free.pop()
+            self.names[inode] = name
+            self.parents[inode] = parent
+            self.lengths[inode] = length
+            self.dirs[inode] = 1 if is_dir else 0
+        else:
+            inode = len(self.names)
+            self.names.append(name)
+            self.parents.append(parent)
+            self.lengths.append(length)
+            self.dirs.append(1 if is_dir else 0)
+        if is_dir:
+            self.children[inode] = {}
+            self.listing[inode] = []
+
+        self.children[parent][name] = inode
+        bisect.insort(self.listing[parent], name)
+        self.count += 1
+        return inode
+
+    def remove(self, inode):
+        parent, name = self.parents[inode], self.names[inode]
+        del self.children[parent][name]
+        siblings = self.listing[parent]
+        del siblings[bisect.bisect_left(siblings, name)]
+
+        self.children.pop(inode, None)
+        self.listing.pop(inode, None)
+        self.names[inode] = None
+        self.parents[inode] = FREE
+        self.lengths[inode] = 0
+        self.count -= 1
+        self.free.append(inode)
+
+    def copy(self, inode, parent, name):
+        """
+        Copies the subtree rooted at inode to a new child `name` of directory parent.
+        Returns the (source, copy) inode ids of the copied files.
+        """
+        files = []
+        stack = [(inode, parent, name)]
+        while stack:
+            source, target_parent, target_name = stack.pop()
+            copy = self.add(target_parent, target_name, self.dirs[source], self.lengths[source])
+            if self.dirs[source]:
+                stack.extend((child, copy, child_name) for child_name, child in self.children[source].items())
+            else:
+                files.append((source, copy))
+        return files
+
+    def list(self, inode, after=None, limit=None):
+        """Sorted names of the children of a directory, starting after name `after`."""
+        names = self.listing[inode]
+        start = bisect.bisect_right(names, after) if after else 0
+        end = start + limit if limit else len(names)
+        return names[start:end]
+
+    def snapshot(self):
+        """Copy of the columns, made of builtins and arrays only (for checkpoints)."""
+        return {
+            'names': list(self.names),
+            'parents': array('q', self.parents),
+            'lengths': array('q', self.lengths),
+            'dirs': bytes(self.dirs),
+        }
+
+    @classmethod
+    def from_snapshot(cls, state):
+        table = cls()
+        table.names = [sys.intern(name) if name is not None else None for name in state['names']]
+        table.parents = state['parents']
+        table.lengths = state['lengths']
+        table.dirs = bytearray(state['dirs'])
+
+        table.children = {inode: {} for inode, is_dir in enumerate(table.dirs)
+                          if is_dir and table.parents[inode] != FREE}
+        table.count = 1
+        for inode in range(1, len(table.names)):
+            if table.parents[inode] != FREE:
+                table.children[table.parents[inode]][table.names[inode]] = inode
+                table.count += 1
+            else:
+                table.free.append(inode)
+        # sort each directory once instead of paying for an insort per entry
+        table.listing = {inode: sorted(children) for inode, children in table.children.items()}
+        return table
@@ -1,116 +1,305 @@
 import threading
-from typing import Dict
+from contextlib import contextmanager
+from typing import Dict, List
 
 from commons.errors import *
+from commons.locks import RWLock
+from commons.stats import InstrumentedLock
+from master.inode_table import InodeTable
 
 
-class Path:
-    is_dir: bool
-    length: int
+class PathLocks:
+    """
+    GFS style hierarchical locking: an operation on a path takes read locks on
+    all of its ancestors and a read or write lock on the path itself. Locks are
+    created on demand and dropped once nobody holds or waits for them.
+    """
+    locks: Dict[str, List]
 
-    __slots__ = 'is_dir', 'length'
+    __slots__ = 'mutex', 'locks'
 
-    def __init__(self, is_dir=False, length=0):
-        self.is_dir = is_dir
-        self.length = length
+    def __init__(self):
+        self.mutex = threading.Lock()  # protects the locks table only
+        self.locks = {}  # path -> [RWLock, number of users]
+
+    def lock(self, path: str, write=False):
+        """Locks ancestors of path for reading and path itself for reading or writing."""
+        return self.lock_all([(path, write)])
+
+    @contextmanager
+    def lock_all(self, targets):
+        """Locks several paths at once, targets is a list of (path, write)."""
+        modes = {}
+        for path, write in targets:
+            for ancestor in get_ancestors(path):
+                modes.setdefault(ancestor, False)
+            modes[path] = modes.get(path, False) or write
+        # acquire in a global order (depth, then name) so that operations never deadlock
+        wanted = sorted(modes.items(), key=lambda entry: (entry[0].count('/'), entry[0]))
+
+        acquired = []
+        try:
+            for lock_path, lock_write in wanted:
+                rw_lock = self.get(lock_path)
+                acquired.append((lock_path, lock_write, rw_lock))
+                if lock_write:
+                    rw_lock.acquire_write()
+                else:
+                    rw_lock.acquire_read()
+            yield
+        finally:
+            for lock_path, lock_write, rw_lock in reversed(acquired):
+                if lock_write:
+                    rw_lock.release_write()
+                else:
+                    rw_lock.release_read()
+                self.put(lock_path)
+
+    def get(self, path):
+        with self.mutex:
+            entry = self.locks.get(path, None)
+            if not entry:
+                entry = self.locks[path] = [RWLock(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def put(self, path):
+        with self.mutex:
+            entry = self.locks[path]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[path]
 
 
 class NamespaceManager:
-    paths: Dict[str, Path]
+    inodes: InodeTable
 
-    __slots__ = 'mutex', 'paths'
+    __slots__ = 'mutex', 'path_locks', 'inodes'
 
     def __init__(self):
-        self.mutex = threading.Lock()  # TODO: probably use a re entrant lock
-        # Initialize paths with root path
-        self.paths = {'/': Path(True, 0)}  # TODO: probably need to persist in metadata file of master server
+        # Operations on disjoint subtrees run in parallel under path_locks,
+        # mutex only guards the short updates of the inode table.
+        self.path_locks = PathLocks()
+        self.mutex = InstrumentedLock()
+        # the namespace tree, holding only the root initially
+        self.inodes = InodeTable()
 
     # Create a file
-    def create(self, path: str):
-        with self.mutex:
+    # on_created is called once it is created, while path is still locked (eg. to log the create
+    # before a delete of the same path).
+    def create(self, path: str, on_created=None):
+        with self.path_locks.lock(path, write=True):
             parent = get_parent(path)
-            if not self.exists(parent):
+            if not self.exists_helper(parent):
                 return False, PathNotFoundErr
 
-            if not self.is_dir(parent):
+            if not self.is_dir_helper(parent):
                 return False, ParentIsNotDirErr
 
-            if self.exists(path):
+            if self.exists_helper(path):
                 return False, FileAlreadyExistsErr
 
-            self.paths[path] = Path(False, 0)
+            with self.mutex:
+                self.insert_path(path, False)
+            if on_created:
+                on_created()
 
             return True, None
 
     # FIXME: Too much code repetition from create file
-    def create_dir(self, path: str):
-        with self.mutex:
+    def create_dir(self, path: str, on_created=None):
+        with self.path_locks.lock(path, write=True):
             parent = get_parent(path)
-            if not self.exists(parent):
+            if not self.exists_helper(parent):
                 return False, PathNotFoundErr
 
-            if not self.is_dir(parent):
+            if not self.is_dir_helper(parent):
                 return False, ParentIsNotDirErr
 
-            if self.exists(path):
+            if self.exists_helper(path):
                 return False, DirAlreadyExistsErr
 
-            self.paths[path] = Path(True, 0)
+            with self.mutex:
+                self.insert_path(path, True)
+            if on_created:
+                on_created()
 
             return True, None
 
-    # list all files
-    def list_allfiles(self, path: str):
-        files = []
-        with self.mutex:
-            if not self.is_dir(path):
-                return files, ParentIsNotDirErr
+    # Copy a file or a directory tree to dst, which must not exist yet.
+    # on_copy is called with the (source, copy) inode ids of the copied files before the copies can be used,
+    # then on_copied, still before any other operation on src or dst (eg. to log the copy).
+    def copy(self, src: str, dst: str, on_copy, on_copied=None):
+        if dst == src or dst.startswith(src.rstrip('/') + '/'):
+            return False, InvalidSnapshotErr
 
-            if not self.exists(path):
-                return files, PathNotFoundErr
+        # writes on src keep its subtree unchanged while it is copied
+        with self.path_locks.lock_all([(src, True), (dst, True)]):
+            if not self.exists_helper(src):
+                return False, PathNotFoundErr
 
-            for file in self.paths:
-                parent = get_parent(file)
-                if parent == path:
-                    files.append(file)
+            parent = get_parent(dst)
+            if not self.exists_helper(parent):
+                return False, PathNotFoundErr
 
-            return files, None
+            if not self.is_dir_helper(parent):
+                return False, ParentIsNotDirErr
 
-    # delete File
-    def delete(self, path: str):
-        if not self.exists(path):
-            return PathNotFoundErr
+            if self.exists_helper(dst):
+                return False, FileAlreadyExistsErr
+
+            with self.mutex:
+                on_copy(self.copy_path(src, dst))
+            if on_copied:
+                on_copied()
+
+            return True, None
+
+    # Assumes mutex is acquired (or that the master is not serving yet, during recovery)
+    def copy_path(self, src: str, dst: str):
+        return self.inodes.copy(self.inodes.lookup(src), self.inodes.lookup(get_parent(dst)), get_name(dst))
 
-        if self.is_dir(path):
-            resp, err = self.list_allfiles(path)
-            if resp and len(resp) > 0:
+    # list all files
+    # Returns at most `limit` children of a directory in sorted order, starting
+    # right after `cursor` (the last path of the previous page) if it is given.
+    def list_allfiles(self, path: str, cursor: str = None, limit: int = None):
+        with self.path_locks.lock(path):
+            if not self.exists_helper(path):
+                return [], PathNotFoundErr
+
+            if not self.is_dir_helper(path):
+                return [], ParentIsNotDirErr
+
+            with self.mutex:
+                # children are sorted by name, which is the order of their full paths too
+                names = self.inodes.list(self.inodes.lookup(path), get_name(cursor) if cursor else None, limit)
+
+            prefix = path.rstrip('/') + '/'
+            return [prefix + name for name in names], None
+
+    # Yields every path in the subtree rooted at path (excluding path itself).
+    # Assumes the subtree is locked against mutations for the whole iteration
+    def walk(self, path: str):
+        stack = [(self.inodes.lookup(path), path.rstrip('/'))]
+        while stack:
+            inode, dir_path = stack.pop()
+            for name, child in self.inodes.children[inode].items():
+                child_path = f'{dir_path}/{name}'
+                yield child_path
+                if self.inodes.is_dir(child):
+                    stack.append((child, child_path))
+
+    # delete File
+    # on_delete is called with the inode id of the file (None for a directory) before it is removed
+    # (its id may be reused right after), while path is still locked.
+    def delete(self, path: str, on_delete=None):
+        with self.path_locks.lock(path, write=True):
+            inode = self.inodes.lookup(path)
+            if inode is None:
+                return PathNotFoundErr
+
+            # creates inside path need a read lock on it, so the directory stays empty
+            if self.inodes.children.get(inode):
                 return DirIsNotEmptyErr
 
-        del self.paths[path]
+            if on_delete:
+                on_delete(None if self.inodes.is_dir(inode) else inode)
+            with self.mutex:
+                self.inodes.remove(inode)
+
+            return None
+
+    @contextmanager
+    def freeze(self):
+        """Blocks every namespace operation, all of them read lock the root."""
+        with self.path_locks.lock('/', write=True):
+            yield
+
+    def snapshot(self):
+        """Copy of the inode table for checkpoints."""
+        with self.mutex:
+            return self.snapshot_helper()
+
+    # Assumes mutex is acquired
+    def snapshot_helper(self):
+        return self.inodes.snapshot()
 
-        return None
+    # Replace the whole namespace with a snapshot of the inode table. Used to restore a checkpoint.
+    def load_snapshot(self, state):
+        self.inodes = InodeTable.from_snapshot(state)
+
+    # Assumes mutex is acquired (or that the master is not serving yet, during recovery)
+    # Returns the inode id of the new path.
+    def insert_path(self, path: str, is_dir: bool, length=0):
+        return self.inodes.add(self.inodes.lookup(get_parent(path)), get_name(path), is_dir, length)
+
+    # Assumes mutex is acquired (or that the master is not serving yet, during recovery)
+    def remove_path(self, path: str):
+        self.inodes.remove(self.inodes.lookup(path))
 
     def exists(self, path: str):
-        return path in self.paths
+        with self.path_locks.lock(path):
+            return self.exists_helper(path)
 
     def is_dir(self, path: str):
-        if path in self.paths and self.paths[path].is_dir:
-            return True
-        else:
-            return False
+        with self.path_locks.lock(path):
+            return self.is_dir_helper(path)
+
+    # Assumes path is locked
+    def exists_helper(self, path: str):
+        return self.inodes.lookup(path) is not None
+
+    # Assumes path is locked
+    def is_dir_helper(self, path: str):
+        inode = self.inodes.lookup(path)
+        return inode is not None and self.inodes.is_dir(inode)
+
+    def file_id(self, path: str):
+        """
+        Inode id of a file, None if there is no such file. Chunk metadata refers to
+        files by id, the id of a deleted file is reused: lock path while it is used.
+        """
+        with self.mutex:
+            return self.file_id_helper(path)
+
+    # Assumes path is locked or mutex is acquired (or that the master is not serving yet, during recovery)
+    def file_id_helper(self, path: str):
+        inode = self.inodes.lookup(path)
+        if inode is None or self.inodes.is_dir(inode):
+            return None
+        return inode
 
     def get_file_length(self, path):
-        with self.mutex:
-            info = self.paths.get(path, None)
-            if not info:
+        with self.path_locks.lock(path):
+            inode = self.file_id_helper(path)
+            if inode is None:
                 return 0, FileNotFoundErr
-            return info.length, None
+            return self.inodes.lengths[inode], None
 
     def set_file_length(self, path, length):
-        with self.mutex:
-            info = self.paths.get(path, None)
-            if info:  # add check to prevent NPE
-                info.length = length
+        with self.path_locks.lock(path, write=True):
+            inode = self.file_id_helper(path)
+            if inode is not None:  # add check to prevent NPE
+                with self.mutex:
+                    self.inodes.lengths[inode] = length
+
+    # Assumes mutex is acquired, and was since file_lengths were looked up (ids are reused)
+    # Grow files, given as [(file id, length)], to the lengths they are shorter than.
+    def extend_file_lengths_helper(self, file_lengths):
+        lengths = self.inodes.lengths
+        for file_id, length in file_lengths:
+            if length > lengths[file_id]:
+                lengths[file_id] = length
+
+
+def get_ancestors(path):
+    """Returns all proper ancestors of path, e.g. /a/b/c -> ['/', '/a', '/a/b']"""
+    ancestors = []
+    while path != '/':
+        path = get_parent(path)
+        ancestors.append(path)
+    ancestors.reverse()
+    return ancestors
 
 
 def get_parent(path):
@@ -121,3 +310,8 @@ def get_parent(path):
     # FIXME: what if path is = '/home/username/' i.e. ends with a trailing '/'
     #   I don't know whether it's a valid case
     return path[:idx]
+
+
+def get_name(path):
+    """Last component of path, e.g. /a/b/c -> c"""
+    return path[path.rfind('/') + 1:]
@@ -0,0 +1,153 @@
+import time
+from collections import deque
+from typing import Dict
+
+from commons.settings import MAX_DISK_UTILIZATION, NEW_SERVER_PERIOD, NEW_SERVER_MAX_ALLOCATIONS, \
+    ALLOCATION_WINDOW, MAX_RECENT_ALLOCATION_SKEW, MAX_WRITE_LOAD_SKEW
+from commons.utils import pick_randomly
+
+
+class ServerStats:
+    """Latest load statistics reported by a chunk server, plus master side allocation bookkeeping."""
+    disk_total: int
+    disk_used: int
+    chunk_count: int
+    write_load: float
+    joined: float
+    allocations: deque
+
+    __slots__ = 'disk_total', 'disk_used', 'chunk_count', 'write_load', 'joined', 'allocations'
+
+    def __init__(self, joined=None):
+        self.disk_total = 0  # bytes
+        self.disk_used = 0  # bytes
+        self.chunk_count = 0  # reported chunks plus chunks placed here since the last report
+        self.write_load = 0.0  # bytes written per second, averaged over the last report interval
+        self.joined = time.time() if joined is None else joined  # when the master first heard of this server
+        self.allocations = deque()  # timestamps of recent chunk placements on this server
+
+    def __repr__(self):
+        return f'ServerStats(disk_used={self.disk_used}/{self.disk_total}, chunk_count={self.chunk_count}, ' \
+               f'write_load={self.write_load:.0f})'
+
+    @property
+    def disk_utilization(self):
+        return self.disk_used / self.disk_total if self.disk_total else 0.0
+
+    def update(self, report):
+        """Apply a stats report of the chunk server (see ChunkServer.collect_stats)."""
+        self.disk_total = report['disk_total']
+        self.disk_used = report['disk_used']
+        self.chunk_count = report['chunk_count']
+        self.write_load = report['write_load']
+
+    def recent_allocations(self, now):
+        while self.allocations and self.allocations[0] < now - ALLOCATION_WINDOW:
+            self.allocations.popleft()
+        return len(self.allocations)
+
+
+class PlacementPolicy:
+    """Decides on which chunk servers the replicas of a new chunk are placed."""
+    __slots__ = 'clock',
+
+    def __init__(self, clock=time.time):
+        self.clock = clock  # replaceable for simulations
+
+    def place(self, servers, count, stats: Dict[str, ServerStats]):
+        """
+        Returns a list of at most `count` distinct servers picked from `servers`.
+        stats may be missing entries for servers that have not reported yet.
+        """
+        raise NotImplementedError
+
+    def record(self, placed, stats: Dict[str, ServerStats]):
+        """Book keeping after replicas were placed on the `placed` servers."""
+        now = self.clock()
+        for server in placed:
+            server_stats = stats.get(server, None)
+            if server_stats:
+                server_stats.chunk_count += 1
+                server_stats.allocations.append(now)
+
+
+class RandomPlacement(PlacementPolicy):
+    """Uniformly random placement, ignores load."""
+    __slots__ = ()
+
+    def place(self, servers, count, stats):
+        return pick_randomly(servers, count)
+
+
+class LoadAwarePlacement(PlacementPolicy):
+    """
+    Scores servers by disk utilization, chunk count and the number of chunks placed
+    on them within the last ALLOCATION_WINDOW. New chunks are the ones being written,
+    so recent placements track write traffic without the lag of the stats reports.
+    Each replica goes to the better scored of `choices` randomly sampled servers
+    ("power of d choices"), which steers away from loaded servers without herding
+    every new chunk onto the single emptiest one.
+    A server is only used when nothing else is left if it is above
+    MAX_DISK_UTILIZATION, took more than MAX_RECENT_ALLOCATION_SKEW times its fair
+    share of recent placements, reports more than MAX_WRITE_LOAD_SKEW times the
+    average write load, or joined within NEW_SERVER_PERIOD and already received
+    NEW_SERVER_MAX_ALLOCATIONS chunks in the window (so it is not flooded with all
+    new writes).
+    """
+    __slots__ = 'disk_weight', 'chunks_weight', 'load_weight', 'choices'
+
+    def __init__(self, disk_weight=1.0, chunks_weight=1.0, load_weight=1.0, choices=2, clock=time.time):
+        super().__init__(clock)
+        self.disk_weight = disk_weight
+        self.chunks_weight = chunks_weight
+        self.load_weight = load_weight
+        self.choices = choices
+
+    def place(self, servers, count, stats):
+        if not servers:
+            return []
+
+        now = self.clock()
+        known = [stats[server] for server in servers if server in stats]
+        max_chunks = max((s.chunk_count for s in known), default=0) or 1
+        mean_load = sum(s.write_load for s in known) / len(known) if known else 0
+        recent_counts = [s.recent_allocations(now) for s in known]
+        max_recent = max(recent_counts, default=0) or 1
+        # no server may take much more than its fair share of the recently created (hot) chunks,
+        # nor new chunks while it reports far more write traffic than the average
+        recent_cap = MAX_RECENT_ALLOCATION_SKEW * (sum(recent_counts) + count) / len(servers)
+
+        preferred, fallback = {}, {}
+        for server in servers:
+            server_stats = stats.get(server, None)
+            if not server_stats:
+                # never reported: neutral score
+                preferred[server] = (self.disk_weight + self.chunks_weight + self.load_weight) / 2
+                continue
+
+            recent = len(server_stats.allocations)  # already trimmed above
+            score = self.disk_weight * server_stats.disk_utilization \
+                + self.chunks_weight * server_stats.chunk_count / max_chunks \
+                + self.load_weight * recent / max_recent
+
+            throttled = recent >= recent_cap or server_stats.write_load > MAX_WRITE_LOAD_SKEW * mean_load > 0 \
+                or now - server_stats.joined < NEW_SERVER_PERIOD and recent >= NEW_SERVER_MAX_ALLOCATIONS
+            if server_stats.disk_utilization > MAX_DISK_UTILIZATION or throttled:
+                fallback[server] = score
+            else:
+                preferred[server] = score
+
+        placed = []
+        for candidates in (preferred, fallback):
+            while candidates and len(placed) < count:
+                sampled = pick_randomly(candidates, self.choices)
+                best = min(sampled, key=candidates.get)
+                placed.append(best)
+                del candidates[best]
+        return placed
+
+
+PLACEMENT_POLICIES = {
+    'random': RandomPlacement,
+    'load_aware': LoadAwarePlacement,
+}
@@ -0,0 +1,227 @@
+import socket
+import statistics
+import threading
+import time
+import xmlrpc.client
+from concurrent.futures import ThreadPoolExecutor
+
+from commons.loggers import default_logger
+from commons.settings import REPLICATION_FACTOR, CHUNK_SIZE, MAX_DISK_UTILIZATION, REBALANCE_INTERVAL, \
+    REBALANCE_THRESHOLD, REBALANCE_BATCH, REBALANCE_WORKERS, REBALANCE_BANDWIDTH, REBALANCE_COPY_TIMEOUT
+from commons.utils import rpc_call
+from master.replication import RateLimiter
+
+log = default_logger
+
+
+def balance(counts):
+    """
+    Balance of the chunk counts of the chunk servers: (coefficient of variation, max / mean).
+    (0, 1) is a perfectly balanced cluster.
+    """
+    if not counts:
+        return 0.0, 1.0
+    mean = sum(counts) / len(counts)
+    if not mean:
+        return 0.0, 1.0
+    return statistics.pstdev(counts) / mean, max(counts) / mean
+
+
+class Rebalancer:
+    """
+    Moves replicas from chunk servers holding more chunks than the average to the ones
+    holding less, so that existing data (and its read load) spreads over chunk servers
+    that joined later. New chunks are balanced by the placement policy already.
+    Every `interval` seconds a round plans up to `batch` moves, from the fullest to the
+    emptiest server, until every server is within `threshold` of the mean chunk count.
+    A move copies the chunk with order_chunk_copy_from_peer, then hands the source
+    replica to the garbage collection of its chunk server. Up to `workers` moves run in
+    parallel, limited to `bandwidth` bytes per second all together.
+    Chunks with a valid lease (being written) and under replicated chunks (left to the
+    ReplicationScheduler) are not moved. A move is given up if a lease was granted on
+    the chunk while it was copied, or if the copy takes more than `copy_timeout` seconds.
+    Destinations fuller than MAX_DISK_UTILIZATION are skipped.
+    """
+
+    def __init__(self, chunk_manager, interval=REBALANCE_INTERVAL, threshold=REBALANCE_THRESHOLD,
+                 batch=REBALANCE_BATCH, workers=REBALANCE_WORKERS, bandwidth=REBALANCE_BANDWIDTH,
+                 copy_timeout=REBALANCE_COPY_TIMEOUT):
+        self.chunk_manager = chunk_manager
+        self.interval = interval
+        self.threshold = threshold
+        self.batch = batch
+        self.copy_timeout = copy_timeout
+        self.limiter = RateLimiter(bandwidth)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rebalance')
+
+        self.lock = threading.Lock()  # protects the counters below
+        self.moving = set()  # handles being moved
+
+        # progress
+        self.rounds = 0
+        self.moved = 0
+        self.failed = 0  # copies that failed
+        self.aborted = 0  # moves given up because the chunk got leased or deleted meanwhile
+        self.skipped_leased = 0  # candidate chunks passed over because they were leased
+        self.bytes_moved = 0
+
+    def start(self):
+        threading.Thread(target=self.rebalance_loop, args=(), daemon=True).start()
+
+    def rebalance_loop(self):
+        while True:
+            time.sleep(self.interval)
+            # keep going while there is work, rounds are throttled by the limiter
+            while self.run_round():
+                pass
+
+    def run_round(self):
+        """Plans and performs one batch of moves, returns the number of replicas moved."""
+        if not self.chunk_manager.poll_status.converged.is_set():
+            return 0  # chunk counts are incomplete until every chunk server has been polled
+
+        moves = self.plan()
+        if not moves:
+            return 0
+
+        with self.lock:
+            self.rounds += 1
+        moved = sum(self.pool.map(lambda move: self.move(*move), moves))
+        log.info("Rebalancing round moved %d of %d planned replicas", moved, len(moves))
+        return moved
+
+    # Assumes chunk_manager.lock is acquired
+    def chunk_counts_helper(self):
+        cm = self.chunk_manager
+        return {server: len(cm.table.chunks_of(server)) for server in cm.active_chunk_servers}
+
+    def plan(self):
+        """Returns a list of (source, destination, chunk handle) moves reducing the imbalance."""
+        cm = self.chunk_manager
+        with cm.lock, self.lock:
+            counts = self.chunk_counts_helper()
+            if len(counts) < 2:
+                return []
+
+            mean = sum(counts.values()) / len(counts)
+            slack = max(1.0, self.threshold * mean)
+            sources = {server for server, count in counts.items() if count > mean + slack}
+            dests = {server for server in counts if self.has_room_helper(server)}
+
+            now = time.time()
+            moves = []
+            planned = set()
+            while sources and dests and len(moves) < self.batch:
+                source = max(sources, key=counts.__getitem__)
+                dest = min(dests, key=counts.__getitem__)
+                if counts[source] <= mean + slack:
+                    break
+                if counts[source] - counts[dest] < 2:
+                    break  # a move would not reduce the spread
+
+                chunk_handle = self.pick_chunk_helper(source, dest, now, planned)
+                if chunk_handle is None:
+                    sources.discard(source)  # nothing movable left there
+                    continue
+
+                planned.add(chunk_handle)
+                moves.append((source, dest, chunk_handle))
+                counts[source] -= 1
+                counts[dest] += 1
+                self.moving.add(chunk_handle)
+
+            return moves
+
+    # Assumes chunk_manager.lock is acquired
+    def has_room_helper(self, server):
+        server_stats = self.chunk_manager.server_stats.get(server, None)
+        return not server_stats or server_stats.disk_utilization < MAX_DISK_UTILIZATION
+
+    # Assumes chunk_manager.lock and lock are acquired
+    # Picks a chunk of source that can be moved to dest, or None.
+    def pick_chunk_helper(self, source, dest, now, planned):
+        cm = self.chunk_manager
+        on_dest = cm.table.chunks_of(dest)
+        for chunk_handle in cm.table.chunks_of(source):
+            if chunk_handle in planned or chunk_handle in self.moving or chunk_handle in on_dest:
+                continue
+            if cm.table.replica_count(chunk_handle) < REPLICATION_FACTOR:
+                continue  # being repaired
+
+            lease = cm.leases.get(chunk_handle, None)
+            if lease and lease.expiration >= now:
+                self.skipped_leased += 1
+                continue
+            return chunk_handle
+        return None
+
+    def move(self, source, dest, chunk_handle):
+        """Copies a replica to dest and drops it from source, returns whether it was moved."""
+        # the exact length is only known to the chunk servers, charge a full chunk
+        self.limiter.acquire(CHUNK_SIZE)
+        log.debug("Moving chunk %d from %s to %s", chunk_handle, source, dest)
+        timed_out = False
+        try:
+            # a hung destination would hold a move slot
+            err = rpc_call(dest, self.copy_timeout).order_chunk_copy_from_peer(source, chunk_handle)
+        except socket.timeout as e:
+            err, timed_out = str(e), True
+        except (OSError, xmlrpc.client.Error) as e:
+            err = str(e)
+
+        cm = self.chunk_manager
+        moved = False
+        if timed_out:
+            with cm.lock:
+                # the copy may still complete, its replica is dropped
+                cm.table.remove_location(chunk_handle, dest)
+                cm.garbage[dest].add(chunk_handle)
+        elif not err:
+            with cm.lock:
+                lease = cm.leases.get(chunk_handle, None)
+                if chunk_handle in cm.table and not (lease and lease.expiration >= time.time()):
+                    cm.table.add_location(chunk_handle, dest)
+                    cm.table.remove_location(chunk_handle, source)
+                    cm.garbage[source].add(chunk_handle)
+                    moved = True
+                else:
+                    # written or deleted meanwhile, the copy may be stale
+                    cm.table.remove_location(chunk_handle, dest)
+                    cm.garbage[dest].add(chunk_handle)
+
+        with self.lock:
+            self.moving.discard(chunk_handle)
+            if err:
+                self.failed += 1
+                log.info("Unable to move chunk %d from %s to %s: %s", chunk_handle, source, dest, err)
+                return False
+            if not moved:
+                self.aborted += 1
+                return False
+            self.moved += 1
+            self.bytes_moved += CHUNK_SIZE
+            return True
+
+    def status(self):
+        """Cluster balance and rebalancing progress, see Master.get_rebalance_status."""
+        cm = self.chunk_manager
+        with cm.lock:
+            counts = self.chunk_counts_helper()
+            disk = {server: cm.server_stats[server].disk_utilization
+                    for server in counts if server in cm.server_stats}
+
+        imbalance, max_over_mean = balance(list(counts.values()))
+        with self.lock:
+            return {
+                'imbalance': imbalance,
+                'max_over_mean': max_over_mean,
+                'chunks_per_server': counts,
+                'disk_utilization': disk,
+                'rounds': self.rounds,
+                'in_flight': len(self.moving),
+                'moved': self.moved,
+                'failed': self.failed,
+                'aborted': self.aborted,
+                'skipped_leased': self.skipped_leased,
+                'bytes_moved': float(self.bytes_moved),  # may exceed xmlrpc's 32 bit ints
+            }
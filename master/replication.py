@@ -0,0 +1,282 @@
+import heapq
+import itertools
+import threading
+import time
+import xmlrpc.client
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+
+from commons.loggers import default_logger
+from commons.settings import REPLICATION_FACTOR, CHUNK_SIZE, REPLICATION_WORKERS, MAX_COPIES_PER_SOURCE, \
+    MAX_COPIES_PER_DEST, REPLICATION_BANDWIDTH, REPLICATION_RETRIES, REPLICATION_RETRY_DELAY, \
+    REPLICATION_SCAN_INTERVAL, REPLICATION_COPY_TIMEOUT
+from commons.utils import rpc_call
+
+log = default_logger
+
+
+class RateLimiter:
+    """
+    Token bucket limiting a flow to `rate` units per second, with bursts of up to one second.
+    A request larger than the bucket is admitted once the bucket is full and then leaves
+    the bucket in debt, so large requests are delayed instead of starved.
+    """
+    __slots__ = 'rate', 'tokens', 'last', 'lock'
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount):
+        """Blocks until `amount` units may be sent."""
+        with self.lock:  # serializes waiters, first come first served
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            needed = min(amount, self.rate)
+            if self.tokens < needed:
+                time.sleep((needed - self.tokens) / self.rate)
+                self.tokens = needed
+                self.last = time.monotonic()
+            self.tokens -= amount
+
+
+class ReplicationTask:
+    chunk_handle: int
+    attempts: int
+    not_before: float
+
+    __slots__ = 'chunk_handle', 'attempts', 'not_before'
+
+    def __init__(self, chunk_handle, attempts=0, not_before=0.0):
+        self.chunk_handle = chunk_handle
+        self.attempts = attempts  # failed copies so far
+        self.not_before = not_before  # retry back off
+
+    def __repr__(self):
+        return f'ReplicationTask(chunk_handle={self.chunk_handle}, attempts={self.attempts})'
+
+
+class ReplicationScheduler:
+    """
+    Restores the replication goal of chunks that lost replicas.
+    Under replicated chunks wait in a priority queue, the chunks that lost the most
+    replicas (closest to being lost) are copied first. Up to `workers` copies run in
+    parallel, but at most `per_source` copies read from and `per_dest` copies write to
+    the same chunk server at a time, and all copies together are limited to
+    `bandwidth` bytes per second so that client traffic is not starved.
+    A failed copy, or one that takes more than `copy_timeout` seconds, is retried `retries`
+    times with a growing delay, from another source or destination if one is available.
+    A chunk has at most one copy in flight, a chunk that is still under replicated
+    after a copy is queued again (with its new priority).
+    """
+
+    def __init__(self, chunk_manager, workers=REPLICATION_WORKERS, per_source=MAX_COPIES_PER_SOURCE,
+                 per_dest=MAX_COPIES_PER_DEST, bandwidth=REPLICATION_BANDWIDTH, retries=REPLICATION_RETRIES,
+                 retry_delay=REPLICATION_RETRY_DELAY, copy_timeout=REPLICATION_COPY_TIMEOUT):
+        self.chunk_manager = chunk_manager
+        self.workers = workers
+        self.per_source = per_source
+        self.per_dest = per_dest
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.copy_timeout = copy_timeout
+        self.limiter = RateLimiter(bandwidth)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='replication')
+
+        self.cond = threading.Condition(threading.Lock())
+        self.queue = []  # heap of (-missing replicas, seq, ReplicationTask)
+        self.seq = itertools.count()  # FIFO among chunks of the same priority
+        self.scheduled = set()  # handles queued or being copied
+        self.sources = defaultdict(int)  # chunk server -> copies reading from it
+        self.dests = defaultdict(int)  # chunk server -> copies writing to it
+        self.in_flight = 0
+
+        # progress
+        self.completed = 0
+        self.failed = 0  # copies that failed, including the ones retried later
+        self.abandoned = 0  # chunks given up after all retries (queued again by the next scan)
+        self.bytes_copied = 0
+
+    def enqueue(self, chunk_handles):
+        """Queue chunks that may be under replicated, chunks already scheduled are ignored."""
+        with self.chunk_manager.lock:
+            missing = {handle: self.missing_replicas_helper(handle) for handle in chunk_handles}
+
+        with self.cond:
+            for handle, count in missing.items():
+                if count > 0 and handle not in self.scheduled:
+                    self.push_helper(ReplicationTask(handle), count)
+            self.cond.notify()
+
+    def scan(self):
+        """Queue every under replicated chunk known to the chunk manager."""
+        with self.chunk_manager.lock:
+            chunk_handles = [handle for handle, _ in self.chunk_manager.table.under_replicated(REPLICATION_FACTOR)]
+        if chunk_handles:
+            self.enqueue(chunk_handles)
+
+    def start(self, scan_interval=REPLICATION_SCAN_INTERVAL):
+        threading.Thread(target=self.dispatch_loop, args=(), daemon=True).start()
+        threading.Thread(target=self.scan_loop, args=(scan_interval,), daemon=True).start()
+
+    def scan_loop(self, interval):
+        # catches chunks given up earlier or created while too few chunk servers were alive
+        while True:
+            time.sleep(interval)
+            self.scan()
+
+    # Assumes cond is acquired
+    def push_helper(self, task, missing):
+        self.scheduled.add(task.chunk_handle)
+        heapq.heappush(self.queue, (-missing, next(self.seq), task))
+
+    # Assumes chunk_manager.lock is acquired
+    # Number of replicas a chunk needs to reach its goal, 0 for chunks that can not be
+    # repaired because they are gone or have no replica left to copy from.
+    def missing_replicas_helper(self, chunk_handle):
+        count = self.chunk_manager.table.replica_count(chunk_handle)
+        if not count:
+            return 0
+        return max(0, REPLICATION_FACTOR - count)
+
+    def dispatch_loop(self):
+        while True:
+            with self.cond:
+                while not self.queue or self.in_flight >= self.workers:
+                    self.cond.wait()
+
+            started = self.dispatch()
+
+            if not started:
+                # every queued chunk waits for a busy server or a retry delay
+                with self.cond:
+                    self.cond.wait(timeout=1)
+
+    def dispatch(self):
+        """Start copies for the most urgent chunks that fit the limits, returns the number of copies started."""
+        if not self.chunk_manager.poll_status.converged.is_set():
+            return 0  # replica counts are incomplete until every chunk server has been polled
+
+        now = time.time()
+        started = 0
+        deferred = []
+        with self.chunk_manager.lock, self.cond:
+            while self.queue and self.in_flight < self.workers:
+                priority, seq, task = heapq.heappop(self.queue)
+                if task.not_before > now:
+                    deferred.append((priority, seq, task))
+                    continue
+
+                if not self.missing_replicas_helper(task.chunk_handle):
+                    # repaired meanwhile (a chunk server came back) or deleted
+                    self.scheduled.discard(task.chunk_handle)
+                    continue
+
+                peers, busy = self.pick_peers_helper(task.chunk_handle)
+                if not peers:
+                    if busy:
+                        deferred.append((priority, seq, task))
+                    else:
+                        log.warning("No chunk server available to replicate chunk %d", task.chunk_handle)
+                        self.scheduled.discard(task.chunk_handle)
+                    continue
+
+                source, dest = peers
+                self.sources[source] += 1
+                self.dests[dest] += 1
+                self.in_flight += 1
+                started += 1
+                self.pool.submit(self.copy, task, source, dest)
+
+            for item in deferred:
+                heapq.heappush(self.queue, item)
+
+        return started
+
+    # Assumes chunk_manager.lock and cond are acquired
+    # Picks (source, destination) for copying a chunk within the per server limits.
+    # Returns the pair or None, and whether a candidate was only rejected because it is busy.
+    def pick_peers_helper(self, chunk_handle):
+        cm = self.chunk_manager
+        locations = cm.table.locations(chunk_handle)
+        sources = [cs for cs in locations if cs in cm.active_chunk_servers]
+        # a server about to delete a replica (eg. a corrupt one) would delete the copy too
+        dests = [cs for cs in cm.active_chunk_servers
+                 if cs not in locations and chunk_handle not in cm.garbage.get(cs, ())]
+        if not sources or not dests:
+            return None, False
+
+        free_sources = [cs for cs in sources if self.sources[cs] < self.per_source]
+        free_dests = [cs for cs in dests if self.dests[cs] < self.per_dest]
+        if not free_sources or not free_dests:
+            return None, True
+
+        source = min(free_sources, key=self.sources.__getitem__)  # spread reads over the replicas
+        dest = cm.placement.place(free_dests, 1, cm.server_stats)[0]
+        cm.placement.record([dest], cm.server_stats)
+        return (source, dest), False
+
+    def copy(self, task, source, dest):
+        # the exact length is only known to the chunk servers, charge a full chunk
+        self.limiter.acquire(CHUNK_SIZE)
+        log.debug("Replicating chunk %d from %s to %s", task.chunk_handle, source, dest)
+        try:
+            # a hung destination would hold the worker and the slots of both servers
+            err = rpc_call(dest, self.copy_timeout).order_chunk_copy_from_peer(source, task.chunk_handle)
+        except (OSError, xmlrpc.client.Error) as e:
+            err = str(e)
+
+        if not err:
+            # the destination reports non empty chunks itself, empty ones would go unnoticed
+            self.chunk_manager.set_chunk_location(task.chunk_handle, dest)
+
+        with self.chunk_manager.lock:
+            missing = self.missing_replicas_helper(task.chunk_handle)
+
+        with self.cond:
+            self.sources[source] -= 1
+            self.dests[dest] -= 1
+            self.in_flight -= 1
+            self.scheduled.discard(task.chunk_handle)
+
+            if err:
+                self.failed += 1
+                log.info("Unable to replicate chunk %d from %s to %s: %s", task.chunk_handle, source, dest, err)
+                task.attempts += 1
+                if task.attempts > self.retries:
+                    self.abandoned += 1
+                    log.error("Giving up replication of chunk %d after %d attempts", task.chunk_handle, task.attempts)
+                    missing = 0
+                else:
+                    task.not_before = time.time() + self.retry_delay * task.attempts
+            else:
+                self.completed += 1
+                self.bytes_copied += CHUNK_SIZE
+                task = ReplicationTask(task.chunk_handle)
+
+            if missing > 0:
+                self.push_helper(task, missing)
+            self.cond.notify()
+
+    def status(self):
+        """Repair progress, see Master.get_replication_status."""
+        with self.chunk_manager.lock:
+            under_replicated = defaultdict(int)
+            for _, count in self.chunk_manager.table.under_replicated(REPLICATION_FACTOR):
+                under_replicated[REPLICATION_FACTOR - count] += 1
+
+        with self.cond:
+            return {
+                'under_replicated': sum(under_replicated.values()),
+                # xmlrpc only supports string keys
+                'by_missing_replicas': {str(missing): count for missing, count in sorted(under_replicated.items())},
+                'queued': len(self.queue),
+                'in_flight': self.in_flight,
+                'completed': self.completed,
+                'failed': self.failed,
+                'abandoned': self.abandoned,
+                'bytes_copied': float(self.bytes_copied),  # may exceed xmlrpc's 32 bit ints
+            }
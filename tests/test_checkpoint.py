@@ -0,0 +1,69 @@
+import logging
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from commons.loggers import default_logger, request_logger  # noqa: E402
+from commons.metadata_manager import take_checkpoint  # noqa: E402
+from commons.oplog import OplogWriter  # noqa: E402
+
+# master.py can't simply be imported, the master package shadows it
+Master = runpy.run_path(os.path.join(ROOT_DIR, 'master.py'))['Master']
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        default_logger.setLevel(logging.WARNING)
+        request_logger.setLevel(logging.WARNING)
+        self.work_dir = tempfile.mkdtemp(prefix='gfs_test_checkpoint_')
+        self.m = Master('http://test', os.path.join(self.work_dir, 'oplog.bin'),
+                        os.path.join(self.work_dir, 'checkpoint.bin'))
+        self.m.oplog = OplogWriter(self.m.metadata_file)
+
+    def tearDown(self):
+        self.m.oplog.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_reports_during_checkpoints(self):
+        """Chunk reports and checkpoints take the namespace and chunk locks in the same order."""
+        ns, cm = self.m.namespace_manager, self.m.chunk_manager
+        for i in range(8):
+            file_id = ns.insert_path(f'/f{i}', False)
+            cm.table.add(i, file_id, 0, ['http://cs1'])
+        cm.chunk_handle = 8
+
+        deadline = time.monotonic() + 1
+
+        def report(server):
+            length = 0
+            while time.monotonic() < deadline:
+                length += 1
+                self.m.report_chunks(server, [[i, 0, length] for i in range(8)])
+
+        def checkpoint():
+            while time.monotonic() < deadline:
+                take_checkpoint(self.m)
+
+        threads = [threading.Thread(target=report, args=(f'http://cs{i}',), daemon=True) for i in range(2)]
+        threads.append(threading.Thread(target=checkpoint, daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive(), "deadlock between chunk reports and checkpoints")
+
+        length, err = ns.get_file_length('/f0')
+        self.assertIsNone(err)
+        self.assertGreater(length, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
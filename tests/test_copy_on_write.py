@@ -0,0 +1,105 @@
+import logging
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from commons.errors import FileNotFoundErr  # noqa: E402
+from commons.loggers import default_logger, request_logger  # noqa: E402
+from commons.oplog import OplogWriter  # noqa: E402
+
+# master.py can't simply be imported, the master package shadows it
+Master = runpy.run_path(os.path.join(ROOT_DIR, 'master.py'))['Master']
+
+LOCATIONS = ['http://cs1', 'http://cs2', 'http://cs3']
+
+
+class FakeChunkServer:
+    """Records the copies the master orders, each one takes a while."""
+
+    def __init__(self, on_copy=None):
+        self.copies = []
+        self.on_copy = on_copy
+
+    def __call__(self, address, timeout=None):
+        return self
+
+    def copy_chunk(self, chunk_handle, copy_handle, path):
+        self.copies.append((chunk_handle, copy_handle))
+        if self.on_copy:
+            self.on_copy()
+        time.sleep(0.01)
+        return None
+
+    def set_shared(self, chunk_handles, shared):
+        return None
+
+
+class CopyOnWriteTest(unittest.TestCase):
+    def setUp(self):
+        default_logger.setLevel(logging.WARNING)
+        request_logger.setLevel(logging.WARNING)
+        self.work_dir = tempfile.mkdtemp(prefix='gfs_test_cow_')
+        self.m = Master('http://test', os.path.join(self.work_dir, 'oplog.bin'),
+                        os.path.join(self.work_dir, 'checkpoint.bin'))
+        self.m.oplog = OplogWriter(self.m.metadata_file)
+
+        ns, cm = self.m.namespace_manager, self.m.chunk_manager
+        file_id = ns.insert_path('/f', False)
+        copy_id = ns.insert_path('/snap', False)
+        cm.table.add(0, file_id, 0, LOCATIONS)
+        cm.chunk_handle = 1
+        cm.share_chunks([(file_id, copy_id)])
+        cm.poll_status.converged.set()
+
+    def tearDown(self):
+        self.m.oplog.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_concurrent_writers_copy_once(self):
+        """Writers of the same shared chunk wait for a single copy instead of copying it again."""
+        chunk_server = FakeChunkServer()
+        results = []
+        with mock.patch('master.chunk_manager.rpc_call', chunk_server):
+            threads = [threading.Thread(target=lambda: results.append(self.m.copy_on_write('/f', 0)))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+
+        self.assertEqual(len(chunk_server.copies), len(LOCATIONS))
+        self.assertEqual(results, [(1, LOCATIONS, None)] * 4)
+        self.assertEqual(self.m.chunk_manager.table.refs(0), 1)
+
+    def test_delete_during_copy(self):
+        """The file is not locked while its chunk is copied, the copy is dropped if it is deleted meanwhile."""
+        deleted = []
+
+        def delete():
+            if not deleted:
+                thread = threading.Thread(target=lambda: deleted.append(self.m.delete('/f')))
+                thread.start()
+                thread.join(10)
+                self.assertTrue(deleted, "path locked while the chunk servers copy the chunk")
+
+        with mock.patch('master.chunk_manager.rpc_call', FakeChunkServer(delete)):
+            handle, locations, err = self.m.copy_on_write('/f', 0)
+
+        self.assertEqual(err, FileNotFoundErr)
+        cm = self.m.chunk_manager
+        self.assertNotIn(1, cm.table)
+        for chunk_server in LOCATIONS:
+            self.assertIn(1, cm.garbage[chunk_server])
+
+
+if __name__ == '__main__':
+    unittest.main()